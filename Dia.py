@@ -605,15 +605,23 @@ class Directory:
     return msgs
 
   def find_avps(self, vendor, code):
-    avps = set()
-    for app in self.apps:
-      if vendor == 0:
-        for a in app.find_avps(lambda x: not x.V and x.code == code):
-          avps.add(a)
-      else:
-        for a in app.find_avps(lambda x: x.V and x.vendor_id == vendor and x.code == code):
-          avps.add(a)
-    return [a for a in avps]
+    # index is built on first use, as instances may come from .dia-cache
+    if getattr(self, 'avps_index', None) is None:
+      self.avps_index = {}
+      for app in self.apps:
+        for a in app.find_avps():
+          if not a.V:
+            key = (0, a.code)
+          elif a.vendor_id:
+            key = (a.vendor_id, a.code)
+          else:
+            continue
+          # model AVPs compare equal on code and vendor, keep the first one
+          self.avps_index.setdefault(key, a)
+
+    if (vendor, code) in self.avps_index:
+      return [self.avps_index[(vendor, code)]]
+    return []
 
   def find_avps_by_app(self, appid, vendor, code):
     if appid not in self.ids: raise NonExistingAppID()
@@ -634,6 +642,19 @@ class Directory:
     if Directory.DEFAULT is None:
       Directory.DEFAULT = load(open('.dia-cache', 'rb'))
 
+    model_msgs = Directory.DEFAULT.find_msgs(wire_msg.app_id, wire_msg.code, wire_msg.R)
+    if len(model_msgs) == 0: raise NonSpecifiedMsg(wire_msg)
+    if len(model_msgs) > 1: raise MultipleSpecifiedMsg(wire_msg)
+    wire_msg.model = model_msgs[0]
+
+    Directory.tag_avps(wire_msg.avps, wire_msg.model.avps)
+
+  @staticmethod
+  def tag_avps(wire_avps, model_qavps):
+    '''tag an array of AVPs given an array of qualified AVPs.'''
+    if Directory.DEFAULT is None:
+      Directory.DEFAULT = load(open('.dia-cache', 'rb'))
+
     def find_matching_qa(wire_avp, model_qavps):
       '''find matching qualified avp in given list.'''
       wildcard = None
@@ -684,9 +705,4 @@ class Directory:
         if a.model_avp is not None and a.model_avp.datatype == 'Grouped':
           avps_tag(a.avps, a.model_avp.grouped)
 
-    model_msgs = Directory.DEFAULT.find_msgs(wire_msg.app_id, wire_msg.code, wire_msg.R)
-    if len(model_msgs) == 0: raise NonSpecifiedMsg(wire_msg)
-    if len(model_msgs) > 1: raise MultipleSpecifiedMsg(wire_msg)
-    wire_msg.model = model_msgs[0]
-
-    avps_tag(wire_msg.avps, wire_msg.model.avps)
+    avps_tag(wire_avps, model_qavps)
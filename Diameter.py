@@ -151,13 +151,21 @@ class Msg:
   def recv(f, _timeout=5.0):
     f.settimeout(_timeout)
 
-    data = scenario.unpack_frame(f)
+    if isinstance(f, scenario.Channel):
+      (m, data) = f.get()
+      if m is not None:
+        return m
+    else:
+      data = scenario.unpack_frame(f)
 
     return Msg.decode(data)
 
   def send(self, f):
     data = self.encode()
-    scenario.pack_frame(f, data)
+    if isinstance(f, scenario.Channel):
+      f.put(self, data)
+    else:
+      scenario.pack_frame(f, data)
 
   @staticmethod
   def decode(s, tag=False):
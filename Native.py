@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from struct import unpack
+from collections import OrderedDict
+from socket import inet_ntop, AF_INET, AF_INET6
+
+from Pdml import PcapLoader, Pdu
+
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = 12
+DLT_RAW_BSD = 14
+DLT_LINKTYPE_RAW = 101
+DLT_LINUX_SLL = 113
+DLT_IPV4 = 228
+DLT_IPV6 = 229
+DLT_LINUX_SLL2 = 276
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+ETH_P_8021Q = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_SCTP = 132
+
+# IPv6 extension headers which are skipped, fragment header apart
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+IPV6_AH = 51
+
+SCTP_DATA = 0
+SCTP_PPID_DIAMETER = (46, 47)
+
+# part of PDU cache keys: bump whenever extracted PDUs may change
+VERSION = 2
+
+def seq_diff(a, b):
+  '''signed difference between two 32 bits sequence numbers.'''
+  d = (a - b) & 0xffffffff
+  if d >= 0x80000000:
+    d -= 0x100000000
+  return d
+
+class Fragments(object):
+  '''collects fragments of an IP datagram, until it is complete.
+first is the number of the frame holding the first fragment seen.'''
+  def __init__(self, first):
+    self.first = first
+    self.parts = {}
+    self.total = None
+
+  def add(self, offset, data, last):
+    self.parts[offset] = data
+    if last:
+      self.total = offset + len(data)
+
+    if self.total is None:
+      return None
+
+    content = ''
+    for offset in sorted(self.parts):
+      if offset > len(content):
+        return None
+      content += self.parts[offset][len(content)-offset:]
+    if len(content) < self.total:
+      return None
+    return content[:self.total]
+
+class TcpStream(object):
+  '''reorders segments of one direction of a TCP connection.
+Once more than segments segments, or size bytes, wait for missing bytes,
+these are given up on, and delivery resumes from the first pending
+segment. gaps counts the holes given up on.'''
+  def __init__(self, segments=256, size=1<<20):
+    self.next_seq = None
+    self.pending = {}
+    self.segments = segments
+    self.size = size
+    self.gaps = 0
+
+  def add(self, seq, syn, data):
+    '''returns in-order bytes made available by this segment.'''
+    if syn:
+      self.next_seq = (seq + 1) & 0xffffffff
+      seq = self.next_seq
+    if self.next_seq is None:
+      self.next_seq = seq
+
+    if len(data) == 0:
+      return ''
+
+    d = seq_diff(seq, self.next_seq)
+    if d > 0:
+      self.pending[seq] = data
+      if len(self.pending) <= self.segments and \
+        sum([len(p) for p in self.pending.values()]) <= self.size:
+        return ''
+      # segment never captured
+      self.next_seq = min(self.pending, key=lambda s: seq_diff(s, self.next_seq))
+      self.gaps += 1
+      out = ''
+    elif -d >= len(data):
+      # retransmission of already delivered bytes
+      return ''
+    else:
+      out = data[-d:]
+      self.next_seq = (self.next_seq + len(out)) & 0xffffffff
+
+    while self.pending:
+      progress = False
+      for seq in list(self.pending):
+        d = seq_diff(seq, self.next_seq)
+        if d > 0:
+          continue
+        data = self.pending.pop(seq)
+        if -d < len(data):
+          out += data[-d:]
+          self.next_seq = (self.next_seq + len(data) + d) & 0xffffffff
+          progress = True
+      if not progress:
+        break
+
+    return out
+
+class TsnWindow(object):
+  '''TSNs of DATA chunks seen in one direction of an SCTP association: all
+TSNs up to cumulative have been seen, and those seen beyond it are kept.
+Once more than window TSNs are kept, missing ones are given up on.'''
+  def __init__(self, window=4096):
+    self.cumulative = None
+    self.above = set()
+    self.window = window
+
+  def add(self, tsn):
+    '''whether tsn was not seen before.'''
+    if self.cumulative is None:
+      self.cumulative = (tsn - 1) & 0xffffffff
+    if seq_diff(tsn, self.cumulative) <= 0 or tsn in self.above:
+      return False
+    self.above.add(tsn)
+
+    if len(self.above) > self.window:
+      first = min(self.above, key=lambda t: seq_diff(t, self.cumulative))
+      self.cumulative = (first - 1) & 0xffffffff
+
+    following = (self.cumulative + 1) & 0xffffffff
+    while following in self.above:
+      self.above.remove(following)
+      self.cumulative = following
+      following = (following + 1) & 0xffffffff
+    return True
+
+class DiameterFramer(object):
+  '''splits a byte stream into Diameter messages, using their length.'''
+  def __init__(self):
+    self.buf = ''
+
+  def add(self, data):
+    self.buf += data
+
+    while len(self.buf) >= 20:
+      version = ord(self.buf[0])
+      length = unpack('!L', '\x00' + self.buf[1:4])[0]
+      if version != 1 or length < 20:
+        # lost synchronization, drop buffered bytes
+        self.buf = ''
+        return
+      if len(self.buf) < length:
+        return
+      (msg, self.buf) = (self.buf[:length], self.buf[length:])
+      yield msg
+
+class NativeLoader(object):
+  '''extracts Diameter PDUs from a pcap file without tshark.
+Handles Ethernet (with 802.1Q tags), Linux cooked captures and raw IP
+link types, IPv4 and IPv6 with fragments reassembly, TCP streams
+reassembly, and SCTP DATA chunks reassembly.
+TCP and SCTP payloads are considered as Diameter when using one of given
+ports, or when SCTP payload protocol identifier is Diameter.
+PDUs are numbered after the frame which completes them, as tshark does.
+IP datagrams still incomplete fragments_window frames after their first
+fragment are given up on.
+Like PdmlLoader, PDUs are stored under self.pdus, unless streaming is
+set, in which case they are only yielded by iter_pdus.
+'''
+  def __init__(self, name, ports=(3868,), streaming=False, fragments_window=4096):
+    self.name = name
+    self.ports = set(ports)
+    self.pcap = PcapLoader(name)
+    self.pdus = []
+    self.flows = []
+    self.flow_keys = set()
+    self.streaming = streaming
+
+    self.ip_fragments = OrderedDict()
+    self.fragments_window = fragments_window
+    self.tcp_streams = {}
+    self.sctp_messages = {}
+    self.sctp_tsns = {}
+    self.framers = {}
+
+    if streaming:
+      return
+
+    self.pdus = [pdu for pdu in self.extract()]
+
+  def iter_pdus(self):
+    if not self.streaming:
+      return iter(self.pdus)
+    return self.extract()
+
+  def extract(self):
+    for ndx in range(len(self.pcap.frames)):
+      frm = self.pcap.frames[ndx]
+      for pdu in self.link(ndx + 1, frm['bytes']):
+        yield pdu
+
+  def link(self, number, b):
+    dlt = self.pcap.dlt
+
+    if dlt == DLT_EN10MB:
+      if len(b) < 14:
+        return []
+      (ethertype,) = unpack('!H', b[12:14])
+      off = 14
+      while ethertype in ETH_P_8021Q and len(b) >= off + 4:
+        (ethertype,) = unpack('!H', b[off+2:off+4])
+        off += 4
+      return self.network(number, ethertype, b[off:])
+    elif dlt == DLT_LINUX_SLL:
+      if len(b) < 16:
+        return []
+      (ethertype,) = unpack('!H', b[14:16])
+      return self.network(number, ethertype, b[16:])
+    elif dlt == DLT_LINUX_SLL2:
+      if len(b) < 20:
+        return []
+      (ethertype,) = unpack('!H', b[0:2])
+      return self.network(number, ethertype, b[20:])
+    elif dlt == DLT_NULL:
+      if len(b) < 4:
+        return []
+      return self.network(number, None, b[4:])
+    elif dlt in (DLT_RAW, DLT_RAW_BSD, DLT_LINKTYPE_RAW, DLT_IPV4, DLT_IPV6):
+      return self.network(number, None, b)
+    return []
+
+  def network(self, number, ethertype, b):
+    if len(b) == 0:
+      return []
+    if ethertype is None:
+      version = ord(b[0]) >> 4
+      if version == 4:
+        ethertype = ETH_P_IP
+      elif version == 6:
+        ethertype = ETH_P_IPV6
+
+    if ethertype == ETH_P_IP:
+      return self.ipv4(number, b)
+    elif ethertype == ETH_P_IPV6:
+      return self.ipv6(number, b)
+    return []
+
+  def fragments(self, number, key):
+    '''Fragments of datagram key, after evicting expired datagrams, which
+are the oldest ones.'''
+    while self.ip_fragments:
+      (oldest, frags) = next(self.ip_fragments.iteritems())
+      if number - frags.first <= self.fragments_window:
+        break
+      del self.ip_fragments[oldest]
+    return self.ip_fragments.setdefault(key, Fragments(number))
+
+  def ipv4(self, number, b):
+    if len(b) < 20:
+      return []
+    ihl = (ord(b[0]) & 0x0f) * 4
+    (total, ident, frag) = unpack('!HHH', b[2:8])
+    if total == 0:
+      # length left to segmentation offload
+      total = len(b)
+    proto = ord(b[9])
+    src = inet_ntop(AF_INET, b[12:16])
+    dst = inet_ntop(AF_INET, b[16:20])
+
+    payload = b[ihl:total]
+    offset = (frag & 0x1fff) * 8
+    more = frag & 0x2000
+
+    if offset or more:
+      key = (src, dst, ident, proto)
+      frags = self.fragments(number, key)
+      payload = frags.add(offset, payload, not more)
+      if payload is None:
+        return []
+      del self.ip_fragments[key]
+
+    return self.transport(number, src, dst, proto, payload)
+
+  def ipv6(self, number, b):
+    if len(b) < 40:
+      return []
+    (length,) = unpack('!H', b[4:6])
+    nh = ord(b[6])
+    src = inet_ntop(AF_INET6, b[8:24])
+    dst = inet_ntop(AF_INET6, b[24:40])
+    payload = b[40:40+length]
+
+    while True:
+      if nh in IPV6_EXTENSIONS and len(payload) >= 8:
+        (nh, hlen) = (ord(payload[0]), (ord(payload[1]) + 1) * 8)
+        payload = payload[hlen:]
+      elif nh == IPV6_AH and len(payload) >= 8:
+        (nh, hlen) = (ord(payload[0]), (ord(payload[1]) + 2) * 4)
+        payload = payload[hlen:]
+      elif nh == IPV6_FRAGMENT and len(payload) >= 8:
+        (nh, frag, ident) = unpack('!BxHL', payload[:8])
+        key = (src, dst, ident)
+        frags = self.fragments(number, key)
+        payload = frags.add(frag & 0xfff8, payload[8:], not (frag & 1))
+        if payload is None:
+          return []
+        del self.ip_fragments[key]
+      else:
+        break
+
+    return self.transport(number, src, dst, nh, payload)
+
+  def transport(self, number, src, dst, proto, b):
+    if proto == IPPROTO_TCP:
+      return self.tcp(number, src, dst, b)
+    elif proto == IPPROTO_SCTP:
+      return self.sctp(number, src, dst, b)
+    return []
+
+  def tcp(self, number, src, dst, b):
+    if len(b) < 20:
+      return []
+    (sport, dport, seq) = unpack('!HHL', b[:8])
+    doff = (ord(b[12]) >> 4) * 4
+    syn = ord(b[13]) & 0x02
+
+    if sport not in self.ports and dport not in self.ports:
+      return []
+
+    label = (IPPROTO_TCP, src, sport, dst, dport)
+    stream = self.tcp_streams.setdefault(label, TcpStream())
+    gaps = stream.gaps
+    data = stream.add(seq, syn, b[doff:])
+    if stream.gaps != gaps:
+      # bytes buffered before the hole belong to an incomplete message
+      self.framers.pop(label, None)
+    if not data:
+      return []
+
+    return self.messages(number, label, data)
+
+  def sctp(self, number, src, dst, b):
+    if len(b) < 12:
+      return []
+    (sport, dport) = unpack('!HH', b[:4])
+    label = (IPPROTO_SCTP, src, sport, dst, dport)
+    tsns = self.sctp_tsns.setdefault(label, TsnWindow())
+
+    pdus = []
+    off = 12
+    while off + 4 <= len(b):
+      (ctype, flags, clen) = unpack('!BBH', b[off:off+4])
+      if clen < 4:
+        break
+      chunk = b[off:off+clen]
+      off += (clen + 3) & ~3
+
+      if ctype != SCTP_DATA or len(chunk) < 16:
+        continue
+
+      (tsn, sid, ssn, ppid) = unpack('!LHHL', chunk[4:16])
+      if not tsns.add(tsn):
+        # retransmitted chunk
+        continue
+      if sport not in self.ports and dport not in self.ports and \
+        ppid not in SCTP_PPID_DIAMETER:
+        continue
+
+      data = chunk[16:]
+      key = label + (sid,)
+      if flags & 0x02:
+        self.sctp_messages[key] = data
+      elif key in self.sctp_messages:
+        self.sctp_messages[key] += data
+      else:
+        # middle or end of a message whose beginning was not captured
+        continue
+
+      if flags & 0x01:
+        pdus.extend(self.messages(number, label, self.sctp_messages.pop(key)))
+
+    return pdus
+
+  def messages(self, number, label, data):
+    framer = self.framers.setdefault(label, DiameterFramer())
+
+    pdus = []
+    for msg in framer.add(data):
+      (proto, src, sport, dst, dport) = label
+
+      rlabel = (proto, dst, dport, src, sport)
+      if rlabel not in self.flow_keys and label not in self.flow_keys:
+        self.flow_keys.add(label)
+        self.flows.append(label)
+
+      pdu = Pdu.from_content(number, src, dst, proto, sport, dport, 'diameter', msg)
+      pdu.summary = 'DIAMETER'
+      pdus.append(pdu)
+
+    return pdus
@@ -9,7 +9,11 @@
 import xml.parsers.expat
 import subprocess
 import sys
-from struct import unpack
+from struct import unpack, unpack_from, Struct
+from array import array
+import mmap
+from collections import deque
+from heapq import heappush, heappop
 from binascii import a2b_hex
 from socket import inet_ntoa
 
@@ -18,43 +22,79 @@ track_owner = False
 def isgraph(c):
   return ord(c) > 0x20 and ord(c) < 0x7f
 
+class PcapFrames(object):
+  '''lazy sequence of the frames of a memory mapped pcap file.
+Only frame offsets and headers are kept in memory, frames are built on
+access.'''
+  def __init__(self, mm):
+    self.mm = mm
+    self.offsets = array('L')
+    self.caplens = array('L')
+    self.lens = array('L')
+    self.ts = array('d')
+
+  def append(self, offset, caplen, l, ts):
+    self.offsets.append(offset)
+    self.caplens.append(caplen)
+    self.lens.append(l)
+    self.ts.append(ts)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, ndx):
+    caplen = self.caplens[ndx]
+    return {'ts': self.ts[ndx], 'caplen': caplen, 'len': self.lens[ndx],
+      'bytes': buffer(self.mm, self.offsets[ndx], caplen)}
+
+  def __iter__(self):
+    for ndx in xrange(len(self)):
+      yield self[ndx]
+
 class PcapLoader(object):
-  '''reads a pcap file and stores frames under self.frames.
+  '''memory maps a pcap file and serves its frames under self.frames.
 A frame is a dictionary with the following keys:
 _ 'ts': a double, representing tv_sec + tv_usec/1000000
 _ 'caplen': an integer, representing captured length
 _ 'len': an integer, representing original wire length
-_ 'bytes': an array of bytes, the captured bytes
+_ 'bytes': a read-only buffer over the captured bytes
+Both byte orders, and nanosecond resolution files, are supported.
 '''
+  MAGICS = {
+    0xa1b2c3d4: ('<', 0.000001),
+    0xd4c3b2a1: ('>', 0.000001),
+    0xa1b23c4d: ('<', 0.000000001),
+    0x4d3cb2a1: ('>', 0.000000001),
+  }
+
   def __init__(self, name):
-    f = open(name, 'rb')
-    magic = f.read(4)
-    assert(len(magic) == 4)
-    (self.magic,) = unpack('=L', magic)
-    if self.magic == 0xa1b2c3d4:
-      swapped = '<'
-    elif self.magic == 0xd4c3b2a1:
-      swapped = '>'
-    else:
+    with open(name, 'rb') as f:
+      magic = f.read(4)
+      assert(len(magic) == 4)
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (self.magic,) = unpack('<L', magic)
+    if self.magic not in PcapLoader.MAGICS:
       print >>sys.stderr, 'pcap magic unknown!'
       sys.exit(1)
-    fhdr = f.read(20)
-    assert(len(fhdr) == 20)
+    (swapped, resolution) = PcapLoader.MAGICS[self.magic]
+
+    assert(len(self.mm) >= 24)
     (self.maj, self.min, self.zone, self.sigfigs,
-      self.snaplen, self.dlt) = unpack(swapped + 'HHLLLL', fhdr)
+      self.snaplen, self.dlt) = unpack_from(swapped + 'HHLLLL', self.mm, 4)
     
-    self.frames = []
+    self.frames = PcapFrames(self.mm)
     
-    while True:
-      phdr = f.read(16)
-      if len(phdr) == 0:
-        break
-      assert(len(phdr) == 16)
-      (sec, usec, caplen, l) = unpack(swapped + 'LLLL', phdr)
-      content = f.read(caplen)
-      assert(len(content) == caplen)
-      
-      self.frames.append({'ts': sec + usec*0.000001, 'caplen': caplen, 'len': l, 'bytes': bytes(content)})
+    phdr = Struct(swapped + 'LLLL')
+    offset = 24
+    while offset < len(self.mm):
+      assert(offset + 16 <= len(self.mm))
+      (sec, frac, caplen, l) = phdr.unpack_from(self.mm, offset)
+      offset += 16
+      assert(offset + caplen <= len(self.mm))
+
+      self.frames.append(offset, caplen, l, sec + frac*resolution)
+      offset += caplen
 
 class TaggedChunk(object):
   def __init__(self, owner, pos, content):
@@ -72,25 +112,12 @@ It is already dissected, and dissection is flattened to create a signature.
 '''
   def __init__(self, frame, ipsrc, ipdst, ipproto, sport, dport, apps, roots):
     self.pdml = frame
-    self.ipsrc = ipsrc
-    self.ipdst = ipdst
-    self.ipprotocol = ipproto
-    if self.ipprotocol == 6:
-      self.proto = 'tcp'
-    elif self.ipprotocol == 17:
-      self.proto = 'udp'
-    elif self.ipprotocol == 132:
-      self.proto = 'sctp'
-    self.sport = sport
-    self.dport = dport
+    self.set_addresses(ipsrc, ipdst, ipproto, sport, dport)
     self.apps = apps
     self.content = None
     self.fields = []
     self.tags = []
 
-    self.source = '%s:%d' % (self.ipsrc, self.sport)
-    self.dest = '%s:%d' % (self.ipdst, self.dport)
-
     id = 0
     flds = roots
     
@@ -120,45 +147,102 @@ It is already dissected, and dissection is flattened to create a signature.
     if not track_owner:
       return
 
-    tagged_bytes = [None] * (end - start + 1)
     for fld in self.fields:
       fld.pos -= start
-      for i in range(fld.pos, fld.pos+fld.size):
-        if i < len(tagged_bytes):
-          tagged_bytes[i] = fld
 
-    for ndx in range(0, len(tagged_bytes)):
-      owner = tagged_bytes[ndx]
+    for (s, e, owner) in Pdu.owned_intervals(self.fields, end - start + 1):
       if owner is None:
-        print >>sys.stderr, 'byte %d does not belong to any field' % ndx
+        print >>sys.stderr, 'byte %d does not belong to any field' % s
         sys.exit(1)
 
-    i = 0
-    while i < len(tagged_bytes):
-      owner = tagged_bytes[i]
-      assert(owner is not None)
-      
-      s = i
-      while i < len(tagged_bytes) and tagged_bytes[i] == owner:
-        i += 1
-       
-      e = i - 1
-      
       t = TaggedChunk(owner, s, self.content[s:e+1])
       self.tags.append(t)
-      if len(t.content) != e - s + 1:
-        print('%r' % self.content)
-        print('%r' % self.content[s:])
-        print('spanning %d -> %d %r' % (s, e, t.content))
-        print('%d <-> %d' % (len(t.content), e - s + 1))
       assert(len(t.content) == e - s + 1)
 
+  @staticmethod
+  def owned_intervals(fields, length):
+    '''splits [0, length) in maximal (start, end, owner) runs, end included.
+A byte is owned by the last field of fields covering it, or by None.
+Field intervals are swept in order, keeping covering fields in a heap.'''
+    starts = []
+    bounds = set([0, length])
+    for ndx in range(len(fields)):
+      fld = fields[ndx]
+      (s, e) = (fld.pos, min(fld.pos + fld.size, length))
+      if s < e:
+        starts.append((s, ndx, e))
+        bounds.add(s)
+        bounds.add(e)
+    starts.sort(reverse=True)
+    bounds = sorted(b for b in bounds if b <= length)
+
+    runs = []
+    covering = []
+    for i in range(len(bounds) - 1):
+      (s, e) = (bounds[i], bounds[i+1])
+
+      while starts and starts[-1][0] == s:
+        (_, ndx, fe) = starts.pop()
+        heappush(covering, (-ndx, fe))
+      while covering and covering[0][1] <= s:
+        heappop(covering)
+
+      owner = None
+      if covering:
+        owner = fields[-covering[0][0]]
+
+      if runs and runs[-1][2] is owner:
+        runs[-1] = (runs[-1][0], e - 1, owner)
+      else:
+        runs.append((s, e - 1, owner))
+
+    return runs
+
+  @staticmethod
+  def from_content(frm_number, ipsrc, ipdst, ipproto, sport, dport, apps, content):
+    '''builds a Pdu from content extracted without tshark, hence without fields.'''
+    pdu = Pdu.__new__(Pdu)
+    pdu.pdml = FrameNumber(frm_number)
+    pdu.set_addresses(ipsrc, ipdst, ipproto, sport, dport)
+    pdu.apps = apps
+    pdu.content = content
+    pdu.fields = []
+    pdu.tags = []
+    return pdu
+
+  def set_addresses(self, ipsrc, ipdst, ipproto, sport, dport):
+    self.ipsrc = ipsrc
+    self.ipdst = ipdst
+    self.ipprotocol = ipproto
+    if self.ipprotocol == 6:
+      self.proto = 'tcp'
+    elif self.ipprotocol == 17:
+      self.proto = 'udp'
+    elif self.ipprotocol == 132:
+      self.proto = 'sctp'
+    self.sport = sport
+    self.dport = dport
+
+    self.source = '%s:%d' % (self.ipsrc, self.sport)
+    self.dest = '%s:%d' % (self.ipdst, self.dport)
+
+  def release(self):
+    '''drop references to the PDML tree, keeping only content and addressing.'''
+    self.pdml = FrameNumber(self.pdml.frm_number)
+    self.fields = []
+
   def __repr__(self):
     s = '[\n'
     s += ',\n'.join(['    %r' % line for line in self.content.splitlines(True)])
     s += '\n  ]'
     return s
 
+class FrameNumber(object):
+  '''stands for a PdmlFrame whose fields have been dropped.'''
+  def __init__(self, frm_number):
+    self.frm_number = frm_number
+    self.reassembled = None
+
 class PdmlFrame(object):
   '''gathers PDML fields extracted by tshark, plus fragments and raw bytes.
 Fields are stored with respect to their tree nature.
@@ -171,6 +255,12 @@ Fields are stored with respect to their tree nature.
     self.pcap = None
     self.reassembled_later = False
     self.reassembled = None
+    self.pdu = None
+    self.fields_by_name = {}
+
+  def add_field(self, fld):
+    self.fields.append(fld)
+    self.fields_by_name[fld.name] = fld
   
   def add_fragment(self, f):
     if self.reassembled is None:
@@ -188,10 +278,8 @@ Fields are stored with respect to their tree nature.
     return self.get_content()[pos:pos+size]
 
   def get_field(self, n):
-    candidates = [f for f in self.fields if f.name == n]
-    if len(candidates) == 0:
-      return None
-    return candidates[-1]
+    '''last field named n, if any.'''
+    return self.fields_by_name.get(n)
 
   def get_pdu(self, loader):
     if self.reassembled_later and self.reassembled is None:
@@ -236,9 +324,10 @@ Fields are stored with respect to their tree nature.
     apps = self.protocols[ndx+5:]
 
     rlabel = (ipprotocol, ipdst, dport, ipsrc, sport)
-    if rlabel not in loader.flows:
+    if rlabel not in loader.flow_keys:
       label = (ipprotocol, ipsrc, sport, ipdst, dport)
-      if label not in loader.flows:
+      if label not in loader.flow_keys:
+        loader.flow_keys.add(label)
         loader.flows.append(label)
 
     roots = []
@@ -277,10 +366,21 @@ _ generated: it represents an additional information derived from frame content
     return '<%s>' % self.name
 
 class PdmlLoader(object):
-  def __init__(self, name, opts=[]):
+  '''runs tshark over a pcap file, and extracts PDUs from its PDML output.
+By default, the whole capture is loaded, and PDUs are stored under
+self.pdus. In streaming mode, nothing is loaded by the constructor: PDUs
+are yielded by iter_pdus as tshark output is read, and frames are
+dropped once window later frames have been seen, which leaves room for
+reassembly of PDUs spanning up to window frames.
+'''
+  CHUNK_SIZE = 65536
+
+  def __init__(self, name, opts=[], streaming=False, window=1024):
     self.frames = []
+    self.frame = None
     self.pdus = []
     self.name = name
+    self.opts = opts
     self.context = []
     self.pcap = PcapLoader(name)
     self.summaries = []
@@ -289,44 +389,109 @@ class PdmlLoader(object):
     self.start_structure = False
     self.psml_sections = []
     self.flows = []
+    self.flow_keys = set()
+    self.frames_by_number = {}
+    self.streaming = streaming
+    self.window = window
+    self.completed = deque()
+
+    if streaming:
+      self.frames = deque()
+      self.summaries = deque()
+      return
+
+    (p, psml) = self.start_psml()
+    while self.parse_chunk(p, psml):
+      pass
+    psml.wait()
+
+    (p, pdml) = self.start_pdml()
+    while self.parse_chunk(p, pdml):
+      pass
+    pdml.wait()
+
+    assert(len(self.frames) == len(self.summaries))
 
+    for ndx in range(0, len(self.frames)):
+      frm = self.frames[ndx]
+      pdu = frm.get_pdu(self)
+      if pdu is not None:
+        pdu.summary = self.summaries[ndx]
+        self.pdus.append(pdu)
+
+  def start_psml(self):
     p = xml.parsers.expat.ParserCreate()
     p.StartElementHandler = self.psml_start
     p.EndElementHandler = self.psml_end
     p.CharacterDataHandler = self.psml_data
-    cmdline = ['tshark', '-n', '-r', name, '-T', 'psml']
-    cmdline.extend(opts)
+    cmdline = ['tshark', '-n', '-r', self.name, '-T', 'psml']
+    cmdline.extend(self.opts)
     psml = subprocess.Popen(cmdline,
       stdout=subprocess.PIPE)
-    while True:
-      buf = psml.stdout.read()
-      p.Parse(buf, len(buf) == 0)
-      if len(buf) == 0:
-        break
-    psml.wait()
+    return (p, psml)
 
+  def start_pdml(self):
     p = xml.parsers.expat.ParserCreate()
     p.StartElementHandler = self.pdml_start
     p.EndElementHandler = self.pdml_end
-    cmdline = ['tshark', '-n', '-r', name, '-T', 'pdml']
-    cmdline.extend(opts)
+    cmdline = ['tshark', '-n', '-r', self.name, '-T', 'pdml']
+    cmdline.extend(self.opts)
     pdml = subprocess.Popen(cmdline,
       stdout=subprocess.PIPE)
-    while True:
-      buf = pdml.stdout.read()
-      p.Parse(buf, len(buf) == 0)
-      if len(buf) == 0:
-        break
-    pdml.wait()
-
-    assert(len(self.frames) == len(self.summaries))
+    return (p, pdml)
+
+  def parse_chunk(self, p, proc):
+    '''feed parser with next chunk of tshark output.
+Returns False once output is exhausted.'''
+    buf = proc.stdout.read(PdmlLoader.CHUNK_SIZE)
+    p.Parse(buf, len(buf) == 0)
+    return len(buf) > 0
+
+  def iter_pdus(self):
+    if not self.streaming:
+      for pdu in self.pdus:
+        yield pdu
+      return
 
-    for ndx in range(0, len(self.frames)):
-      frm = self.frames[ndx]
-      pdu = frm.get_pdu(self)
-      if pdu is not None:
-        pdu.summary = self.summaries[ndx]
-        self.pdus.append(pdu)
+    (psml_parser, psml) = self.start_psml()
+    (pdml_parser, pdml) = self.start_pdml()
+    psml_open = True
+
+    try:
+      while True:
+        more = self.parse_chunk(pdml_parser, pdml)
+
+        while self.completed:
+          frm = self.completed.popleft()
+
+          while psml_open and len(self.summaries) == 0:
+            psml_open = self.parse_chunk(psml_parser, psml)
+          assert(len(self.summaries) > 0)
+          summary = self.summaries.popleft()
+
+          frm.pdu = frm.get_pdu(self)
+          if frm.pdu is not None:
+            frm.pdu.summary = summary
+
+        # current frame, if any, is the last one and is not completed
+        while len(self.frames) > self.window + 1 or (not more and self.frames):
+          frm = self.frames.popleft()
+          self.frames_by_number.pop(frm.frm_number, None)
+          if frm.pdu is not None and not frm.reassembled_later:
+            if not track_owner:
+              frm.pdu.release()
+            yield frm.pdu
+
+        if not more:
+          break
+
+      pdml.wait()
+      psml.wait()
+    finally:
+      for proc in (pdml, psml):
+        if proc.poll() is None:
+          proc.kill()
+          proc.wait()
 
   def psml_start(self, name, attrs):
     if name == 'packet':
@@ -362,14 +527,15 @@ class PdmlLoader(object):
       
       root = PdmlField('[root]', None)
       
-      frame.fields.append(root)
+      frame.add_field(root)
       frame.top = root
       
       self.frames.append(frame)
+      self.frame = frame
       
       self.context.append(root)
     elif name == 'proto' or name == 'field':
-      frame = self.frames[-1]
+      frame = self.frame
       
       fname = attrs['name']
       if 'size' in attrs:
@@ -392,6 +558,7 @@ class PdmlLoader(object):
       elif fname == 'frame.number':
         fld = PdmlField(fname, self.context[-1], show)
         frame.frm_number = int(show)
+        self.frames_by_number[frame.frm_number] = frame
       elif fname == 'frame.protocols':
         fld = PdmlField(fname, self.context[-1], show)
         frame.protocols = show
@@ -401,9 +568,8 @@ class PdmlLoader(object):
         fld = PdmlField(fname, self.context[-1])
         
         frag_number = int(show)
-        for frm in self.frames:
-          if frm.frm_number == frag_number:
-            frm.reassembled_later = True
+        if frag_number in self.frames_by_number:
+          self.frames_by_number[frag_number].reassembled_later = True
         
         frame.add_fragment(a2b_hex(value))
       elif size > 0:
@@ -426,7 +592,7 @@ class PdmlLoader(object):
       
       assert(fld is not None)
       
-      frame.fields.append(fld)
+      frame.add_field(fld)
       self.context.append(fld)
     else:
       pass
@@ -435,9 +601,11 @@ class PdmlLoader(object):
     if name == 'packet':
       assert(len(self.context) == 1)
       self.context.pop(-1)
+      if self.streaming:
+        self.completed.append(self.frame)
     elif name == 'proto' or name == 'field':
       fld = self.context[-1]
-      frame = self.frames[-1]
+      frame = self.frame
       
       if fld.name == 'frame.number':
         frame.pcap = self.pcap.frames[frame.frm_number-1]
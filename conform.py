@@ -7,9 +7,12 @@
 # license which can be found in the file 'LICENSE' in this package distribution.
 
 from Dia import *
+import Diameter as dm
 from cPickle import load
 from collections import namedtuple
 from struct import unpack
+from multiprocessing import Process, Queue
+from threading import Thread, Lock, Condition
 
 QualifierViolation = namedtuple('QualifierViolation', 'qualified_avp avps')
 
@@ -58,3 +61,105 @@ def conform_avp(a):
         violations.append(UTF8Violation(a.model_avp.name, a))
 
   return violations
+
+def describe(v):
+  '''flatten a violation into a JSON serializable dictionary.'''
+
+  d = {'violation': type(v).__name__}
+
+  if isinstance(v, QualifierViolation):
+    d['avp'] = v.qualified_avp.name
+    d['count'] = len(v.avps)
+  else:
+    d['avp'] = v.name
+    if v.avp.data is not None:
+      d['length'] = len(v.avp.data)
+    if isinstance(v, ExpectedLengthViolation):
+      d['expected'] = v.expected
+
+  return d
+
+def application_name(m):
+  '''name of the application defining the model of a tagged message.'''
+  for app in Directory.DEFAULT.ids.get(m.app_id, []):
+    if m.model in app.msgs:
+      return app.name
+  return '%d' % m.app_id
+
+def check_msg(data):
+  '''decode, tag and conform a wire message.
+Returns a list of violation records as flattened by describe, completed
+with application and command of the message.'''
+
+  try:
+    m = dm.Msg.decode(data, tag=True)
+  except Exception as e:
+    return [{'violation': type(e).__name__}]
+
+  record = {'application': application_name(m), 'command': m.model.name}
+
+  records = []
+  for v in conform_avps(m.avps, m.model.avps):
+    r = dict(record)
+    r.update(describe(v))
+    records.append(r)
+
+  return records
+
+def validation_worker(requests, results):
+  for (key, data) in iter(requests.get, None):
+    results.put((key, check_msg(data)))
+
+class AnswerValidator:
+  '''conformance-checks wire messages in background worker processes.
+Messages are submitted along with the case they belong to, and resulting
+violation records are appended to case.violations once available, so that
+submitting never waits for the check to complete.'''
+  def __init__(self, workers=1):
+    self.requests = Queue()
+    self.results = Queue()
+
+    self.workers = []
+    for i in range(workers):
+      p = Process(target=validation_worker, args=(self.requests, self.results))
+      p.daemon = True
+      p.start()
+      self.workers.append(p)
+
+    self.lock = Lock()
+    self.idle = Condition(self.lock)
+    self.cases = {}
+    self.next_key = 0
+
+    self.collector = Thread(target=self.collect)
+    self.collector.daemon = True
+    self.collector.start()
+
+  def submit(self, case, data):
+    with self.lock:
+      key = self.next_key
+      self.next_key += 1
+      self.cases[key] = case
+    self.requests.put((key, data))
+
+  def collect(self):
+    for (key, records) in iter(self.results.get, None):
+      with self.lock:
+        case = self.cases.pop(key)
+        case.violations.extend(records)
+        if not self.cases:
+          self.idle.notify_all()
+
+  def close(self):
+    '''wait for submitted messages to be checked, and stop workers.'''
+    with self.lock:
+      while self.cases:
+        self.idle.wait()
+
+    for p in self.workers:
+      self.requests.put(None)
+    for p in self.workers:
+      p.join()
+
+    self.results.put(None)
+    self.collector.join()
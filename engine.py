@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import socket as sk
+import select as sl
+import os
+import errno
+import time
+import traceback
+from collections import namedtuple, deque
+from heapq import heappush, heappop
+
+import Diameter as dm
+from scenario import Channel, Disconnected, Transcript, pack_frame, unpack_frame, frames, dwa, HEADER
+from mutate import MutateScenario, MessageTooBig
+from transaction import Transactions
+
+'''actions yielded by scenario coroutines. Send resumes with None, Recv
+resumes with a (Msg or None, encoded bytes) pair, or raises socket.timeout
+once timeout seconds have elapsed, or Disconnected. Expect is like Recv,
+but resumes with a Msg, after checking its code and R flag when not None.
+Close ends the session. msg is either a Msg or its encoded bytes.
+Request sends request msg, a Msg whose identifiers are allocated by the
+transaction layer, and resumes with its Transaction at once, so that
+several requests may be in flight. Wait resumes with the answer of a
+transaction, or raises what ended it, socket.timeout or Disconnected.
+Answers to such requests are never received through Recv or Expect.'''
+Send = namedtuple('Send', 'msg')
+Recv = namedtuple('Recv', 'timeout')
+Expect = namedtuple('Expect', 'timeout code R')
+Close = namedtuple('Close', '')
+Request = namedtuple('Request', 'msg timeout')
+Wait = namedtuple('Wait', 'transaction')
+
+def deliver(action, item):
+  '''(value, exception) resuming a coroutine waiting on action, given
+a received (Msg or None, encoded bytes) pair.'''
+  if isinstance(action, Recv):
+    return (item, None)
+
+  (m, data) = item
+  try:
+    if m is None:
+      m = dm.Msg.decode(data)
+  except Exception as e:
+    return (None, e)
+
+  if action.code is not None and m.code != action.code:
+    return (None, dm.RecvMismatch('expected code %d, got %d' % (action.code, m.code)))
+  if action.R is not None and m.R != action.R:
+    return (None, dm.RecvMismatch('expected R=%r, got R=%r' % (action.R, m.R)))
+  return (m, None)
+
+def outcome(t):
+  '''(value, exception) resuming a coroutine waiting on transaction t.'''
+  try:
+    return (t.result(), None)
+  except Exception as e:
+    return (None, e)
+
+class Peer(object):
+  '''given to coroutine scenarios, to build the actions they yield:
+
+  m = yield peer.expect(272, R=False)
+  yield peer.send(m)
+
+  t = yield peer.request(m)
+  ...
+  m = yield peer.wait(t)
+
+timeout is used by recv, expect and request, unless they are given their own.
+Session-Id and IMSI of sent messages are overridden by session_id and imsi
+entries of args, as in templates.'''
+  def __init__(self, timeout=5.0, args={}):
+    self.timeout = timeout
+    self.args = args
+
+  def substitute(self, m):
+    if isinstance(m, dm.Msg) and self.args:
+      from scn2tpl import substitute
+      substitute(m, self.args)
+    return m
+
+  def send(self, m):
+    return Send(self.substitute(m))
+
+  def recv(self, timeout=None):
+    return self.expect(None, None, timeout)
+
+  def expect(self, code, R=None, timeout=None):
+    if timeout is None:
+      timeout = self.timeout
+    return Expect(timeout, code, R)
+
+  def request(self, m, timeout=None):
+    if timeout is None:
+      timeout = self.timeout
+    return Request(self.substitute(m), timeout)
+
+  def wait(self, t):
+    return Wait(t)
+
+  def close(self):
+    return Close()
+
+class CoroutineScenario(object):
+  '''a scenario whose run function is a generator, given a Peer.
+It is called like other scenarios, or run by the engine as a coroutine.'''
+  def __init__(self, run, timeout=5.0):
+    self.run = run
+    self.timeout = timeout
+
+  def __call__(self, f, args={}):
+    drive(self.coroutine(args), f)
+
+  def coroutine(self, args={}):
+    return self.run(Peer(self.timeout, args), args)
+
+def drive(coroutine, f):
+  '''runs a scenario coroutine over f, blocking on each action.
+f is what dwr_handler gives to scenarios.'''
+  tsxs = Transactions()
+  inbox = deque()
+
+  def read(timeout):
+    f.settimeout(timeout)
+    if isinstance(f, Channel):
+      return f.get()
+    return (None, unpack_frame(f))
+
+  def route(item):
+    '''completes the transaction answered by item, if any.'''
+    t = tsxs.match(item[1])
+    if t is None:
+      return False
+    tsxs.answer(t, item[0] or dm.Msg.decode(item[1]))
+    return True
+
+  (value, exc) = (None, None)
+  while True:
+    try:
+      if exc is not None:
+        action = coroutine.throw(exc)
+      else:
+        action = coroutine.send(value)
+    except StopIteration:
+      return
+    (value, exc) = (None, None)
+
+    if isinstance(action, Send):
+      if isinstance(action.msg, dm.Msg):
+        action.msg.send(f)
+      else:
+        pack_frame(f, action.msg)
+
+    elif isinstance(action, (Recv, Expect)):
+      try:
+        if inbox:
+          item = inbox.popleft()
+        else:
+          item = read(action.timeout)
+          while route(item):
+            item = read(action.timeout)
+      except (sk.timeout, Disconnected) as e:
+        exc = e
+      else:
+        (value, exc) = deliver(action, item)
+
+    elif isinstance(action, Request):
+      value = tsxs.request(action.msg, action.timeout)
+      action.msg.send(f)
+
+    elif isinstance(action, Wait):
+      t = action.transaction
+      try:
+        while not t.done():
+          timeout = None
+          if t.deadline is not None:
+            timeout = max(0, t.deadline - time.time())
+          try:
+            item = read(timeout)
+          except sk.timeout:
+            tsxs.expire()
+            continue
+          if not route(item):
+            inbox.append(item)
+      except Disconnected as e:
+        tsxs.fail_all(e)
+      (value, exc) = outcome(t)
+
+    elif isinstance(action, Close):
+      f.close()
+      coroutine.close()
+      return
+
+class Session(object):
+  '''a scenario coroutine run by the engine over a connected socket.
+Like dwr_handler, DWR are answered on behalf of the scenario, and once
+done, exc_info holds the scenario exception, or the reason why the
+session was interrupted, and msgs is the Transcript of exchanged messages.
+Messages are recorded encoded, and only decoded once accessed, or when
+a coroutine expects them.'''
+  def __init__(self, engine, f, coroutine, mutator=None, validate=None, done=None):
+    assert(mutator is None or isinstance(mutator, MutateScenario))
+    self.engine = engine
+    self.f = f
+    self.fd = f.fileno()
+    self.coroutine = coroutine
+    self.mutator = mutator
+    self.validate = validate
+    self.done = done
+
+    self.rbuf = ''
+    self.wbuf = deque()
+    self.inbox = deque()
+    self.tsxs = Transactions()
+    self.action = None
+    self.waiting = None
+    self.connecting = False
+    self.finished = False
+
+    self.exc_info = None
+    self.msgs = Transcript()
+
+    if mutator is not None:
+      mutator.bind(self)
+
+  def fileno(self):
+    return self.fd
+
+  def sendall(self, data):
+    '''queues data for transmission, used by mutators.'''
+    self.wbuf.append(data)
+
+  def resume(self, value=None, exc=None):
+    '''advances the coroutine until it waits for a message, or ends.'''
+    self.waiting = None
+    while not self.finished:
+      try:
+        if exc is not None:
+          (e, exc) = (exc, None)
+          action = self.coroutine.throw(e)
+        else:
+          action = self.coroutine.send(value)
+      except StopIteration:
+        self.finish()
+        return
+      except Exception:
+        self.finish(traceback.format_exc())
+        return
+      value = None
+
+      if isinstance(action, Send):
+        try:
+          self.send(action.msg)
+        except MessageTooBig:
+          self.finish('MessageTooBig')
+
+      elif isinstance(action, (Recv, Expect)):
+        if self.inbox:
+          (value, exc) = deliver(action, self.inbox.popleft())
+        else:
+          self.action = action
+          self.waiting = self.engine.timer(self, action.timeout)
+          return
+
+      elif isinstance(action, Request):
+        value = self.tsxs.request(action.msg, action.timeout)
+        if value.deadline is not None:
+          self.engine.call_at(value.deadline, self, self.tsxs.expire)
+        try:
+          self.send(action.msg)
+        except MessageTooBig:
+          self.finish('MessageTooBig')
+
+      elif isinstance(action, Wait):
+        t = action.transaction
+        if t.done():
+          (value, exc) = outcome(t)
+        else:
+          self.action = action
+          self.waiting = self.engine.timer(self, None)
+          t.add_done_callback(self.completed)
+          return
+
+      elif isinstance(action, Close):
+        self.coroutine.close()
+        self.finish()
+
+  def connected(self):
+    '''completes a non-blocking connect, then starts the coroutine.'''
+    self.connecting = False
+    err = self.f.getsockopt(sk.SOL_SOCKET, sk.SO_ERROR)
+    if err:
+      self.coroutine.close()
+      self.finish('connect: %s' % os.strerror(err))
+      return
+    self.resume()
+
+  def timed_out(self, token):
+    if self.waiting == token:
+      self.resume(exc=sk.timeout('timed out'))
+
+  def completed(self, t):
+    if self.waiting is not None and isinstance(self.action, Wait) and \
+      self.action.transaction is t:
+      self.resume(*outcome(t))
+
+  def send(self, msg):
+    if self.mutator:
+      # mutations are applied in place
+      if not isinstance(msg, dm.Msg):
+        msg = dm.Msg.decode(msg)
+      self.msgs.append((msg, True))
+      self.mutator.send(msg)
+      return
+
+    # pre-encoded messages of templates are sent as is
+    data = msg.encode() if isinstance(msg, dm.Msg) else msg
+    self.msgs.append((msg, True))
+    self.wbuf.append(data)
+
+  def receive(self, data):
+    (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(data)
+    if dm.unpack24(code) == 280 and flags & 0x80:
+      self.wbuf.append(dwa(self.engine.local_host, self.engine.local_realm, h2h_id, e2e_id))
+      return
+
+    self.msgs.append((data, False))
+    if self.validate is not None:
+      self.validate(data)
+
+    t = self.tsxs.match(data)
+    if t is not None:
+      self.tsxs.answer(t, dm.Msg.decode(data))
+      return
+
+    if self.waiting is not None and isinstance(self.action, (Recv, Expect)):
+      self.resume(*deliver(self.action, (None, data)))
+    else:
+      self.inbox.append((None, data))
+
+  def readable(self):
+    try:
+      b = self.f.recv(dm.U24_MAX)
+    except sk.error as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        return
+      self.interrupt(traceback.format_exc())
+      return
+
+    if len(b) == 0:
+      self.interrupt()
+      return
+
+    try:
+      (msgs, self.rbuf) = frames(self.rbuf + b)
+      for data in msgs:
+        if self.finished:
+          break
+        self.receive(data)
+    except Exception:
+      self.interrupt(traceback.format_exc())
+
+  def writable(self):
+    while self.wbuf:
+      data = self.wbuf[0]
+      try:
+        sent = self.f.send(data)
+      except sk.error as e:
+        if e.errno in (errno.EAGAIN, errno.EINTR):
+          return
+        self.wbuf.clear()
+        self.interrupt(traceback.format_exc())
+        return
+      if sent < len(data):
+        self.wbuf[0] = data[sent:]
+        return
+      self.wbuf.popleft()
+
+  def interrupt(self, reason=None):
+    '''the association failed or was closed by the peer: as with
+dwr_handler, the scenario sees its connection closed.'''
+    self.wbuf.clear()
+    if self.finished:
+      return
+    if self.waiting is not None:
+      self.resume(exc=Disconnected())
+    if not self.finished:
+      self.coroutine.close()
+      self.finish()
+    if self.exc_info is None:
+      self.exc_info = reason
+
+  def finish(self, exc_info=None):
+    self.finished = True
+    self.waiting = None
+    if self.exc_info is None:
+      self.exc_info = exc_info
+    self.tsxs.fail_all(Disconnected())
+
+class Engine(object):
+  '''runs many sessions in a single thread, over epoll.'''
+  def __init__(self, local_host, local_realm):
+    self.local_host = local_host
+    self.local_realm = local_realm
+    self.epoll = sl.epoll()
+    self.sessions = {}
+    self.timers = []
+    self.seq = 0
+
+  def add(self, f, coroutine, mutator=None, validate=None, done=None, address=None):
+    '''starts running coroutine over connected socket f, or once f is
+connected to address when given. Once the session is over, f is closed,
+and done is called with the session.'''
+    f.setblocking(0)
+    s = Session(self, f, coroutine, mutator, validate, done)
+    self.sessions[s.fd] = s
+    self.epoll.register(s.fd, sl.EPOLLIN)
+    if address is None:
+      s.resume()
+    else:
+      err = f.connect_ex(address)
+      if err == errno.EINPROGRESS:
+        s.connecting = True
+      elif err:
+        s.coroutine.close()
+        s.finish('connect: %s' % os.strerror(err))
+      else:
+        s.resume()
+    self.update(s)
+    return s
+
+  def call_at(self, deadline, session, func, *args):
+    '''calls func with args at deadline, on behalf of session.'''
+    self.seq += 1
+    heappush(self.timers, (deadline, self.seq, session, func, args))
+
+  def timer(self, session, timeout):
+    '''arms a timer for the current wait of session, returning its token.'''
+    self.seq += 1
+    token = self.seq
+    if timeout is not None:
+      self.call_at(time.time() + timeout, session, session.timed_out, token)
+    return token
+
+  def update(self, s):
+    if self.sessions.get(s.fd) is not s:
+      return
+    if s.finished and not s.wbuf:
+      self.remove(s)
+    elif s.connecting or s.wbuf:
+      self.epoll.modify(s.fd, sl.EPOLLIN | sl.EPOLLOUT)
+    else:
+      self.epoll.modify(s.fd, sl.EPOLLIN)
+
+  def remove(self, s):
+    self.epoll.unregister(s.fd)
+    del self.sessions[s.fd]
+    s.f.close()
+    if s.done is not None:
+      s.done(s)
+
+  def expire(self):
+    now = time.time()
+    while self.timers and self.timers[0][0] <= now:
+      (deadline, seq, s, func, args) = heappop(self.timers)
+      if self.sessions.get(s.fd) is s:
+        func(*args)
+        self.update(s)
+
+  def poll(self, timeout=None):
+    '''processes pending events, waiting for at most timeout seconds.'''
+    if self.timers:
+      delay = max(0, self.timers[0][0] - time.time())
+      if timeout is None or delay < timeout:
+        timeout = delay
+    if timeout is None:
+      timeout = -1
+
+    try:
+      events = self.epoll.poll(timeout)
+    except IOError as e:
+      if e.errno != errno.EINTR:
+        raise
+      events = []
+
+    for (fd, mask) in events:
+      s = self.sessions.get(fd)
+      if s is None:
+        continue
+      if s.connecting:
+        s.connected()
+      elif mask & sl.EPOLLOUT:
+        s.writable()
+      if mask & (sl.EPOLLIN | sl.EPOLLHUP | sl.EPOLLERR):
+        s.readable()
+      self.update(s)
+
+    self.expire()
+
+  def run(self):
+    '''runs until all sessions are over.'''
+    while self.sessions:
+      self.poll()
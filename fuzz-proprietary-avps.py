@@ -16,7 +16,7 @@ import os
 import Diameter as dm
 from Dia import Directory
 
-from scenario import dwr_handler, load_scenario, MsgAnchor
+from scenario import dwr_handler, load_scenario, MsgAnchor, AssociationPool, Disconnected
 from mutate import MutateScenario
 
 from collections import namedtuple, OrderedDict
@@ -40,6 +40,7 @@ def analyze(seq, v, a=0, b=2**24):
                 s.act = lambda this, m, c=c, v=v: this.appendAvp(m, c, v)
             
                 yield (c, s)
+            sent += 1
 
 
 def testScn(host, port, scenario):
@@ -68,6 +69,7 @@ if __name__ == '__main__':
     parser.add_argument('--vendor', type=int, default=0, help="The vendor ID to fuzz (default: 0)")
     parser.add_argument('--local-hostname', type=str, default='mme.openair4G.eur', help="Define the local hostname to use in the scenario (default=mme.openair4G.eur)")
     parser.add_argument('--local-realm', type=str, default='openair4G.eur', help="Define the local realm to use in the scenario (default=openair4G.eur)")
+    parser.add_argument('--reuse', action='store_true', help="Keep the association open across AVP codes while the target answers DWR, skipping the capabilities exchange")
     args = parser.parse_args()
     
     # Check the min/max values
@@ -92,6 +94,19 @@ if __name__ == '__main__':
 
         for (m, is_sent) in msgs:
             Directory.tag(m)
+
+        def connect():
+            f = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
+            f.connect((host, port))
+            return f
+
+        associations = None
+        if args.reuse:
+            # associations are set up with the CER of the scenario, if any
+            (m, is_sent) = msgs[0]
+            cer = m.encode() if is_sent and m.code == 257 and m.R else None
+            associations = AssociationPool(connect, cer, local_hostname, local_realm)
+
         start = time.ctime()
         startT = time.time()
         print("Scan started on %s..." % time.ctime())
@@ -106,11 +121,20 @@ if __name__ == '__main__':
                 print("%s - [INFO] %f%% : AVP %d to %d scanned (over %d) in %d:%d:%d..." % (time.ctime(), percent, i-1000, i, args.max, elapsedT[0], elapsedT[1], elapsedT[2]))
 
             try: 
-                f = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
-                f.connect((host, port))
-                (exc_info, msgs) = dwr_handler(scenario, f, local_hostname, local_realm, mutator=fuzz)
-                f.close()
-            except sk.error as serr:
+                # fuzzing the CER needs an association of its own
+                if associations is None or (fuzz.anchor.code == 257 and fuzz.anchor.is_request):
+                    f = connect()
+                    (exc_info, msgs) = dwr_handler(scenario, f, local_hostname, local_realm, mutator=fuzz, lazy=True)
+                    f.close()
+                else:
+                    association = associations.get()
+                    msgs = None
+                    try:
+                        (exc_info, msgs) = dwr_handler(scenario, association.f, local_hostname, local_realm, mutator=fuzz, lazy=True,
+                            cea=association.cea, stale=association.stale)
+                    finally:
+                        associations.put(association, msgs)
+            except (sk.error, Disconnected) as serr:
                 print >> sys.stderr, '%s - [ERROR] Connexion broken (%s) for AVP %d' % (time.ctime(), serr, i)
                 try:
                     testScn(host, port, scenario)
@@ -9,23 +9,28 @@
 from Pdml import PdmlLoader
 import Diameter as dm
 from Dia import Directory
-from mutate import MsgAnchor, MutateScenario
-from scenario import unpack_frame, pack_frame, dwr_handler, load_scenario
+from mutate import MsgAnchor, MutateScenario, Mutation
+from scenario import unpack_frame, pack_frame, dwr_handler, load_scenario, AssociationPool
+from oracle import Oracle, find_answer, judge
+from conform import AnswerValidator
+from server import serve, PeerStats
 
 
 import getopt
-from threading import Thread
+from threading import Thread, Lock
 import select as sl
 import os
 from struct import pack
 from functools import partial
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 from random import randint
 import argparse
 import sctp
 import socket as sk
 import sys
 import logging
+import traceback
 
 
 def group_by_code(avps):
@@ -89,6 +94,19 @@ def grouped_variants(avps):
     if qa.max:
       yield (a, qa.max+1, '%s present more than max allowed' % (qa.name))
 
+'''value made of count times pattern, built only once the case runs.'''
+Filler = namedtuple('Filler', 'pattern count')
+
+def fill(filler):
+  return filler.pattern * filler.count
+
+'''a fuzz case as planned by analyze, of which the MutateScenario is only
+built by materialise once about to run, so that payloads of a campaign are
+not held at once. kind is one of absent, overpresent, set_value or stack,
+and arg is respectively None, count, a Filler, or the (Avp, depth) to be
+self-stacked.'''
+Case = namedtuple('Case', 'anchor description kind path arg')
+
 def non_grouped_variants(a):
   assert(a.model_avp)
   ma = a.model_avp
@@ -99,47 +117,45 @@ def non_grouped_variants(a):
     mx = max(ma.val_to_desc.keys())
 
     data = pack('!i', mn-1)
-    yield (data, 'Enumerated lower than allowed')
+    yield (Filler(data, 1), 'Enumerated lower than allowed')
 
     data = pack('!i', mx+1)
-    yield (data, 'Enumerated bigger than allowed')
+    yield (Filler(data, 1), 'Enumerated bigger than allowed')
 
-    yield (pack('!i', -1), 'Enumerated -1')
+    yield (Filler(pack('!i', -1), 1), 'Enumerated -1')
   elif ma.datatype == 'Unsigned32':
-    yield (pack('!I', 0xffffffff), 'Unsigned32 maximum value')
+    yield (Filler(pack('!I', 0xffffffff), 1), 'Unsigned32 maximum value')
   elif ma.datatype == 'Unsigned64':
-    yield (pack('!Q', 0xffffffffffffffff), 'Unsigned64 maximum value')
+    yield (Filler(pack('!Q', 0xffffffffffffffff), 1), 'Unsigned64 maximum value')
   elif ma.datatype == 'UTF8String':
-    for bad in ['\x80', '\xbf', '\x80'*128]:
+    for bad in [Filler('\x80', 1), Filler('\xbf', 1), Filler('\x80', 128)]:
       yield (bad, 'UTF8String continuations')
 
     for bad in ['\xc0 ']:
-      yield (bad, 'UTF8String lonely start')
+      yield (Filler(bad, 1), 'UTF8String lonely start')
 
     for bad in ['\xfe', '\xff']:
-      yield (bad, 'UTF8String impossible bytes')
+      yield (Filler(bad, 1), 'UTF8String impossible bytes')
 
     for bad in [ '\xc0\xaf']:
-      yield (bad, 'UTF8String overlong')
+      yield (Filler(bad, 1), 'UTF8String overlong')
 
     for bad in ['\xef\xbf\xbe', '\xef\xbf\xbf']:
-      yield (bad, 'UTF8String non-characters in 16bits')
+      yield (Filler(bad, 1), 'UTF8String non-characters in 16bits')
 
-  yield ('', 'empty value')
+  yield (Filler('', 1), 'empty value')
 
   for length in [3, 128, 4096, 64000]:
-    data = '\xfe' * length
-    yield (data, 'Generic overflow with %d bytes' % length)
+    yield (Filler('\xfe', length), 'Generic overflow with %d bytes' % length)
 
   for fmt in ['%n', '%-1$n', '%4096$n']:
-    data = fmt * 1024
-    yield (data, 'Generic overflow with format specifier %r' % fmt)
+    yield (Filler(fmt, 1024), 'Generic overflow with format specifier %r' % fmt)
 
 
 
 
 def analyze(seq):
-  fuzzs = []
+  '''yields the Case of each fuzz case of sent messages of seq.'''
   sent = 0
 
   for i in range(len(seq)):
@@ -165,13 +181,11 @@ def analyze(seq):
       avps = msg.avps
       paths = group_by_code(avps)
       for (a, count, description) in grouped_variants(avps):
-        s = MutateScenario(anchor, description)
         path = '/' + get_path(a, paths)
         if count == 0:
-          s.act = lambda this, m, path=path: this.absent_variant(m, path)
+          yield Case(anchor, description, 'absent', path, None)
         else:
-          s.act = lambda this, m, path=path, count=count: this.overpresent_variant(m, path, count)
-        fuzzs.append(s)
+          yield Case(anchor, description, 'overpresent', path, count)
 
       # perform field level fuzzing, Grouped as well as non Grouped
       avps = unfold_avps(msg)
@@ -182,31 +196,147 @@ def analyze(seq):
         if ma.datatype == 'Grouped':
           paths = group_by_code(a.avps)
           for (sub_a, count, description) in grouped_variants(a.avps):
-            s = MutateScenario(anchor, description)
             sub_path = get_path(sub_a, paths)
             sub_path = path + '/' + sub_path
             if count == 0:
-              s.act = lambda this, m, sub_path=sub_path: this.absent_variant(m, sub_path)
+              yield Case(anchor, description, 'absent', sub_path, None)
             else:
-              s.act = lambda this, m, sub_path=sub_path, count=count: this.overpresent_variant(m, sub_path, count)
-            fuzzs.append(s)
+              yield Case(anchor, description, 'overpresent', sub_path, count)
           # if ma allows for stacking e.g. CCF ends with *AVP
           # then generate a deep stacked self embedded AVP :)
           if ma.allows_stacking():
+            # each stacking level adds a copy of the AVP
+            (base, step) = (len(a.overflow_stacking(0)), len(a.encode()))
             for depth in (64, 1024, 2048, 4096, 8192):
-              data = a.overflow_stacking(depth)
-              s = MutateScenario(anchor, '%s self-stacked -> %d' % (ma.name, len(data)))
-              s.act = lambda this, m, path=path, data=data: this.set_value(m, path, data)
-              fuzzs.append(s)
+              yield Case(anchor, '%s self-stacked -> %d' % (ma.name, base + depth*step),
+                'stack', path, (a, depth))
         else:
-          for (data, description) in non_grouped_variants(a):
-            s = MutateScenario(anchor, '%s %s' % (ma.name, description))
-            s.act = lambda this, m, path=path, data=data: this.set_value(m, path, data)
-            fuzzs.append(s)
+          for (filler, description) in non_grouped_variants(a):
+            yield Case(anchor, '%s %s' % (ma.name, description), 'set_value', path, filler)
 
       sent += 1
 
-  return fuzzs
+def materialise(case):
+  '''MutateScenario running case, its payload being built.'''
+  s = MutateScenario(case.anchor, case.description)
+  path = case.path
+  if case.kind == 'absent':
+    s.act = lambda this, m: this.absent_variant(m, path)
+    s.mutation = Mutation('absent', path, None)
+  elif case.kind == 'overpresent':
+    count = case.arg
+    s.act = lambda this, m: this.overpresent_variant(m, path, count)
+    s.mutation = Mutation('overpresent', path, count)
+  else:
+    if case.kind == 'stack':
+      (a, depth) = case.arg
+      data = a.overflow_stacking(depth)
+    else:
+      data = fill(case.arg)
+    s.act = lambda this, m: this.set_value(m, path, data)
+    s.mutation = Mutation('set_value', path, data)
+  return s
+
+def preview(cases, listing=False, out=sys.stdout):
+  '''prints the number of cases, preceded by each of them when listing,
+without building their payloads.'''
+  count = 0
+  for case in cases:
+    if listing:
+      print >>out, '%d: sent message %d, %s %s: %s' % (count, case.anchor.index,
+        case.kind, case.path, case.description)
+    count += 1
+  print >>out, '%d cases' % count
+
+'''description and violations of a case once run, kept until the end of the
+campaign instead of the case itself, which holds its payload.'''
+Outcome = namedtuple('Outcome', 'description violations')
+
+def case_validator(validator, fuzz):
+  '''hook for dwr_handler, attaching violations of received messages to fuzz.'''
+  if validator is None:
+    return None
+  return partial(validator.submit, fuzz)
+
+def report_violations(validator, outcomes):
+  if validator is None:
+    return
+
+  validator.close()
+  for o in outcomes:
+    if o.violations:
+      logging.warning('scenario %s received non conformant messages: %r' % (o.description, o.violations))
+
+def build_oracles(seq):
+  '''one oracle per sent message, indexed as MsgAnchor.index.'''
+  return [Oracle(m) for (m, is_sent) in seq if is_sent]
+
+class OracleStats(object):
+  '''counters of cases checked against their oracle.'''
+  def __init__(self):
+    self.lock = Lock()
+    self.judged = 0
+    self.mismatches = 0
+    self.errors = 0
+
+  def record(self, mismatch, error=False):
+    with self.lock:
+      if error:
+        self.errors += 1
+      else:
+        self.judged += 1
+        if mismatch is not None:
+          self.mismatches += 1
+
+  def report(self):
+    with self.lock:
+      logging.warning('oracle: %d cases judged, %d mismatches, %d could not be judged' % (
+        self.judged, self.mismatches, self.errors))
+
+def check_answer(oracles, fuzz, msgs, stats):
+  '''compare the answer of the target with the verdict predicted for fuzz.
+A case which cannot be judged is logged and counted, so that a malformed
+mutant does not end the campaign.'''
+  if fuzz.mutation is None:
+    return
+
+  try:
+    verdict = oracles[fuzz.anchor.index].predict(fuzz.mutation)
+    mismatch = judge(verdict, find_answer(msgs, fuzz.anchor))
+  except Exception:
+    logging.warning('scenario %s could not be judged: %s' % (fuzz.description, traceback.format_exc()))
+    stats.record(None, error=True)
+    return
+
+  stats.record(mismatch)
+  if mismatch is not None:
+    logging.warning('scenario %s: %s' % (fuzz.description, mismatch))
+
+def run_cases(fuzzs, run_case, parallel=1):
+  '''applies run_case to each case, running up to parallel of them at once.
+(case, result) pairs are yielded in case order, whatever the order of
+completion, so that results are reported deterministically.'''
+  if parallel <= 1:
+    for fuzz in fuzzs:
+      yield (fuzz, run_case(fuzz))
+    return
+
+  pool = ThreadPool(parallel)
+  inflight = deque()
+  try:
+    for fuzz in fuzzs:
+      inflight.append((fuzz, pool.apply_async(run_case, (fuzz,))))
+      # only a bounded window of cases is submitted ahead
+      if len(inflight) >= 2 * parallel:
+        (fuzz, ar) = inflight.popleft()
+        yield (fuzz, ar.get())
+
+    while inflight:
+      (fuzz, ar) = inflight.popleft()
+      yield (fuzz, ar.get())
+  finally:
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
@@ -222,6 +352,27 @@ if __name__ == '__main__':
   parser.add_argument('--local-realm',
     help='Local Diameter realm, used in DWA as Origin-Realm, and may be used as local_realm',
     default='invalid')
+  parser.add_argument('--oracle',
+    help='Compare answers of the target with Result-Code predicted for each mutation',
+    action='store_true')
+  parser.add_argument('--validate',
+    help='Conformance-check every received message using this many background workers',
+    type=int, default=0)
+  parser.add_argument('--parallel',
+    help='Run up to this many cases at once, each over its own association',
+    type=int, default=1)
+  parser.add_argument('--socketpair',
+    help='Exchange messages with the scenario over a framed socketpair, instead of an in-process channel',
+    action='store_true')
+  parser.add_argument('--count',
+    help='Print the number of cases of the campaign after the vanilla run, and exit',
+    action='store_true')
+  parser.add_argument('--list',
+    help='Print each case of the campaign after the vanilla run, and exit',
+    action='store_true')
+  parser.add_argument('--reuse',
+    help='In client mode, run cases over associations kept open while the target answers DWR, skipping the capabilities exchange',
+    action='store_true')
   parser.add_argument('mode', help='Role: client, clientloop or server. When using client or clientloop, an additional positional argument describing the target IP and port, colon separated, must be used. When using server, local address and port must be given using options',
     choices=('client', 'server'))
   parser.add_argument('scenario', help='Python scenario to run')
@@ -244,6 +395,10 @@ if __name__ == '__main__':
     (host, port) = target.split(':')
     port = int(port)
 
+    if args.parallel > 1 and args.local_port and not args.local_addresses:
+      print >>sys.stderr, 'parallel associations cannot share a local port'
+      sys.exit(1)
+
 
   # load scenario
   scenario = load_scenario(args.scenario, args.local_hostname, args.local_realm)
@@ -252,29 +407,7 @@ if __name__ == '__main__':
   logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
 
   if args.mode == 'client':
-    # run once in order to capture exchanged pdus
-    f = sk.socket(sk.AF_INET, sk.SOCK_STREAM, sk.IPPROTO_SCTP)
-    if args.local_addresses:
-      addrs = [(a, 0) for a in args.local_addresses]
-      ret = sctp.bindx(f, addrs)
-      assert(ret == 0)
-    else:
-      f.bind(('0.0.0.0', args.local_port))
-    f.connect((host, port))
-
-    (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm)
-    if exc_info is not None:
-      logging.warning('vanilla scenario raised: %s' % (exc_info))
-      sys.exit(1)
-    f.close()
-
-    for (m, is_sent) in msgs:
-      Directory.tag(m)
-
-    fuzzs = analyze(msgs)
-    logging.info('generated %d scenarios of fuzzing' % len(fuzzs))
-
-    for fuzz in fuzzs:
+    def connect():
       f = sk.socket(sk.AF_INET, sk.SOCK_STREAM, sk.IPPROTO_SCTP)
       if args.local_addresses:
         addrs = [(a, 0) for a in args.local_addresses]
@@ -283,11 +416,81 @@ if __name__ == '__main__':
       else:
         f.bind(('0.0.0.0', args.local_port))
       f.connect((host, port))
+      return f
+
+    # run once in order to capture exchanged pdus
+    f = connect()
+    (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm,
+        channel=not args.socketpair)
+    if exc_info is not None:
+      logging.warning('vanilla scenario raised: %s' % (exc_info))
+      sys.exit(1)
+    f.close()
 
-      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm, fuzz)
+    for (m, is_sent) in msgs:
+      Directory.tag(m)
+
+    if args.count or args.list:
+      preview(analyze(msgs), args.list)
+      sys.exit(0)
+
+    # payloads are built as cases are about to run
+    fuzzs = (materialise(case) for case in analyze(msgs))
+    outcomes = []
+
+    if args.oracle:
+      oracles = build_oracles(msgs)
+      oracle_stats = OracleStats()
+
+    validator = None
+    if args.validate:
+      validator = AnswerValidator(args.validate)
+
+    associations = None
+    if args.reuse:
+      # associations are set up with the CER of the vanilla run, if any
+      cer = None
+      (m, is_sent) = msgs[0]
+      if is_sent and m.code == 257 and m.R:
+        cer = m.encode()
+      associations = AssociationPool(connect, cer, args.local_hostname, args.local_realm)
+      associations.prewarm(args.parallel)
+
+    def run_case(fuzz):
+      # cases mutating the CER need an association of their own
+      if associations is None or (fuzz.anchor.code == 257 and fuzz.anchor.is_request):
+        f = connect()
+        try:
+          return dwr_handler(scenario, f, args.local_hostname, args.local_realm, fuzz,
+            case_validator(validator, fuzz), channel=not args.socketpair, lazy=True)
+        finally:
+          f.close()
+
+      association = associations.get()
+      msgs = None
+      try:
+        (exc_info, msgs) = dwr_handler(scenario, association.f, args.local_hostname, args.local_realm, fuzz,
+          case_validator(validator, fuzz), channel=not args.socketpair, lazy=True,
+          cea=association.cea, stale=association.stale)
+        return (exc_info, msgs)
+      finally:
+        associations.put(association, msgs)
+
+    for (fuzz, (exc_info, msgs)) in run_cases(fuzzs, run_case, args.parallel):
       if exc_info is not None:
         logging.warning('scenario %s raised: %s' % (fuzz.description, exc_info))
-      f.close()
+      if args.oracle:
+        check_answer(oracles, fuzz, msgs, oracle_stats)
+      outcomes.append(Outcome(fuzz.description, fuzz.violations))
+
+    if associations is not None:
+      associations.close()
+      logging.info('%d associations set up, %d reused' % (associations.created, associations.reused))
+
+    if args.oracle:
+      oracle_stats.report()
+
+    report_violations(validator, outcomes)
 
   elif args.mode == 'server':
     srv = sk.socket(sk.AF_INET, sk.SOCK_STREAM, sk.IPPROTO_SCTP)
@@ -300,7 +503,8 @@ if __name__ == '__main__':
     srv.listen(64)
 
     (f,_) = srv.accept()
-    (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm)
+    (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm,
+        channel=not args.socketpair)
     if exc_info is not None:
       logging.warning('vanilla scenario raised: %s' % (exc_info))
       sys.exit(1)
@@ -309,12 +513,36 @@ if __name__ == '__main__':
     for (m, is_sent) in msgs:
       Directory.tag(m)
 
-    fuzzs = analyze(msgs)
-    logging.info('generated %d scenarios of fuzzing' % len(fuzzs))
+    if args.count or args.list:
+      preview(analyze(msgs), args.list)
+      sys.exit(0)
 
-    for fuzz in fuzzs:
-      (f,_) = srv.accept()
-      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm, fuzz)
+    # payloads are built as cases are about to run
+    fuzzs = (materialise(case) for case in analyze(msgs))
+    outcomes = []
+
+    if args.oracle:
+      oracles = build_oracles(msgs)
+      oracle_stats = OracleStats()
+
+    validator = None
+    if args.validate:
+      validator = AnswerValidator(args.validate)
+
+    def handle(f, fuzz):
+      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm, fuzz,
+        case_validator(validator, fuzz), channel=not args.socketpair, lazy=True)
       if exc_info is not None:
         logging.warning('scenario %s raised: %s' % (fuzz.description, exc_info))
-      f.close()
+      if args.oracle:
+        check_answer(oracles, fuzz, msgs, oracle_stats)
+      outcomes.append(Outcome(fuzz.description, fuzz.violations))
+      return (exc_info, msgs)
+
+    stats = PeerStats()
+    serve(srv, fuzzs, handle, args.parallel, stats)
+    stats.report()
+    if args.oracle:
+      oracle_stats.report()
+
+    report_violations(validator, outcomes)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import sys
+import time
+import socket as sk
+from math import ceil, sqrt
+
+from engine import Engine
+
+def percentile(values, p):
+  '''nearest-rank percentile of sorted values.'''
+  if not values:
+    return None
+  return values[max(0, int(ceil(p / 100.0 * len(values))) - 1)]
+
+def arrival_time(n, rate, ramp_up=0):
+  '''offset of the n-th scenario start, the rate growing linearly from 0 to
+rate over ramp_up seconds.'''
+  if ramp_up and n < rate * ramp_up / 2.0:
+    return sqrt(2.0 * ramp_up * n / rate)
+  return n / float(rate) + ramp_up / 2.0
+
+def parse_range(s):
+  '''(first, count) of a FIRST-LAST range of decimal values.'''
+  (first, last) = s.split('-')
+  assert(len(first) == len(last) and int(first) <= int(last))
+  return (first, int(last) - int(first) + 1)
+
+class Substitutions(object):
+  '''args given to the n-th scenario instance: a unique Session-Id, and when
+imsis is a (first, count) range, an IMSI cycling over it.'''
+  def __init__(self, local_hostname, imsis=None):
+    self.prefix = '%s;%d' % (local_hostname, int(time.time()))
+    self.imsis = imsis
+
+  def args(self, n):
+    args = {'session_id': '%s;%d' % (self.prefix, n)}
+    if self.imsis is not None:
+      (first, count) = self.imsis
+      args['imsi'] = str(int(first) + n % count).zfill(len(first))
+    return args
+
+class LoadStats(object):
+  '''outcome of scenario instances, for the whole run and since last report.
+Latency is the duration of a scenario instance, connection included.'''
+  def __init__(self):
+    self.started = 0
+    self.skipped = 0
+    self.completed = 0
+    self.failed = 0
+    self.errors = {}
+    self.latencies = []
+    self.recent = []
+
+  def done(self, started, exc_info):
+    if exc_info:
+      self.failed += 1
+      reason = exc_info.strip().split('\n')[-1]
+      self.errors[reason] = self.errors.get(reason, 0) + 1
+    else:
+      self.completed += 1
+      latency = time.time() - started
+      self.latencies.append(latency)
+      self.recent.append(latency)
+
+  def line(self, elapsed, latencies, throughput):
+    r = '%7.1fs started %d completed %d failed %d skipped %d %.1f/s' % (elapsed,
+      self.started, self.completed, self.failed, self.skipped, throughput)
+    latencies = sorted(latencies)
+    for p in (50, 90, 99):
+      v = percentile(latencies, p)
+      if v is not None:
+        r += ' p%d %.1fms' % (p, v * 1000)
+    return r
+
+  def report(self, elapsed, interval, active, out=sys.stdout):
+    '''prints throughput and latencies of the last interval.'''
+    print >>out, self.line(elapsed, self.recent, len(self.recent) / interval) + \
+      ' active %d' % active
+    out.flush()
+    self.recent = []
+
+  def summary(self, elapsed, out=sys.stdout):
+    print >>out, 'total ' + self.line(elapsed, self.latencies, self.completed / elapsed)
+    for (reason, count) in sorted(self.errors.items(), key=lambda x: -x[1]):
+      print >>out, '  %d x %s' % (count, reason)
+
+def run_load(scenario, new_socket, address, local_hostname, local_realm,
+  associations, rate, duration, ramp_up=0, imsis=None, interval=1.0, out=sys.stdout):
+  '''starts instances of scenario at rate per second for duration seconds,
+each over its own association, in open loop: instances are not delayed
+by slower ones, but skipped when associations are already running.
+new_socket returns an unconnected socket, which the engine connects to
+address. Returns the LoadStats.'''
+  e = Engine(local_hostname, local_realm)
+  subs = Substitutions(local_hostname, imsis)
+  stats = LoadStats()
+
+  start = time.time()
+  last_report = start
+  n = 0
+
+  while True:
+    now = time.time()
+
+    while True:
+      offset = arrival_time(n, rate, ramp_up)
+      if offset >= duration or start + offset > now:
+        break
+      n += 1
+      if len(e.sessions) >= associations:
+        stats.skipped += 1
+        continue
+
+      # latency is measured from the scheduled start
+      stats.started += 1
+      try:
+        f = new_socket()
+      except sk.error as err:
+        stats.done(start + offset, 'socket: %s' % err)
+        continue
+      e.add(f, scenario.coroutine(subs.args(n - 1)), address=address,
+        done=lambda s, t=start + offset: stats.done(t, s.exc_info))
+
+    if now - last_report >= interval:
+      stats.report(now - start, now - last_report, len(e.sessions), out)
+      last_report = now
+
+    if now - start >= duration and not e.sessions:
+      break
+
+    timeout = last_report + interval - now
+    if offset < duration:
+      timeout = min(timeout, start + offset - now)
+    e.poll(max(0, timeout))
+
+  stats.summary(time.time() - start, out)
+  return stats
@@ -13,6 +13,11 @@ from collections import namedtuple
 
 MsgAnchor = namedtuple('MsgAnchor', 'index code is_request')
 
+'''describes what act does to the anchored message, for those who need to
+reason about a mutation without running it: kind is one of absent,
+overpresent or set_value, and arg is respectively None, count or value.'''
+Mutation = namedtuple('Mutation', 'kind path arg')
+
 class MessageTooBig(Exception): pass
 
 class MutateScenario:
@@ -25,6 +30,8 @@ class MutateScenario:
     self.f = None
 
     self.act = None
+    self.mutation = None
+    self.violations = []
 
   def bind(self, f, is_tcp=False):
     assert(self.f is None)
@@ -47,6 +54,13 @@ class MutateScenario:
     else:
       self.xmit(msg)
 
+  def skip(self, msg):
+    '''to be called on locally generated messages which are not transmitted,
+such as a CER answered on behalf of an already set up association.'''
+    assert(isinstance(msg, dm.Msg))
+    assert(len(self.processed_msgs) != self.anchor.index)
+    self.processed_msgs.append((msg.code, msg.R))
+
   def xmit(self, msg):
     '''perform transmit of msg, without alteration.'''
     assert(self.f is not None)
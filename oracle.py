@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from Dia import Directory
+from conform import conform_avps, conform_avp, describe, QualifierViolation, \
+  ExpectedLengthViolation, UnknownEnumeratedViolation, UTF8Violation
+from mutate import Mutation
+
+from collections import namedtuple
+from struct import unpack
+
+DIAMETER_SUCCESS = 2001
+DIAMETER_INVALID_AVP_VALUE = 5004
+DIAMETER_MISSING_AVP = 5005
+DIAMETER_AVP_OCCURS_TOO_MANY_TIMES = 5009
+DIAMETER_INVALID_AVP_LENGTH = 5014
+
+'''reported when a Grouped AVP value does not decode as a list of AVPs.'''
+InvalidGroupedViolation = namedtuple('InvalidGroupedViolation', 'name avp')
+
+'''expected outcome of a mutant: the violations it introduces, and the
+Result-Code values a conformant target may answer with.
+Both are None when the mutant cannot be predicted.'''
+Verdict = namedtuple('Verdict', 'violations result_codes')
+
+def result_codes(v):
+  '''Result-Code values expected for a given violation, as per rfc6733.'''
+  if isinstance(v, QualifierViolation):
+    qa = v.qualified_avp
+    cnt = len(v.avps)
+    if (qa.max and cnt > qa.max) or (not qa.multiple and cnt > 1):
+      return (DIAMETER_AVP_OCCURS_TOO_MANY_TIMES,)
+    return (DIAMETER_MISSING_AVP,)
+  elif isinstance(v, ExpectedLengthViolation):
+    return (DIAMETER_INVALID_AVP_LENGTH,)
+  elif isinstance(v, InvalidGroupedViolation):
+    return (DIAMETER_INVALID_AVP_VALUE, DIAMETER_INVALID_AVP_LENGTH)
+  elif isinstance(v, (UnknownEnumeratedViolation, UTF8Violation)):
+    return (DIAMETER_INVALID_AVP_VALUE,)
+  assert(False)
+
+def make_verdict(violations):
+  if not violations:
+    return Verdict([], (DIAMETER_SUCCESS,))
+  return Verdict(violations, result_codes(violations[0]))
+
+class Oracle:
+  '''predicts the verdict of mutants derived from a tagged baseline message.
+Conformance of each AVP container of the baseline is cached on first use,
+so that a mutant is judged by re-checking only its mutated path.
+Mutants of a baseline which is itself not conformant are not predicted,
+as a target may reject them for violations they do not introduce.'''
+  def __init__(self, msg):
+    assert(hasattr(msg, 'model'))
+    self.msg = msg
+    self.baseline = conform_avps(msg.avps, msg.model.avps)
+    self.containers = {}
+
+  def container(self, path):
+    '''returns wire AVPs and per qualified AVP counts of the container
+holding path.'''
+    parent = path.rsplit('/', 1)[0]
+
+    if parent not in self.containers:
+      if parent == '':
+        avps = self.msg.avps
+      else:
+        avps = self.msg.eval_path(parent).avps
+
+      counts = {}
+      for a in avps:
+        if a.qualified_avp is not None:
+          counts[id(a.qualified_avp)] = counts.get(id(a.qualified_avp), 0) + 1
+
+      self.containers[parent] = (avps, counts)
+
+    return self.containers[parent]
+
+  def recount(self, path, count):
+    '''verdict of the container of path, once AVPs sharing code and vendor of
+the AVP at path are present count times.'''
+    a = self.msg.eval_path(path)
+    qa = a.qualified_avp
+    if qa is None:
+      return make_verdict([])
+
+    (avps, counts) = self.container(path)
+    matching = set(id(x) for x in avps if x.code == a.code and x.vendor == a.vendor)
+
+    cnt = counts[id(qa)] - len(matching) + count
+    if qa.accept(cnt):
+      return make_verdict([])
+
+    present = [x for x in avps if x.qualified_avp is qa and id(x) not in matching]
+    present.extend([a] * count)
+    return make_verdict([QualifierViolation(qa, present)])
+
+  def revalue(self, path, value):
+    '''verdict of the AVP at path, once its value is replaced.'''
+    a = self.msg.eval_path(path)
+
+    mutated = dm.Avp(code=a.code, V=a.V, M=a.M, P=a.P, vendor=a.vendor, data=value)
+    mutated.qualified_avp = a.qualified_avp
+    mutated.model_avp = a.model_avp
+
+    ma = a.model_avp
+    if ma is not None and ma.datatype == 'Grouped':
+      data = value
+      try:
+        while len(data) > 0:
+          sub_a = dm.Avp.decode(data)
+          mutated.avps.append(sub_a)
+          data = data[sub_a.padded_length:]
+      except Exception:
+        return make_verdict([InvalidGroupedViolation(ma.name, mutated)])
+      Directory.tag_avps(mutated.avps, ma.grouped)
+
+    return make_verdict(conform_avp(mutated))
+
+  def predict(self, mutation):
+    assert(isinstance(mutation, Mutation))
+
+    if self.baseline:
+      return Verdict(None, None)
+
+    try:
+      if mutation.kind == 'absent':
+        return self.recount(mutation.path, 0)
+      elif mutation.kind == 'overpresent':
+        return self.recount(mutation.path, mutation.arg)
+      elif mutation.kind == 'set_value':
+        return self.revalue(mutation.path, mutation.arg)
+    except RuntimeError:
+      # deeply stacked values exhaust recursion
+      pass
+
+    return Verdict(None, None)
+
+def answer_result_code(m):
+  '''Result-Code, or Experimental-Result-Code, carried by an answer.'''
+  for a in m.avps:
+    if a.code == 268 and a.data is not None and len(a.data) == 4:
+      return unpack('!L', a.data)[0]
+    if a.code == 297:
+      for sub_a in a.avps:
+        if sub_a.code == 298 and sub_a.data is not None and len(sub_a.data) == 4:
+          return unpack('!L', sub_a.data)[0]
+  return None
+
+def find_answer(msgs, anchor):
+  '''find the answer received for the anchored sent message.'''
+  sent = [m for (m, is_sent) in msgs if is_sent]
+  if anchor.index >= len(sent):
+    return None
+  req = sent[anchor.index]
+
+  for (m, is_sent) in msgs:
+    if not is_sent and not m.R and m.code == req.code and \
+      (m.e2e_id, m.h2h_id) == (req.e2e_id, req.h2h_id):
+      return m
+  return None
+
+def judge(verdict, answer):
+  '''compare a verdict with the answer of the target.
+Returns None when they agree, or a description of the disagreement, where
+violations are flattened by describe, as mutated AVPs may not even repr.'''
+  if verdict.result_codes is None:
+    return None
+
+  if answer is None:
+    return 'no answer, expected %r' % (verdict.result_codes,)
+
+  rc = answer_result_code(answer)
+  if rc is None:
+    return 'answer without Result-Code, expected %r' % (verdict.result_codes,)
+
+  if verdict.result_codes == (DIAMETER_SUCCESS,):
+    if rc / 1000 == 2:
+      return None
+  elif rc in verdict.result_codes:
+    return None
+
+  return 'answered %d, expected %r because of %r' % (rc, verdict.result_codes,
+    [describe(v) for v in verdict.violations])
@@ -7,12 +7,20 @@
 # license which can be found in the file 'LICENSE' in this package distribution.
 
 import sys
+import argparse
+import json
+import traceback
+from multiprocessing import Pool
+from collections import Counter, deque
+from functools import partial
+from cPickle import load
 
-from Pdml import PdmlLoader
+from pducache import CachedLoader
 import Diameter as dm
 from Dia import Directory
 
 import conform
+import shard
 
 def cprint(what, color):
   COLORS = {
@@ -30,11 +38,198 @@ def cprint(what, color):
   sys.stdout.write(COLORS[color] + what + ENDC)
   sys.stdout.flush()
 
+def load_directory():
+  '''pool initializer: load the Directory once per worker.'''
+  if Directory.DEFAULT is None:
+    with open('.dia-cache', 'rb') as f:
+      Directory.DEFAULT = load(f)
+
+def loader(pcap, native):
+  return CachedLoader(pcap, native=native, streaming=True)
+
+def conform_pdus(pcap, pdus):
+  '''conform (frame number, content) pairs.
+Returns the number of processed PDUs and the list of violation records.'''
+
+  records = []
+
+  for (frm_number, content) in pdus:
+    for r in conform.check_msg(content):
+      r['pcap'] = pcap
+      r['frame'] = frm_number
+      records.append(r)
+
+  return (len(pdus), records)
+
+def failure(pcap):
+  '''result of a pcap which could not be processed, reported as a record
+holding the reason instead of violations.'''
+  reason = traceback.format_exc().strip().split('\n')[-1]
+  return (0, [{'pcap': pcap, 'error': reason}])
+
+def conform_task(task):
+  '''a task is either a whole pcap, or a chunk of PDUs already extracted from it.'''
+  (pcap, native, pdus) = task
+
+  # PcapLoader exits on an unknown magic
+  try:
+    if pdus is None:
+      c = loader(pcap, native)
+      pdus = [(pdu.pdml.frm_number, pdu.content) for pdu in c.iter_pdus()]
+
+    return conform_pdus(pcap, pdus)
+  except (Exception, SystemExit):
+    return failure(pcap)
+
+def extract_task(task):
+  '''PDUs of a pcap, as (frame number, content) pairs, or None and the
+result reporting why they could not be extracted.'''
+  (pcap, native) = task
+  try:
+    c = loader(pcap, native)
+    return ([(pdu.pdml.frm_number, pdu.content) for pdu in c.iter_pdus()], None)
+  except (Exception, SystemExit):
+    return (None, failure(pcap))
+
+def conform_flow(pcap, task):
+  '''conform PDUs of a flow, one (1, records) result per PDU.'''
+  results = []
+  for (seq, pdu) in task[1]:
+    results.append((seq, conform_pdus(pcap, [(pdu.pdml.frm_number, pdu.content)])))
+  return results
+
+def flow_results(pcaps, native, pool, chunk):
+  for pcap in pcaps:
+    try:
+      c = loader(pcap, native)
+      for r in shard.map_flows(c.iter_pdus(), partial(conform_flow, pcap), pool, chunk):
+        yield r
+    except (Exception, SystemExit):
+      yield failure(pcap)
+
+def chunk_results(pcaps, chunk, native, pool, ahead):
+  '''extracts up to ahead pcaps at once in workers, and hands chunks of
+each of them to workers once it is extracted.'''
+  pcaps = iter(pcaps)
+  extracting = deque()
+
+  def extract_next():
+    pcap = next(pcaps, None)
+    if pcap is not None:
+      extracting.append((pcap, pool.apply_async(extract_task, ((pcap, native),))))
+
+  for i in range(ahead):
+    extract_next()
+
+  while extracting:
+    (pcap, ar) = extracting.popleft()
+    (pdus, failed) = ar.get()
+    extract_next()
+    if failed is not None:
+      yield failed
+      continue
+
+    chunks = []
+    for i in range(0, len(pdus), chunk):
+      chunks.append(pool.apply_async(conform_task, ((pcap, native, pdus[i:i+chunk]),)))
+    del pdus
+    for ar in chunks:
+      yield ar.get()
+
+def run_batch(args):
+  if args.jobs > 1:
+    pool = Pool(args.jobs, initializer=load_directory)
+  else:
+    pool = None
+    load_directory()
+
+  tasks = [(pcap, args.native, None) for pcap in args.pcaps]
+  if args.by_flow:
+    results = flow_results(args.pcaps, args.native, pool, args.chunk)
+  elif pool is not None and args.chunk:
+    results = chunk_results(args.pcaps, args.chunk, args.native, pool, args.jobs)
+  elif pool is not None:
+    results = pool.imap(conform_task, tasks)
+  else:
+    # chunks would be processed in turn anyway
+    results = (conform_task(t) for t in tasks)
+
+  # results must go somewhere: violations default to stdout
+  output = None
+  if args.output == '-' or (not args.output and not args.report):
+    output = sys.stdout
+  elif args.output:
+    output = open(args.output, 'wb')
+
+  histograms = {
+    'application': Counter(),
+    'command': Counter(),
+    'avp': Counter(),
+    'violation': Counter(),
+  }
+  count = 0
+  total = 0
+  errors = 0
+
+  for (processed, records) in results:
+    count += processed
+
+    for r in records:
+      if output:
+        output.write(json.dumps(r) + '\n')
+      if 'error' in r:
+        errors += 1
+        continue
+      total += 1
+      for k in histograms:
+        if k in r:
+          histograms[k][r[k]] += 1
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  if output and output is not sys.stdout:
+    output.close()
+
+  report = {'pcaps': len(args.pcaps), 'pdus': count, 'violations': total, 'errors': errors}
+  for k in histograms:
+    report['by_%s' % k] = dict(histograms[k])
+
+  if args.report == '-':
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+  elif args.report:
+    with open(args.report, 'wb') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+
 if __name__ == '__main__':
-  for pcap in sys.argv[1:]:
-    c = PdmlLoader(pcap)
+  parser = argparse.ArgumentParser(
+    description='Check conformance of Diameter PDUs contained in pcap files.')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='Number of worker processes used in batch mode (default: 1)')
+  parser.add_argument('--chunk', type=int, default=0,
+    help='Split each pcap in chunks of this many PDUs, instead of handing whole pcaps to workers')
+  parser.add_argument('--output',
+    help='Write violations as JSON lines to this file, - for stdout, which is the default in batch mode unless --report is given. Enables batch mode')
+  parser.add_argument('--report',
+    help='Write aggregate histograms as JSON to this file, - for stdout. Enables batch mode')
+  parser.add_argument('--by-flow', action='store_true',
+    help='Hand each flow of a pcap to a worker, or chunks of a flow if --chunk is given. Enables batch mode')
+  parser.add_argument('-n', '--native', action='store_true',
+    help='Extract Diameter PDUs natively, instead of using tshark')
+  parser.add_argument('pcaps', nargs='+', help='pcap files to check')
+
+  args = parser.parse_args(sys.argv[1:])
+
+  if args.jobs > 1 or args.chunk or args.by_flow or args.output or args.report:
+    run_batch(args)
+    sys.exit(0)
+
+  for pcap in args.pcaps:
+    c = loader(pcap, args.native)
 
-    for pdu in c.pdus:
+    for pdu in c.iter_pdus():
       m = dm.Msg.decode(pdu.content, tag=True)
 
       violations = conform.conform_avps(m.avps, m.model.avps)
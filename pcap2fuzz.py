@@ -7,9 +7,10 @@
 # license which can be found in the file 'LICENSE' in this package distribution.
 
 import sys
+from getopt import getopt
 
 import Diameter as dm
-from Pdml import PdmlLoader
+from pducache import CachedLoader
 
 from Dia import Directory
 
@@ -22,8 +23,15 @@ import pcapng
 if __name__ == '__main__':
   random.seed(0)
 
-  if len(sys.argv) != 2:
-    print >>sys.stderr, 'usage: %s <.pcap>' % sys.argv[0]
+  native = False
+
+  opts, args = getopt(sys.argv[1:], 'n', ['native'])
+  for o, a in opts:
+    if o in ('-n', '--native'):
+      native = True
+
+  if len(args) != 1:
+    print >>sys.stderr, 'usage: %s [--native] <.pcap>' % sys.argv[0]
     sys.exit(1)
 
   f = sys.stdout
@@ -31,9 +39,9 @@ if __name__ == '__main__':
   pcapng.write_shblock(f)
   pcapng.write_idblock(f)
 
-  pcap = sys.argv[1]
-  c = PdmlLoader(pcap)
-  for pdu in c.pdus:
+  pcap = args[0]
+  c = CachedLoader(pcap, native=native, streaming=True)
+  for pdu in c.iter_pdus():
     m = dm.Msg.decode(pdu.content)
     Directory.tag(m)
 
@@ -7,19 +7,60 @@
 # license which can be found in the file 'LICENSE' in this package distribution.
 
 import sys
+from getopt import getopt
+from multiprocessing import Pool
+from cPickle import load
 
-from Pdml import PdmlLoader
+from pducache import CachedLoader
 from Diameter import Msg
+from Dia import Directory
 from cStringIO import StringIO
 
-if __name__ == '__main__':
-  pcap = sys.argv[1]
+import shard
 
-  c = PdmlLoader(pcap)
+def load_directory():
+  '''pool initializer: load the Directory once per worker.'''
+  if Directory.DEFAULT is None:
+    with open('.dia-cache', 'rb') as f:
+      Directory.DEFAULT = load(f)
 
-  for pdu in c.pdus:
-    m = Msg.decode(pdu.content, tag=True)
+def dump(pdu):
+  m = Msg.decode(pdu.content, tag=True)
 
-    print('''# frame %d
+  return '''# frame %d
 %r
-''' % (pdu.pdml.frm_number, m))
+''' % (pdu.pdml.frm_number, m)
+
+def dump_flow(task):
+  '''dumps PDUs of a flow, one (ordinal, text) result per PDU.'''
+  return [(seq, dump(pdu)) for (seq, pdu) in task[1]]
+
+if __name__ == '__main__':
+  native = False
+  jobs = 1
+
+  opts, args = getopt(sys.argv[1:], 'nj:', ['native', 'jobs='])
+  for o, a in opts:
+    if o in ('-n', '--native'):
+      native = True
+    elif o in ('-j', '--jobs'):
+      jobs = int(a)
+
+  if len(args) != 1:
+    print >>sys.stderr, 'usage: %s [--native] [--jobs=<workers>] <.pcap>' % sys.argv[0]
+    sys.exit(1)
+
+  pcap = args[0]
+
+  c = CachedLoader(pcap, native=native, streaming=True)
+
+  if jobs > 1:
+    pool = Pool(jobs, initializer=load_directory)
+    pdus = (shard.strip(pdu) for pdu in c.iter_pdus())
+    for text in shard.map_flows(pdus, dump_flow, pool):
+      print(text)
+    pool.close()
+    pool.join()
+  else:
+    for pdu in c.iter_pdus():
+      print(dump(pdu))
@@ -8,9 +8,12 @@
 
 import sys
 from getopt import getopt
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+from cStringIO import StringIO
 
-from Pdml import PdmlLoader
+from pducache import CachedLoader
+from shard import canonical_flow, flow_key, strip
 import Diameter as dm
 
 from Dia import *
@@ -76,66 +79,83 @@ def explode(m):
 
   m.values = values
 
-def lookup(msgs, val):
-  for m in msgs:
-    for k in m.values:
-      if m.values[k] == val:
-        return (m, k)
+class MsgIndex(object):
+  '''maps keys to the messages holding them, oldest message first.
+When window is set, only keys of the window last added messages are kept.'''
+  def __init__(self, window=None):
+    self.window = window
+    self.entries = {}
+    self.recent = deque()
+
+  def add(self, m, pairs):
+    '''indexes m under each key of (key, location) pairs. Only the first
+location of a key is kept for a given message.'''
+    keys = set()
+    for (key, loc) in pairs:
+      if key in keys:
+        continue
+      keys.add(key)
+      if key not in self.entries:
+        self.entries[key] = deque()
+      self.entries[key].append((m, loc))
+
+    if self.window is None:
+      return
+
+    self.recent.append(keys)
+    if len(self.recent) > self.window:
+      for key in self.recent.popleft():
+        occurrences = self.entries[key]
+        occurrences.popleft()
+        if len(occurrences) == 0:
+          del self.entries[key]
+
+  def lookup(self, key):
+    '''oldest (message, location) indexed under key, or None.'''
+    occurrences = self.entries.get(key)
+    if occurrences:
+      return occurrences[0]
+    return None
 
 def usage(arg0):
-  print('''usage: %s [--client=<generated client scenario>] [--server=<generated server scenario] <pcap file>''' % arg0)
+  print('''usage: %s [--client=<generated client scenario>] [--server=<generated server scenario] [--window=<messages>] [--coroutine] [--jobs=<workers>] [--native] <pcap file>''' % arg0)
   sys.exit(1)
 
+def flow_name(name, flow):
+  '''inserts flow tuple in name, before its extension.'''
+  (root, ext) = os.path.splitext(name)
+  return '%s-%d-%s-%d-%s-%d%s' % ((root,) + flow + (ext,))
+
+def generate(pdus, flow, client_name, server_name, window=None, coroutine=False):
+  '''generates client and server scenarios for pdus of a flow.
+When window is set, reused values and requests are only looked up in the
+window last messages. When coroutine is set, scenarios are generators
+yielding actions built by a Peer.'''
+  if coroutine:
+    (header, footer) = ('def run(peer, args={}):\n', '\n  yield peer.close()\n')
+  else:
+    (header, footer) = ('def run(f, args={}):\n', '\n  f.close()\n')
 
-
-if __name__ == '__main__':
   client_dump = None
   client_empty = True
 
   server_dump = None
   server_empty = True
 
-  try:
-    opts, args = getopt(sys.argv[1:], 'c:s:h', ['client=', 'server=', 'help'])
-    for o, a in opts:
-      if o in ('-c', '--client'):
-        client_dump = open(a, 'wb')
-        client_dump.write('def run(f, args={}):\n')
-      elif o in ('-s', '--server'):
-        server_dump = open(a, 'wb')
-        server_dump.write('def run(f, args={}):\n')
-      elif o in ('-h', '--help'):
-        usage(sys.argv[0])
-  except:
-    sys.exit(2)
-
-  if len(args) != 1:
-    usage(sys.argv[0])
-
-  if client_dump is None and server_dump is None:
-    print >>sys.stderr, "As per your options, no scenario will be generated"
-
-
-  pcap = args[0]
-
-  c = PdmlLoader(pcap)
-
-  if len(c.flows) == 0:
-    print >>sys.stderr, 'Could not find a flow in capture %s' % pcap
-    sys.exit(1)
-  elif len(c.flows) > 1:
-    print >>sys.stderr, 'Multiple flows in capture %s' % pcap
-    for flow in c.flows:
-      print >>sys.stderr, flow
-    sys.exit(1)
-
-  flow = c.flows.pop()
-  print('detected a flow %s:%d -> %s:%d' % flow[1:])
+  if client_name:
+    client_dump = open(client_name, 'wb')
+    client_dump.write(header)
+  if server_name:
+    server_dump = open(server_name, 'wb')
+    server_dump.write(header)
 
   msgs = []
   tsxs = []
 
-  for pdu in c.pdus:
+  values = MsgIndex(window)
+  requests = MsgIndex(window)
+
+  for pdu in pdus:
     m = dm.Msg.decode(pdu.content, tag=True)
     if m.code == 280: continue
 
@@ -152,14 +172,14 @@ if __name__ == '__main__':
       h2h_id = m.h2h_id
       m.in_response_to = None
 
-      for prev_m in msgs:
-        if prev_m.R and prev_m.e2e_id == e2e_id and prev_m.h2h_id == h2h_id:
-          m.in_response_to = prev_m
-          prev_m.answered_by = m
-          m.tsx_id = len(tsxs)
-          prev_m.tsx_id = len(tsxs)
-          tsxs.append((prev_m, m))
-          break
+      req = requests.lookup((e2e_id, h2h_id))
+      if req is not None:
+        prev_m = req[0]
+        m.in_response_to = prev_m
+        prev_m.answered_by = m
+        m.tsx_id = len(tsxs)
+        prev_m.tsx_id = len(tsxs)
+        tsxs.append((prev_m, m))
 
       assert(m.in_response_to is not None)
 
@@ -169,7 +189,7 @@ if __name__ == '__main__':
 
     for a in m.all_avps():
       v = a.data
-      anchor = lookup(msgs, v)
+      anchor = values.lookup(v)
       if anchor:
         (prev_m, prev_loc) = anchor
         if prev_loc not in prev_m.anchors:
@@ -178,6 +198,15 @@ if __name__ == '__main__':
 
     msgs.append(m)
 
+    values.add(m, [(m.values[k], k) for k in m.values])
+    if m.R:
+      requests.add(m, [((m.e2e_id, m.h2h_id), None)])
+    else:
+      requests.add(m, [])
+
+    if window is not None and len(msgs) > window:
+      msgs[-window-1].values = None
+
   for m in msgs:
     for loc in m.anchors:
       print('anchor %r, propagating to %r' % (loc, m.anchors[loc]))
@@ -188,7 +217,21 @@ if __name__ == '__main__':
     server_dump.write('  tsxs = [()]*%d\n' % len(tsxs))
 
   for m in msgs:
-    if m.R:
+    if coroutine and m.R:
+      emitter = '''
+  # frame %d
+  m = %s
+  yield peer.send(m)
+  tsxs[%d] = (m.e2e_id, m.h2h_id)
+''' % (m.frm_number, m.__repr__(2, 2)[2:], m.tsx_id)
+    elif coroutine:
+      emitter = '''
+  # frame %d
+  m = %s
+  (m.e2e_id, m.h2h_id) = tsxs[%d]
+  yield peer.send(m)
+''' % (m.frm_number, m.__repr__(2, 2)[2:], m.tsx_id)
+    elif m.R:
       emitter = '''
   # frame %d
   m = %s
@@ -203,7 +246,19 @@ if __name__ == '__main__':
   m.send(f)
 ''' % (m.frm_number, m.__repr__(2, 2)[2:], m.tsx_id)
 
-    if m.R:
+    if coroutine and m.R:
+      receiver = '''
+  # frame %d
+  m = yield peer.expect(%d, R=True)
+  tsxs[%d] = (m.e2e_id, m.h2h_id)
+''' % (m.frm_number, m.code, m.tsx_id)
+    elif coroutine:
+      receiver = '''
+  # frame %d
+  m = yield peer.expect(%d, R=False)
+  assert(tsxs[%d] == (m.e2e_id, m.h2h_id))
+''' % (m.frm_number, m.code, m.tsx_id)
+    elif m.R:
       receiver = '''
   # frame %d
   m = Msg.recv(f)
@@ -256,8 +311,105 @@ if __name__ == '__main__':
         server_empty = False
 
   if client_dump:
-    client_dump.write('\n  f.close()\n')
+    client_dump.write(footer)
     client_dump.close()
   if server_dump:
-    server_dump.write('\n  f.close()\n')
+    server_dump.write(footer)
     server_dump.close()
+
+def load_directory():
+  '''pool initializer: load the Directory once per worker.'''
+  if Directory.DEFAULT is None:
+    with open('.dia-cache', 'rb') as f:
+      Directory.DEFAULT = load(f)
+
+def generate_flow(job):
+  '''pool task: generates scenarios of a flow, and returns what generate
+printed, so that outputs of flows are not interleaved.'''
+  out = StringIO()
+  saved = sys.stdout
+  sys.stdout = out
+  try:
+    generate(*job)
+  finally:
+    sys.stdout = saved
+  return out.getvalue()
+
+if __name__ == '__main__':
+  client_name = None
+  server_name = None
+
+  native = False
+  window = None
+  coroutine = False
+  jobs = 1
+
+  try:
+    opts, args = getopt(sys.argv[1:], 'c:s:w:aj:nh', ['client=', 'server=', 'window=', 'coroutine', 'jobs=', 'native', 'help'])
+    for o, a in opts:
+      if o in ('-c', '--client'):
+        client_name = a
+      elif o in ('-s', '--server'):
+        server_name = a
+      elif o in ('-w', '--window'):
+        window = int(a)
+      elif o in ('-a', '--coroutine'):
+        coroutine = True
+      elif o in ('-j', '--jobs'):
+        jobs = int(a)
+      elif o in ('-n', '--native'):
+        native = True
+      elif o in ('-h', '--help'):
+        usage(sys.argv[0])
+  except:
+    sys.exit(2)
+
+  if len(args) != 1:
+    usage(sys.argv[0])
+
+  if client_name is None and server_name is None:
+    print >>sys.stderr, "As per your options, no scenario will be generated"
+
+
+  pcap = args[0]
+
+  c = CachedLoader(pcap, native=native)
+
+  if len(c.flows) == 0:
+    print >>sys.stderr, 'Could not find a flow in capture %s' % pcap
+    sys.exit(1)
+
+  # raw PDUs are only split by flow here, generate decodes and tags those of each flow
+  flows = OrderedDict()
+  for flow in c.flows:
+    flows[canonical_flow(flow)] = (flow, [])
+  for pdu in c.pdus:
+    flows[flow_key(pdu)][1].append(pdu)
+
+  pool = None
+  if jobs > 1 and len(flows) > 1:
+    pool = Pool(jobs, initializer=load_directory)
+  results = []
+
+  for (flow, pdus) in flows.values():
+    (client, server) = (client_name, server_name)
+    if len(flows) > 1:
+      if client:
+        client = flow_name(client, flow)
+      if server:
+        server = flow_name(server, flow)
+
+    if pool is not None:
+      job = ([strip(pdu) for pdu in pdus], flow, client, server, window, coroutine)
+      results.append((flow, pool.apply_async(generate_flow, (job,))))
+    else:
+      print('detected a flow %s:%d -> %s:%d' % flow[1:])
+      generate(pdus, flow, client, server, window, coroutine)
+
+  if pool is not None:
+    # outputs are printed in flow order, whatever the order of completion
+    for (flow, result) in results:
+      print('detected a flow %s:%d -> %s:%d' % flow[1:])
+      sys.stdout.write(result.get())
+    pool.close()
+    pool.join()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import os
+import subprocess
+from hashlib import sha1
+from struct import Struct
+from tempfile import mkstemp
+
+import Pdml
+from Pdml import PdmlLoader, Pdu
+import Native
+from Native import NativeLoader
+
+MAGIC = 'DPDU\x01'
+
+class CorruptedEntry(Exception): pass
+
+'''frame number, ip protocol, source port, destination port, then lengths
+of source address, destination address, apps, summary and content.'''
+RECORD = Struct('!LBHHBBHHL')
+
+def tshark_version():
+  '''first line of tshark --version, or None if tshark cannot be run.'''
+  if tshark_version.cached is None:
+    try:
+      p = subprocess.Popen(['tshark', '--version'], stdout=subprocess.PIPE)
+      tshark_version.cached = p.communicate()[0].split('\n')[0].strip()
+    except OSError:
+      tshark_version.cached = ''
+  return tshark_version.cached or None
+tshark_version.cached = None
+
+def file_digest(name):
+  h = sha1()
+  with open(name, 'rb') as f:
+    while True:
+      b = f.read(1 << 20)
+      if len(b) == 0:
+        break
+      h.update(b)
+  return h.hexdigest()
+
+def encode_pdu(pdu):
+  ipsrc = pdu.ipsrc.encode('utf-8')
+  ipdst = pdu.ipdst.encode('utf-8')
+  apps = pdu.apps.encode('utf-8')
+  summary = getattr(pdu, 'summary', u'').encode('utf-8')
+  return RECORD.pack(pdu.pdml.frm_number, pdu.ipprotocol, pdu.sport, pdu.dport,
+    len(ipsrc), len(ipdst), len(apps), len(summary), len(pdu.content)) + \
+    ipsrc + ipdst + apps + summary + pdu.content
+
+def read_pdus(f):
+  '''yields PDUs stored in an opened cache file, after its magic.
+Raises CorruptedEntry on a truncated or corrupted record.'''
+  while True:
+    hdr = f.read(RECORD.size)
+    if len(hdr) == 0:
+      return
+    if len(hdr) != RECORD.size:
+      raise CorruptedEntry(len(hdr), RECORD.size)
+    (frm_number, proto, sport, dport, srclen, dstlen, appslen,
+      summarylen, contentlen) = RECORD.unpack(hdr)
+    b = f.read(srclen + dstlen + appslen + summarylen + contentlen)
+    if len(b) != srclen + dstlen + appslen + summarylen + contentlen:
+      raise CorruptedEntry(len(b), srclen + dstlen + appslen + summarylen + contentlen)
+
+    fields = []
+    for l in (srclen, dstlen, appslen, summarylen):
+      try:
+        fields.append(b[:l].decode('utf-8'))
+      except UnicodeDecodeError:
+        raise CorruptedEntry(b[:l])
+      b = b[l:]
+    (ipsrc, ipdst, apps, summary) = fields
+
+    pdu = Pdu.from_content(frm_number, str(ipsrc), str(ipdst), proto, sport, dport, apps, b)
+    pdu.summary = summary
+    yield pdu
+
+def discard(f, tmp):
+  '''closes f and removes tmp, an entry being written, ignoring errors.'''
+  try:
+    if f is not None:
+      f.close()
+  except (IOError, OSError):
+    pass
+  try:
+    if tmp is not None and os.path.exists(tmp):
+      os.unlink(tmp)
+  except OSError:
+    pass
+  return None
+
+class PduCache(object):
+  '''directory of PDU lists extracted from pcap files.
+Entries are keyed by the pcap content hash and by the extractor used,
+including the tshark or native extractor version. Least recently used entries are evicted
+once the directory grows beyond max_size bytes.
+Content hashes are themselves cached, keyed by pcap device, inode, size
+and modification time, so that a pcap is only read once to be hashed.
+'''
+  DIRECTORY = '.pdu-cache'
+  MAX_SIZE = 512 << 20
+
+  def __init__(self, directory=DIRECTORY, max_size=MAX_SIZE):
+    self.directory = directory
+    self.max_size = max_size
+
+  def path(self, pcap, extractor):
+    h = sha1(self.digest(pcap))
+    h.update(extractor)
+    return os.path.join(self.directory, h.hexdigest() + '.pdus')
+
+  def digest(self, pcap):
+    st = os.stat(pcap)
+    key = sha1('%d %d %d %r' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime))
+    path = os.path.join(self.directory, key.hexdigest() + '.digest')
+
+    try:
+      with open(path, 'rb') as f:
+        digest = f.read()
+      if len(digest) == 40:
+        os.utime(path, None)
+        return digest
+    except (IOError, OSError):
+      pass
+
+    digest = file_digest(pcap)
+
+    # an unwritable cache directory only costs hashing again
+    tmp = None
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      (fd, tmp) = mkstemp(dir=self.directory, suffix='.tmp')
+      with os.fdopen(fd, 'wb') as f:
+        f.write(digest)
+      os.rename(tmp, path)
+    except (IOError, OSError):
+      if tmp is not None and os.path.exists(tmp):
+        os.unlink(tmp)
+
+    return digest
+
+  def lookup(self, path):
+    '''opened cache file positioned on first PDU, or None on cache miss.'''
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    if f.read(len(MAGIC)) != MAGIC:
+      f.close()
+      return None
+    # refresh entry for LRU eviction, unless another process evicted it
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return f
+
+  def store(self, path, pdus):
+    '''yields pdus while writing them to a new cache entry.
+The entry is only committed once all PDUs have been consumed. When it
+cannot be written, pdus are still yielded, and nothing is cached.'''
+    (f, tmp) = (None, None)
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      (fd, tmp) = mkstemp(dir=self.directory, suffix='.tmp')
+      f = os.fdopen(fd, 'wb')
+      f.write(MAGIC)
+    except (IOError, OSError):
+      f = discard(f, tmp)
+
+    try:
+      for pdu in pdus:
+        if f is not None:
+          try:
+            f.write(encode_pdu(pdu))
+          except (IOError, OSError):
+            f = discard(f, tmp)
+        yield pdu
+
+      if f is not None:
+        try:
+          f.close()
+          os.rename(tmp, path)
+        except (IOError, OSError):
+          pass
+        self.evict()
+    finally:
+      discard(f, tmp)
+
+  def evict(self):
+    '''removes least recently used entries. Entries may be removed
+concurrently by other processes sharing the directory.'''
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+
+    entries = []
+    for n in names:
+      if not n.endswith('.pdus') and not n.endswith('.digest'):
+        continue
+      p = os.path.join(self.directory, n)
+      try:
+        st = os.stat(p)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, p))
+
+    total = sum([size for (mtime, size, p) in entries])
+    for (mtime, size, p) in sorted(entries):
+      if total <= self.max_size:
+        break
+      try:
+        os.unlink(p)
+      except OSError:
+        pass
+      total -= size
+
+class CachedLoader(object):
+  '''extracts PDUs from a pcap file, either natively or through tshark,
+unless they have been cached by a previous run.
+Like PdmlLoader, PDUs are stored under self.pdus, unless streaming is
+set, in which case they are only yielded by iter_pdus.
+Flows are available once PDUs have been extracted.
+The cache is bypassed when cache is None, or when track_owner is set,
+since cached PDUs are not dissected.
+'''
+  def __init__(self, name, native=False, streaming=False, cache=PduCache()):
+    self.name = name
+    self.native = native
+    self.streaming = streaming
+    self.cache = cache
+    self.pdus = []
+    self.flows = []
+    self.flow_keys = set()
+
+    if streaming:
+      return
+
+    self.pdus = [pdu for pdu in self.extract()]
+
+  def iter_pdus(self):
+    if not self.streaming:
+      return iter(self.pdus)
+    return self.extract()
+
+  def extractor(self):
+    if self.native:
+      return 'native %d' % Native.VERSION
+    return 'tshark %s' % tshark_version()
+
+  def loader(self):
+    if self.native:
+      return NativeLoader(self.name, streaming=True)
+    return PdmlLoader(self.name, streaming=True)
+
+  def cached(self, path, f):
+    '''yields PDUs of cache entry f. A truncated or corrupted entry is
+dropped, and PDUs are extracted again, past those already yielded.'''
+    count = 0
+    try:
+      with f:
+        for pdu in read_pdus(f):
+          yield pdu
+          count += 1
+      return
+    except CorruptedEntry:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+    for (ndx, pdu) in enumerate(self.cache.store(path, self.loader().iter_pdus())):
+      if ndx >= count:
+        yield pdu
+
+  def extract(self):
+    if self.cache is None or Pdml.track_owner:
+      pdus = self.loader().iter_pdus()
+    else:
+      path = self.cache.path(self.name, self.extractor())
+      f = self.cache.lookup(path)
+      if f is not None:
+        pdus = self.cached(path, f)
+      else:
+        pdus = self.cache.store(path, self.loader().iter_pdus())
+
+    for pdu in pdus:
+      label = (pdu.ipprotocol, pdu.ipsrc, pdu.sport, pdu.ipdst, pdu.dport)
+      rlabel = (pdu.ipprotocol, pdu.ipdst, pdu.dport, pdu.ipsrc, pdu.sport)
+      if rlabel not in self.flow_keys and label not in self.flow_keys:
+        self.flow_keys.add(label)
+        self.flows.append(label)
+      yield pdu
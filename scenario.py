@@ -8,20 +8,92 @@
 
 import Diameter as dm
 
-from struct import pack, unpack
-from threading import Thread
+from collections import deque, namedtuple
+
+from struct import pack, unpack, Struct, error as StructError
+from threading import Thread, Lock
+from random import randint
 from mutate import MsgAnchor, MutateScenario, MessageTooBig
 
 import socket as sk
 import select as sl
 import sys
+import os
+import time
 import traceback
+import inspect
+import imp
+import marshal
+from hashlib import sha1
+from tempfile import mkstemp
 
 
 class Disconnected(Exception): pass
 class FramingError(Exception): pass
 
+class Channel(object):
+  '''one end of an in-process channel between a scenario and dwr_handler.
+Messages are queued as (Msg or None, encoded bytes) pairs, and a byte is
+written to a pipe for each of them, so that select can wait on fileno.'''
+  def __init__(self):
+    self.queue = deque()
+    (self.rfd, self.wfd) = os.pipe()
+    self.peer = None
+    self.lock = None
+    self.timeout = None
+    self.closed = False
+
+  @staticmethod
+  def pair():
+    (a, b) = (Channel(), Channel())
+    (a.peer, b.peer) = (b, a)
+    a.lock = b.lock = Lock()
+    return (a, b)
+
+  def fileno(self):
+    return self.rfd
+
+  def settimeout(self, timeout):
+    self.timeout = timeout
+
+  def notify(self, item):
+    self.peer.queue.append(item)
+    os.write(self.peer.wfd, '.')
+
+  def put(self, msg, data):
+    if self.closed or self.peer.closed:
+      raise Disconnected()
+    self.notify((msg, data))
+
+  def get(self):
+    (readable, _, _) = sl.select([self.rfd], [], [], self.timeout)
+    if not readable:
+      raise sk.timeout('timed out')
+    os.read(self.rfd, 1)
+
+    item = self.queue.popleft()
+    if item is None:
+      raise Disconnected()
+    return item
+
+  def close(self):
+    '''signals end of stream to the peer. Pipes are closed along with the
+last end of the pair.'''
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      if not self.peer.closed:
+        self.notify(None)
+      else:
+        for c in (self, self.peer):
+          os.close(c.rfd)
+          os.close(c.wfd)
+
 def unpack_frame(f):
+  if isinstance(f, Channel):
+    return f.get()[1]
+
   data = f.recv(4)
   if len(data) == 0: raise Disconnected()
   if len(data) != 4: raise FramingError(len(data), 4)
@@ -41,24 +113,106 @@ def unpack_frame(f):
   return data
 
 def pack_frame(f, data):
+  if isinstance(f, Channel):
+    f.put(None, data)
+    return
+
   length = pack('!I', len(data))
 
   f.sendall(length + data)
 
+def frames(buf):
+  '''splits buf into complete Diameter messages, and remaining bytes.'''
+  msgs = []
+  offset = 0
+  while len(buf) - offset >= 4:
+    length = dm.unpack24(buf[offset+1:offset+4])
+    if length < 20:
+      raise FramingError(length, 20)
+    if len(buf) - offset < length:
+      break
+    msgs.append(buf[offset:offset+length])
+    offset += length
+  return (msgs, buf[offset:])
+
 def load_scenario(scn, local_hostname, local_realm):
-  globs = globals()
+  if scn.endswith('.tpl'):
+    from scn2tpl import load_template
+    return load_template(scn, local_hostname, local_realm)
+
+  # each scenario gets its own copy of module globals
+  globs = dict(globals())
 
+  globs['__file__'] = scn
   globs['Msg'] = dm.Msg
   globs['Avp'] = dm.Avp
   globs['RecvMismatch'] = dm.RecvMismatch
   globs['local_hostname'] = local_hostname
   globs['local_realm'] = local_realm
 
-  execfile(scn, globs, globs)
+  exec compile_scenario(scn) in globs
 
   assert('run' in globs)
 
-  return globs['run']
+  run = globs['run']
+  if inspect.isgeneratorfunction(run):
+    from engine import CoroutineScenario
+    return CoroutineScenario(run)
+
+  return run
+
+'''header of compiled scenarios: magic, then source mtime, size and sha1.'''
+COMPILED_MAGIC = 'DSCN' + imp.get_magic()
+COMPILED_HEADER = Struct('!dQ20s')
+
+def compile_scenario(scn):
+  '''code object of scn. It is cached as marshal data in scn + 'c', which
+is used as long as scn mtime and size, or else content, are unchanged.'''
+  cached = scn + 'c'
+  st = os.stat(scn)
+
+  (header, code) = (None, None)
+  try:
+    with open(cached, 'rb') as f:
+      b = f.read()
+    if b.startswith(COMPILED_MAGIC):
+      header = COMPILED_HEADER.unpack_from(b, len(COMPILED_MAGIC))
+      code = marshal.loads(b[len(COMPILED_MAGIC) + COMPILED_HEADER.size:])
+  except (IOError, StructError, ValueError, EOFError, TypeError):
+    # a missing, unreadable or corrupted cache is rebuilt
+    (header, code) = (None, None)
+
+  if header is not None and header[:2] == (st.st_mtime, st.st_size):
+    return code
+
+  with open(scn, 'rb') as f:
+    source = f.read()
+  digest = sha1(source).digest()
+
+  if header is not None and header[2] == digest:
+    return code
+
+  code = compile(source, scn, 'exec')
+
+  # a concurrent loader must either see a complete file, or none, and a
+  # read-only scenario directory is simply not cached
+  tmp = None
+  try:
+    (fd, tmp) = mkstemp(dir=os.path.dirname(os.path.abspath(scn)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(COMPILED_MAGIC)
+      f.write(COMPILED_HEADER.pack(st.st_mtime, st.st_size, digest))
+      f.write(marshal.dumps(code))
+    os.chmod(tmp, st.st_mode & 0666)
+    os.rename(tmp, cached)
+  except (IOError, OSError):
+    if tmp is not None and os.path.exists(tmp):
+      try:
+        os.unlink(tmp)
+      except OSError:
+        pass
+
+  return code
 
 class WrappedThread(Thread):
   def __init__(self, plug, **kwargs):
@@ -80,13 +234,186 @@ class WrappedThread(Thread):
     Thread.join(self)
     return self.exc_info
 
-def dwr_handler(scenario, f, local_host, local_realm, mutator=None):
+class Transcript(object):
+  '''(Msg, is_sent) pairs exchanged by dwr_handler. A message may be
+recorded encoded, in which case it is only decoded once accessed.'''
+  def __init__(self):
+    self.entries = []
+
+  def append(self, entry):
+    self.entries.append(entry)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __getitem__(self, i):
+    (m, is_sent) = self.entries[i]
+    if not isinstance(m, dm.Msg):
+      m = dm.Msg.decode(m)
+      self.entries[i] = (m, is_sent)
+    return (m, is_sent)
+
+  def __iter__(self):
+    for i in range(len(self.entries)):
+      yield self[i]
+
+'''flags, code, hop-by-hop and end-to-end identifiers of a message header.'''
+HEADER = Struct('!4xB3s4xLL')
+
+def dwa(local_host, local_realm, h2h_id, e2e_id):
+  '''encoded DWA answering the DWR of given identifiers.'''
+  return dm.Msg(code=280, R=False, e2e_id=e2e_id, h2h_id=h2h_id, avps=[
+    dm.Avp(code=264, M=True, data=local_host),
+    dm.Avp(code=296, M=True, data=local_realm),
+    dm.Avp(code=268, M=True, u32=2001),
+    dm.Avp(code=278, M=True, u32=0xcafebabe)]).encode()
+
+def set_ids(data, h2h_id, e2e_id):
+  '''encoded message data, with given identifiers.'''
+  return data[:12] + pack('!LL', h2h_id, e2e_id) + data[20:]
+
+def transact(f, req, local_host, local_realm, timeout=5.0):
+  '''sends encoded request req over f, and returns its encoded answer, or
+None when f fails, is closed, or does not answer within timeout.
+DWR received meanwhile are answered, and other messages are dropped.'''
+  (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(req)
+  deadline = time.time() + timeout
+  rbuf = ''
+
+  try:
+    f.sendall(req)
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return None
+      (readable, _, _) = sl.select([f], [], [], remaining)
+      if not readable:
+        return None
+      b = f.recv(dm.U24_MAX)
+      if len(b) == 0:
+        return None
+
+      (msgs, rbuf) = frames(rbuf + b)
+      for data in msgs:
+        (a_flags, a_code, a_h2h_id, a_e2e_id) = HEADER.unpack_from(data)
+        if a_flags & 0x80:
+          if dm.unpack24(a_code) == 280:
+            f.sendall(dwa(local_host, local_realm, a_h2h_id, a_e2e_id))
+        elif (a_code, a_h2h_id, a_e2e_id) == (code, h2h_id, e2e_id):
+          return data
+  except (sk.error, FramingError):
+    return None
+
+def probe(f, local_host, local_realm, timeout=5.0):
+  '''whether the peer of f still answers a DWR.'''
+  dwr = dm.Msg(code=280, R=True, avps=[
+    dm.Avp(code=264, M=True, data=local_host),
+    dm.Avp(code=296, M=True, data=local_realm)])
+  return transact(f, dwr.encode(), local_host, local_realm, timeout) is not None
+
+def unanswered(msgs):
+  '''(hop-by-hop, end-to-end) identifiers of requests sent in Transcript
+msgs, for which no answer was received.'''
+  (sent, answered) = (set(), set())
+  for (m, is_sent) in msgs.entries:
+    if isinstance(m, dm.Msg):
+      (request, ids) = (m.R, (m.h2h_id, m.e2e_id))
+    else:
+      (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(m)
+      (request, ids) = (flags & 0x80, (h2h_id, e2e_id))
+    if is_sent and request:
+      sent.add(ids)
+    elif not is_sent and not request:
+      answered.add(ids)
+  return frozenset(sent - answered)
+
+'''an association of an AssociationPool: its socket, the cached CEA, and the
+identifiers of requests left unanswered by the previous scenario run over
+it, whose late answers are to be dropped.'''
+Association = namedtuple('Association', 'f cea stale')
+
+class AssociationPool(object):
+  '''associations to a target, set up beforehand by sending cer, the encoded
+CER of the scenario, so that scenarios run over them through dwr_handler
+are answered the cached CEA instead. An association given back is kept
+as long as it answers a DWR, messages received meanwhile being dropped.
+connect returns a new connected socket. When cer is None, associations
+are only kept open.'''
+  def __init__(self, connect, cer, local_host, local_realm, timeout=5.0):
+    self.connect = connect
+    self.cer = cer
+    self.local_host = local_host
+    self.local_realm = local_realm
+    self.timeout = timeout
+    self.lock = Lock()
+    self.idle = deque()
+    self.created = 0
+    self.reused = 0
+
+  def warm(self):
+    '''a new Association.'''
+    f = self.connect()
+    cea = None
+    if self.cer is not None:
+      cer = set_ids(self.cer, randint(0, pow(2, 32)-1), randint(0, pow(2, 32)-1))
+      cea = transact(f, cer, self.local_host, self.local_realm, self.timeout)
+      if cea is None:
+        f.close()
+        raise Disconnected('capabilities exchange failed')
+    with self.lock:
+      self.created += 1
+    return Association(f, cea, frozenset())
+
+  def prewarm(self, count):
+    for i in range(count):
+      association = self.warm()
+      with self.lock:
+        self.idle.append(association)
+
+  def get(self):
+    with self.lock:
+      if self.idle:
+        self.reused += 1
+        return self.idle.popleft()
+    return self.warm()
+
+  def put(self, association, msgs):
+    '''gives association back, msgs being the Transcript of the scenario run
+over it, or None if it did not complete.'''
+    f = association.f
+    if msgs is not None and probe(f, self.local_host, self.local_realm, self.timeout):
+      with self.lock:
+        self.idle.append(association._replace(stale=unanswered(msgs)))
+    else:
+      f.close()
+
+  def close(self):
+    with self.lock:
+      while self.idle:
+        self.idle.popleft().f.close()
+
+def dwr_handler(scenario, f, local_host, local_realm, mutator=None, validate=None, channel=True, lazy=False, cea=None, stale=()):
+  '''run scenario over f, answering DWR on its behalf.
+When given, validate is called with every other received message.
+The scenario is given one end of a Channel, or of a socketpair when channel
+is False. Over a Channel, messages are passed without framing, and Msg
+objects are passed along, so that they are not decoded again: a scenario
+must not modify a message once it has been sent or received.
+When lazy is set, only headers of received messages are decoded, to spot
+DWR, and messages are recorded encoded in the returned Transcript.
+When cea is given, capabilities were already exchanged over f: CER sent by
+the scenario are not transmitted, but answered using cea. Answers whose
+(hop-by-hop, end-to-end) identifiers are in stale belong to a previous
+scenario run over f, and are dropped.'''
   assert(mutator is None or isinstance(mutator, MutateScenario))
 
   break_reason = None
-  msgs = []
+  msgs = Transcript()
 
-  (own_plug, fuzzed_plug) = sk.socketpair(sk.AF_UNIX, sk.SOCK_STREAM)
+  if channel:
+    (own_plug, fuzzed_plug) = Channel.pair()
+  else:
+    (own_plug, fuzzed_plug) = sk.socketpair(sk.AF_UNIX, sk.SOCK_STREAM)
 
   if mutator is not None:
     mutator.bind(f)
@@ -94,16 +421,44 @@ def dwr_handler(scenario, f, local_host, local_realm, mutator=None):
   child = WrappedThread(fuzzed_plug, target=scenario, args=[fuzzed_plug])
   child.start()
 
+  # messages received from f, which may be several per read over TCP
+  received = deque()
+  rbuf = ''
+
   while True:
-    (readable, _, _) = sl.select([own_plug, f], [], [])
+    if received:
+      # the scenario may have ended before buffered messages are delivered
+      (readable, _, _) = sl.select([own_plug], [], [], 0)
+      if not readable:
+        readable = [f]
+    else:
+      (readable, _, _) = sl.select([own_plug, f], [], [])
 
     if own_plug in readable:
       try:
-        b = unpack_frame(own_plug)
-        m = dm.Msg.decode(b)
-        msgs.append((m, True))
-        assert(isinstance(m, dm.Msg))
-      except Disconnected as e:
+        if channel:
+          (m, b) = own_plug.get()
+        else:
+          (m, b) = (None, unpack_frame(own_plug))
+        # mutations are applied in place
+        if (m is None and not lazy) or mutator is not None:
+          m = dm.Msg.decode(b)
+        msgs.append((b if m is None else m, True))
+
+        if cea is not None:
+          (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(b)
+          if dm.unpack24(code) == 257 and flags & 0x80:
+            if mutator:
+              mutator.skip(m)
+            answer = set_ids(cea, h2h_id, e2e_id)
+            msgs.append((answer, False))
+            if channel:
+              own_plug.put(None, answer)
+            else:
+              pack_frame(own_plug, answer)
+            continue
+      except (Disconnected, sk.error) as e:
+        # the scenario closed its end
         break
       except Exception as e:
         break_reason = traceback.format_exc()
@@ -113,35 +468,53 @@ def dwr_handler(scenario, f, local_host, local_realm, mutator=None):
         try:
           mutator.send(m)
         except MessageTooBig as e:
-          return ('MessageTooBig', msgs)
+          break_reason = 'MessageTooBig'
+          break
       else:
         f.sendall(b)
 
     elif f in readable:
-      try:
-        b = f.recv(dm.U24_MAX)
-        if len(b) == 0:
+      if not received:
+        try:
+          b = f.recv(dm.U24_MAX)
+          if len(b) == 0:
+            break
+          (more, rbuf) = frames(rbuf + b)
+          received.extend(more)
+        except Exception as e:
+          break_reason = traceback.format_exc()
           break
-      except Exception as e:
-        break_reason = traceback.format_exc()
-        break
-
-      m = dm.Msg.decode(b)
-      if m.code == 280 and m.R:
-        dwa = dm.Msg(code=280, R=False, e2e_id=m.e2e_id, h2h_id=m.h2h_id, avps=[
-          dm.Avp(code=264, M=True, data=local_host),
-          dm.Avp(code=296, M=True, data=local_realm),
-          dm.Avp(code=268, M=True, u32=2001),
-          dm.Avp(code=278, M=True, u32=0xcafebabe)])
-        f.sendall(dwa.encode())
+        if not received:
+          continue
+
+      b = received.popleft()
+      (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(b)
+      if dm.unpack24(code) == 280 and flags & 0x80:
+        f.sendall(dwa(local_host, local_realm, h2h_id, e2e_id))
+      elif not flags & 0x80 and (h2h_id, e2e_id) in stale:
+        # late answer to a previous scenario
+        continue
       else:
-        msgs.append((m, False))
-        pack_frame(own_plug, b)
+        m = None
+        if not lazy:
+          m = dm.Msg.decode(b)
+        msgs.append((b if m is None else m, False))
+        if validate is not None:
+          validate(b)
+        try:
+          if channel:
+            own_plug.put(m, b)
+          else:
+            pack_frame(own_plug, b)
+        except (Disconnected, sk.error) as e:
+          # the scenario closed its end
+          break
 
   own_plug.close()
   exc_info = child.join()
 
-  if not exc_info:
+  # the scenario then fails on its closed end, which is not the reason
+  if not exc_info or break_reason == 'MessageTooBig':
     exc_info = break_reason
 
   return (exc_info, msgs)
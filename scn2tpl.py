@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import sys
+import ast
+import re
+from collections import namedtuple
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from struct import pack, unpack
+from random import randint
+
+import Diameter as dm
+from engine import drive, Send, Recv, Close
+
+class CompileError(Exception): pass
+
+SESSION_ID = 263
+USER_NAME = 1
+SUBSCRIPTION_ID = 443
+SUBSCRIPTION_ID_DATA = 444
+SUBSCRIPTION_ID_TYPE = 450
+END_USER_IMSI = 1
+
+IMSI = re.compile(r'^[0-9]{14,15}$')
+
+class Slot(object):
+  '''a value only known at runtime: a captured variable, local_hostname or
+local_realm, or Session-Id and IMSI which may be overridden using args.'''
+  def __init__(self, name, default=None):
+    self.name = name
+    self.default = default
+
+'''pre-encoded message: static bytes encoded with empty slots, and for each
+slot, its offset in static bytes, its name and default value, the offset
+of the length of its AVP, and offsets of enclosing lengths.'''
+Template = namedtuple('Template', 'static slots')
+TemplateSlot = namedtuple('TemplateSlot', 'offset name default own_length lengths')
+
+'''ids: (e2e_id, h2h_id) set by the scenario, tsx_in: transaction whose
+identifiers are reused, tsx_out: transaction whose identifiers are recorded.
+Unset identifiers are randomized.'''
+SendStep = namedtuple('SendStep', 'template ids tsx_in tsx_out')
+'''R is None when not checked, captures is a list of (variable, path).'''
+RecvStep = namedtuple('RecvStep', 'code R tsx_in tsx_out captures')
+CloseStep = namedtuple('CloseStep', '')
+
+def add24(buf, offset, delta):
+  (hi, lo) = unpack('!BH', str(buf[offset:offset+3]))
+  v = (hi << 16) + lo + delta
+  buf[offset:offset+3] = pack('!BH', v >> 16, v & 0xffff)
+
+class TemplateEncoder:
+  '''encodes a Msg whose AVP data may be slots, as Msg.encode does, while
+recording slot offsets and lengths depending on them.'''
+  def __init__(self):
+    self.slots = []
+
+  def encode_msg(self, m):
+    content = ''
+    lengths = []
+    if not m.length:
+      lengths = [1]
+    for a in m.avps:
+      content += self.encode_avp(a, 20 + len(content), lengths)
+
+    if m.length:
+      length = m.length
+    else:
+      length = len(content) + 20
+
+    flags = 0
+    if m.R: flags |= 0x80
+    if m.P: flags |= 0x40
+    if m.E: flags |= 0x20
+    if m.T: flags |= 0x10
+    if m.reserved: flags |= m.reserved
+
+    h2h_id = m.h2h_id or 0
+    e2e_id = m.e2e_id or 0
+
+    static = pack('!B', m.version) + dm.pack24(length) + pack('!B', flags) + \
+      dm.pack24(m.code) + pack('!LLL', m.app_id, h2h_id, e2e_id) + content
+
+    return Template(static, self.slots)
+
+  def encode_avp(self, a, base, lengths):
+    flags = 0
+    if a.V: flags |= 0x80
+    if a.M: flags |= 0x40
+    if a.P: flags |= 0x20
+    if a.reserved: flags |= a.reserved
+
+    header = 8
+    if a.V:
+      header += 4
+
+    own_length = None
+    if a.length is None:
+      own_length = base + 5
+
+    content = ''
+    if a.avps:
+      inner = list(lengths)
+      if own_length is not None:
+        inner.append(own_length)
+      for sub_a in a.avps:
+        content += self.encode_avp(sub_a, base + header + len(content), inner)
+    elif isinstance(a.data, Slot):
+      self.slots.append(TemplateSlot(base + header, a.data.name, a.data.default,
+        own_length, list(lengths)))
+    elif a.data:
+      content = a.data
+
+    length = a.length
+    if length is None:
+      length = len(content) + header
+
+    r = pack('!LB', a.code, flags) + dm.pack24(length)
+    if a.V:
+      r += pack('!L', a.vendor)
+    r += content
+    if length % 4 != 0:
+      r += '\x00' * (4 - (length % 4))
+    return r
+
+def build(template, values, h2h_id, e2e_id):
+  '''instantiate template, given slot values.'''
+  buf = bytearray(template.static)
+  buf[12:20] = pack('!LL', h2h_id, e2e_id)
+
+  parts = []
+  for s in template.slots:
+    v = values.get(s.name, s.default)
+    padding = (4 - len(v) % 4) % 4
+    if s.own_length is not None:
+      add24(buf, s.own_length, len(v))
+    for offset in s.lengths:
+      add24(buf, offset, len(v) + padding)
+    parts.append(v + '\x00' * padding)
+
+  r = ''
+  prev = 0
+  for (s, v) in zip(template.slots, parts):
+    r += str(buf[prev:s.offset]) + v
+    prev = s.offset
+  return r + str(buf[prev:])
+
+def imsi_avps(avps):
+  '''AVPs holding an IMSI: a User-Name made of 14 or 15 digits, or the data
+of an IMSI Subscription-Id.'''
+  for a in avps:
+    if a.vendor:
+      continue
+    if a.code == USER_NAME and isinstance(a.data, str) and IMSI.match(a.data):
+      yield a
+    elif a.code == SUBSCRIPTION_ID and a.avps:
+      types = [sub_a.data for sub_a in a.avps if sub_a.code == SUBSCRIPTION_ID_TYPE]
+      if types != [pack('!L', END_USER_IMSI)]:
+        continue
+      for sub_a in a.avps:
+        if sub_a.code == SUBSCRIPTION_ID_DATA and isinstance(sub_a.data, str):
+          yield sub_a
+
+def imsi_slots(avps):
+  '''turns IMSI held by User-Name or by an IMSI Subscription-Id into slots.'''
+  for a in list(imsi_avps(avps)):
+    a.data = Slot('imsi', a.data)
+
+def substitute(m, args):
+  '''overrides Session-Id and IMSI of Msg m by session_id and imsi entries
+of args, as templates do.'''
+  if 'session_id' in args:
+    for a in m.avps:
+      if a.code == SESSION_ID and a.vendor == 0 and isinstance(a.data, str):
+        a.data = args['session_id']
+  if 'imsi' in args:
+    for a in list(imsi_avps(m.avps)):
+      a.data = args['imsi']
+
+def is_name(node, name):
+  return isinstance(node, ast.Name) and node.id == name
+
+def is_attr(node, obj, attr):
+  return isinstance(node, ast.Attribute) and is_name(node.value, obj) and node.attr == attr
+
+def is_ids(node):
+  '''matches (m.e2e_id, m.h2h_id)'''
+  return isinstance(node, ast.Tuple) and len(node.elts) == 2 and \
+    is_attr(node.elts[0], 'm', 'e2e_id') and is_attr(node.elts[1], 'm', 'h2h_id')
+
+def tsx_index(node):
+  '''matches tsxs[<integer>]'''
+  if isinstance(node, ast.Subscript) and is_name(node.value, 'tsxs') and \
+    isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Num):
+    return node.slice.value.n
+  return None
+
+def is_method_call(node, obj, method):
+  return isinstance(node, ast.Call) and is_attr(node.func, obj, method)
+
+class Compiler:
+  '''translates the run function of a scenario, as generated by pcap2scn.py,
+into a list of steps.'''
+  def __init__(self, name):
+    self.name = name
+    self.steps = []
+    self.tsxs = 0
+    self.variables = set(['local_hostname', 'local_realm'])
+    self.pending = None
+
+  def fail(self, node, reason):
+    raise CompileError('%s:%d: %s' % (self.name, node.lineno, reason))
+
+  def compile(self, source):
+    tree = ast.parse(source, self.name)
+
+    funcs = [n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == 'run']
+    if len(funcs) != 1 or len(tree.body) != 1:
+      raise CompileError('%s: expected a single run function' % self.name)
+
+    for stmt in funcs[0].body:
+      self.statement(stmt)
+
+    if self.pending is not None:
+      self.fail(stmt, 'message built but never sent')
+
+    return self.steps
+
+  def message(self, node):
+    namespace = {'Msg': dm.Msg, 'Avp': dm.Avp}
+    for v in self.variables:
+      namespace[v] = Slot(v)
+
+    try:
+      m = eval(compile(ast.Expression(node), self.name, 'eval'), namespace)
+    except Exception as e:
+      self.fail(node, 'cannot evaluate message: %r' % e)
+
+    for a in m.avps:
+      if a.code == SESSION_ID and a.vendor == 0 and isinstance(a.data, str):
+        a.data = Slot('session_id', a.data)
+    imsi_slots(m.avps)
+
+    return m
+
+  def statement(self, stmt):
+    last = None
+    if self.steps:
+      last = self.steps[-1]
+
+    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+      (target, value) = (stmt.targets[0], stmt.value)
+
+      if is_name(target, 'tsxs'):
+        try:
+          self.tsxs = len(eval(compile(ast.Expression(value), self.name, 'eval'), {}))
+        except Exception as e:
+          self.fail(stmt, 'cannot evaluate transactions: %r' % e)
+      elif is_name(target, 'm') and isinstance(value, ast.Call) and is_name(value.func, 'Msg'):
+        if self.pending is not None:
+          self.fail(stmt, 'message built but never sent')
+        self.pending = [self.message(value), None]
+      elif is_name(target, 'm') and is_method_call(value, 'Msg', 'recv'):
+        self.steps.append(RecvStep(None, None, None, None, []))
+      elif is_ids(target) and tsx_index(value) is not None and self.pending is not None:
+        self.pending[1] = tsx_index(value)
+      elif tsx_index(target) is not None and is_ids(value) and isinstance(last, (SendStep, RecvStep)):
+        self.steps[-1] = last._replace(tsx_out=tsx_index(target))
+      elif isinstance(target, ast.Name) and isinstance(value, ast.Attribute) and \
+        value.attr == 'data' and is_method_call(value.value, 'm', 'eval_path') and \
+        isinstance(last, RecvStep) and len(value.value.args) == 1 and \
+        isinstance(value.value.args[0], ast.Str):
+        last.captures.append((target.id, value.value.args[0].s))
+        self.variables.add(target.id)
+      else:
+        self.fail(stmt, 'unsupported assignment')
+
+    elif isinstance(stmt, ast.Expr) and is_method_call(stmt.value, 'm', 'send'):
+      if self.pending is None:
+        self.fail(stmt, 'no message to send')
+      (m, tsx_in) = self.pending
+      self.pending = None
+      template = TemplateEncoder().encode_msg(m)
+      self.steps.append(SendStep(template, (m.e2e_id, m.h2h_id), tsx_in, None))
+
+    elif isinstance(stmt, ast.Expr) and is_method_call(stmt.value, 'f', 'close'):
+      self.steps.append(CloseStep())
+
+    elif isinstance(stmt, ast.Assert) and isinstance(last, RecvStep):
+      test = stmt.test
+      if isinstance(test, ast.Compare) and is_attr(test.left, 'm', 'code') and \
+        len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq) and \
+        isinstance(test.comparators[0], ast.Num):
+        self.steps[-1] = last._replace(code=test.comparators[0].n)
+      elif is_attr(test, 'm', 'R'):
+        self.steps[-1] = last._replace(R=True)
+      elif isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not) and \
+        is_attr(test.operand, 'm', 'R'):
+        self.steps[-1] = last._replace(R=False)
+      elif isinstance(test, ast.Compare) and tsx_index(test.left) is not None and \
+        len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq) and is_ids(test.comparators[0]):
+        self.steps[-1] = last._replace(tsx_in=tsx_index(test.left))
+      else:
+        self.fail(stmt, 'unsupported assertion')
+
+    else:
+      self.fail(stmt, 'unsupported statement')
+
+class CompiledScenario:
+  '''replays compiled steps over f, like the run function of the scenario.
+It may also be run by the engine, as a coroutine.'''
+  def __init__(self, steps, tsxs, local_hostname=None, local_realm=None):
+    self.steps = steps
+    self.tsxs = tsxs
+    self.local_hostname = local_hostname
+    self.local_realm = local_realm
+
+  def __call__(self, f, args={}):
+    drive(self.coroutine(args), f)
+
+  def coroutine(self, args={}):
+    tsxs = [()] * self.tsxs
+    values = {'local_hostname': self.local_hostname, 'local_realm': self.local_realm}
+    for name in ('session_id', 'imsi'):
+      if name in args:
+        values[name] = args[name]
+
+    for step in self.steps:
+      if isinstance(step, SendStep):
+        if step.tsx_in is not None:
+          (e2e_id, h2h_id) = tsxs[step.tsx_in]
+        else:
+          (e2e_id, h2h_id) = step.ids
+          if h2h_id is None:
+            h2h_id = randint(0, pow(2, 32)-1)
+          if e2e_id is None:
+            e2e_id = randint(0, pow(2, 32)-1)
+        yield Send(build(step.template, values, h2h_id, e2e_id))
+        if step.tsx_out is not None:
+          tsxs[step.tsx_out] = (e2e_id, h2h_id)
+
+      elif isinstance(step, RecvStep):
+        (m, data) = yield Recv(5.0)
+        (flags, code, h2h_id, e2e_id) = unpack('!4xB3s4xLL', data[:20])
+        code = dm.unpack24(code)
+
+        if step.code is not None:
+          assert(code == step.code)
+        if step.R is not None:
+          assert(bool(flags & 0x80) == step.R)
+        if step.tsx_in is not None:
+          assert(tsxs[step.tsx_in] == (e2e_id, h2h_id))
+        if step.tsx_out is not None:
+          tsxs[step.tsx_out] = (e2e_id, h2h_id)
+
+        if step.captures:
+          if m is None:
+            m = dm.Msg.decode(data)
+          for (name, path) in step.captures:
+            values[name] = m.eval_path(path).data
+
+      elif isinstance(step, CloseStep):
+        yield Close()
+
+def compile_scenario(scn):
+  '''returns (steps, transactions count) of a scenario file.'''
+  with open(scn, 'rb') as f:
+    source = f.read()
+  c = Compiler(scn)
+  steps = c.compile(source)
+  return (steps, c.tsxs)
+
+def load_template(tpl, local_hostname, local_realm):
+  with open(tpl, 'rb') as f:
+    (steps, tsxs) = load(f)
+  return CompiledScenario(steps, tsxs, local_hostname, local_realm)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    print >>sys.stderr, 'usage: %s <scenario> <template>' % sys.argv[0]
+    sys.exit(1)
+
+  # pickled steps must refer to this module, not to __main__
+  import scn2tpl
+
+  try:
+    compiled = scn2tpl.compile_scenario(sys.argv[1])
+  except scn2tpl.CompileError as e:
+    print >>sys.stderr, 'could not compile: %s' % e
+    sys.exit(1)
+
+  with open(sys.argv[2], 'wb') as f:
+    dump(compiled, f, HIGHEST_PROTOCOL)
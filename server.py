@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import sys
+import time
+import traceback
+from threading import Thread, Lock, BoundedSemaphore
+from collections import OrderedDict
+
+from scenario import Transcript
+
+class PeerStats(object):
+  '''per peer address counters of sessions run by a server.'''
+  def __init__(self):
+    self.lock = Lock()
+    self.peers = OrderedDict()
+
+  def record(self, peer, duration, exc_info, msgs):
+    with self.lock:
+      if peer not in self.peers:
+        self.peers[peer] = {'sessions': 0, 'failed': 0, 'sent': 0, 'received': 0, 'duration': 0.0}
+      p = self.peers[peer]
+      p['sessions'] += 1
+      if exc_info:
+        p['failed'] += 1
+      p['duration'] += duration
+      # messages may not have been decoded
+      for (m, is_sent) in msgs.entries:
+        if is_sent:
+          p['sent'] += 1
+        else:
+          p['received'] += 1
+
+  def report(self, out=sys.stdout):
+    with self.lock:
+      for (peer, p) in self.peers.items():
+        print >>out, '%s: %d sessions, %d failed, %d sent, %d received, %.3fs per session' % (
+          peer, p['sessions'], p['failed'], p['sent'], p['received'],
+          p['duration'] / p['sessions'])
+
+def serve(srv, tasks, handler, sessions=1, stats=None):
+  '''accepts an association on listening socket srv for each task, and runs
+handler(f, task) over it in its own thread, at most sessions at once.
+handler returns (exc_info, msgs) as dwr_handler does. Associations are
+closed once handled, and recorded under their peer address in stats.
+Returns once all tasks have been handled.'''
+  slots = BoundedSemaphore(sessions)
+  threads = []
+
+  def run(f, peer, task):
+    started = time.time()
+    (exc_info, msgs) = (None, Transcript())
+    try:
+      (exc_info, msgs) = handler(f, task)
+    except Exception:
+      exc_info = traceback.format_exc()
+      print >>sys.stderr, 'session with %s raised: %s' % (peer, exc_info)
+    finally:
+      f.close()
+      if stats is not None:
+        stats.record(peer, time.time() - started, exc_info, msgs)
+      slots.release()
+
+  for task in tasks:
+    slots.acquire()
+    (f, addr) = srv.accept()
+    t = Thread(target=run, args=(f, addr[0], task))
+    t.daemon = True
+    t.start()
+    threads.append(t)
+    threads = [t for t in threads if t.is_alive()]
+
+  for t in threads:
+    t.join()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from collections import OrderedDict, deque
+
+from Pdml import Pdu
+
+def canonical_flow(label):
+  '''(protocol, source, source port, destination, destination port) flow
+label, identical for both directions.'''
+  (proto, a, b) = (label[0], label[1:3], label[3:5])
+  if b < a:
+    (a, b) = (b, a)
+  return (proto,) + a + b
+
+def flow_key(pdu):
+  '''canonical label of the flow of pdu.'''
+  return canonical_flow((pdu.ipprotocol, pdu.ipsrc, pdu.sport, pdu.ipdst, pdu.dport))
+
+def strip(pdu):
+  '''pdu without its dissection, which is cheaper to hand to a worker.'''
+  return Pdu.from_content(pdu.pdml.frm_number, pdu.ipsrc, pdu.ipdst, pdu.ipprotocol,
+    pdu.sport, pdu.dport, pdu.apps, pdu.content)
+
+def demux(pdus, batch=0, window=4096):
+  '''splits a stream of PDUs into (flow key, [(ordinal, pdu), ...]) tasks.
+A task is emitted as soon as a flow has buffered batch PDUs, or once its
+oldest buffered PDU lies window PDUs behind the last one read, so that an
+inactive or long-lived flow does not hold PDUs back, and at most window
+PDUs are buffered. Remaining flows are emitted at the end of the stream.
+A flow may thus be split over several tasks, even when batch is 0.'''
+  # flows are kept in order of their oldest buffered PDU
+  flows = OrderedDict()
+
+  seq = 0
+  for pdu in pdus:
+    key = flow_key(pdu)
+    if key not in flows:
+      flows[key] = []
+    flows[key].append((seq, pdu))
+    seq += 1
+
+    if batch and len(flows[key]) == batch:
+      yield (key, flows.pop(key))
+
+    while flows:
+      (key, task) = next(flows.iteritems())
+      if seq - task[0][0] < window:
+        break
+      yield (key, flows.pop(key))
+
+  for key in flows:
+    yield (key, flows[key])
+
+def map_flows(pdus, func, pool=None, batch=0, pending=64, window=4096):
+  '''applies func to each task built by demux, using pool if given.
+func is given a task, and returns a list of (ordinal, result) pairs.
+Results are yielded in ordinal order, hence in capture order, whatever
+the order of task completion. At most pending tasks are in flight, and
+no task is submitted while more than window results wait for earlier
+ones.'''
+  done = {}
+  next_seq = [0]
+
+  def complete(task, results):
+    for (seq, pdu) in task[1]:
+      done.setdefault(seq, [])
+    for (seq, r) in results:
+      done[seq].append(r)
+
+    out = []
+    while next_seq[0] in done:
+      out.extend(done.pop(next_seq[0]))
+      next_seq[0] += 1
+    return out
+
+  tasks = demux(pdus, batch, window)
+
+  if pool is None:
+    for task in tasks:
+      for r in complete(task, func(task)):
+        yield r
+    return
+
+  inflight = deque()
+  for task in tasks:
+    inflight.append((task, pool.apply_async(func, (task,))))
+
+    while inflight and (len(inflight) >= pending or len(done) > window or inflight[0][1].ready()):
+      (t, ar) = inflight.popleft()
+      for r in complete(t, ar.get()):
+        yield r
+
+  while inflight:
+    (t, ar) = inflight.popleft()
+    for r in complete(t, ar.get()):
+      yield r
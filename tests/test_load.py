@@ -0,0 +1,65 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from engine import CoroutineScenario, Send, Request
+from load import Substitutions, parse_range, arrival_time
+
+import unittest
+
+def air():
+  return dm.Msg(code=318, R=True, app_id=16777251, avps=[
+    dm.Avp(code=263, M=True, vendor=0, data='host;1;1'),
+    dm.Avp(code=1, M=True, vendor=0, data='208010000000001'),
+    dm.Avp(code=443, M=True, vendor=0, avps=[
+      dm.Avp(code=450, M=True, vendor=0, u32=1),
+      dm.Avp(code=444, M=True, vendor=0, data='208010000000001'),
+    ]),
+    dm.Avp(code=443, M=True, vendor=0, avps=[
+      dm.Avp(code=450, M=True, vendor=0, u32=0),
+      dm.Avp(code=444, M=True, vendor=0, data='33600000000'),
+    ]),
+  ])
+
+def run(peer, args={}):
+  yield peer.send(air())
+  yield peer.request(air())
+
+class SubstitutionsTest(unittest.TestCase):
+  def test_range(self):
+    self.assertEqual(parse_range('001-100'), ('001', 100))
+
+  def test_args(self):
+    subs = Substitutions('host', parse_range('0098-0101'))
+    args = [subs.args(n) for n in range(5)]
+    self.assertEqual([a['imsi'] for a in args], ['0098', '0099', '0100', '0101', '0098'])
+    self.assertEqual(len(set([a['session_id'] for a in args])), 5)
+    self.assertNotIn('imsi', Substitutions('host').args(0))
+
+  def test_arrival(self):
+    self.assertEqual([arrival_time(n, 10) for n in (0, 5, 10)], [0, 0.5, 1.0])
+    # half as many scenarios are started during ramp up
+    self.assertAlmostEqual(arrival_time(50, 10, 10), 10.0)
+
+  def test_coroutine(self):
+    args = {'session_id': 'host;2;7', 'imsi': '208019999999999'}
+    c = CoroutineScenario(run).coroutine(args)
+    for (action, kind) in ((c.next(), Send), (c.send(None), Request)):
+      self.assertIsInstance(action, kind)
+      m = action.msg
+      self.assertEqual(m.avps[0].data, 'host;2;7')
+      self.assertEqual(m.avps[1].data, '208019999999999')
+      self.assertEqual(m.avps[2].avps[1].data, '208019999999999')
+      self.assertEqual(m.avps[3].avps[1].data, '33600000000')
+      self.assertEqual(dm.Msg.decode(m.encode()).avps[1].data, '208019999999999')
+
+  def test_no_args(self):
+    m = CoroutineScenario(run).coroutine().next().msg
+    self.assertEqual(m.avps[0].data, 'host;1;1')
+    self.assertEqual(m.avps[1].data, '208010000000001')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,194 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from Native import NativeLoader, TcpStream, TsnWindow, DLT_EN10MB, DLT_LINUX_SLL, DLT_RAW
+
+from struct import pack
+from socket import inet_aton
+from tempfile import mkstemp
+import os
+import unittest
+
+(CLIENT, SERVER) = ('10.0.0.1', '10.0.0.2')
+
+def diameter(h2h_id, size=0):
+  return dm.Msg(code=280, R=True, h2h_id=h2h_id, e2e_id=h2h_id, avps=[
+    dm.Avp(code=264, M=True, data='client'),
+    dm.Avp(code=296, M=True, data='realm' + 'x'*size)]).encode()
+
+def ipv4(proto, payload, ident=1, frag=0, total=None, src=CLIENT, dst=SERVER):
+  if total is None:
+    total = 20 + len(payload)
+  return pack('!BBHHHBBH4s4s', 0x45, 0, total, ident, frag, 64, proto, 0,
+    inet_aton(src), inet_aton(dst)) + payload
+
+def tcp(seq, payload, sport=40000, dport=3868, syn=False):
+  return pack('!HHLLBBHHH', sport, dport, seq, 0, 5 << 4, 0x02 if syn else 0x18, 65535, 0, 0) + payload
+
+def sctp(chunks, sport=40000, dport=3868):
+  return pack('!HHLL', sport, dport, 1, 0) + ''.join(chunks)
+
+def data_chunk(tsn, payload, begin=True, end=True, ppid=46):
+  flags = (0x02 if begin else 0) | (0x01 if end else 0)
+  chunk = pack('!BBHLHHL', 0, flags, 16 + len(payload), tsn, 0, 0, ppid) + payload
+  return chunk + '\x00' * (-len(chunk) % 4)
+
+def ethernet(packet):
+  return '\x00' * 12 + '\x08\x00' + packet
+
+def sll(packet):
+  return '\x00' * 14 + '\x08\x00' + packet
+
+def pcap(dlt, frames):
+  b = pack('<LHHLLLL', 0xa1b2c3d4, 2, 4, 0, 0, 65535, dlt)
+  for (i, frame) in enumerate(frames):
+    b += pack('<LLLL', i, 0, len(frame), len(frame)) + frame
+  return b
+
+class NativeTest(unittest.TestCase):
+  def setUp(self):
+    self.names = []
+
+  def tearDown(self):
+    for name in self.names:
+      os.unlink(name)
+
+  def extract(self, dlt, frames, **kwargs):
+    (fd, name) = mkstemp(suffix='.pcap')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(pcap(dlt, frames))
+    self.names.append(name)
+    return [(pdu.pdml.frm_number, pdu.content) for pdu in NativeLoader(name, **kwargs).pdus]
+
+  def test_link_types(self):
+    m = diameter(1)
+    packet = ipv4(6, tcp(1000, m))
+    for (dlt, frame) in ((DLT_EN10MB, ethernet(packet)), (DLT_LINUX_SLL, sll(packet)), (DLT_RAW, packet)):
+      self.assertEqual(self.extract(dlt, [frame]), [(1, m)])
+
+  def test_several_per_segment(self):
+    (m1, m2) = (diameter(1), diameter(2))
+    self.assertEqual(self.extract(DLT_RAW, [ipv4(6, tcp(0, m1 + m2))]), [(1, m1), (1, m2)])
+
+  def test_other_ports(self):
+    self.assertEqual(self.extract(DLT_RAW, [ipv4(6, tcp(0, diameter(1), sport=1, dport=2))]), [])
+
+  def test_tcp_reordering(self):
+    m = diameter(1, 100)
+    (a, b, c) = (m[:30], m[30:80], m[80:])
+    frames = [
+      ipv4(6, tcp(99, '', syn=True)),
+      ipv4(6, tcp(100 + len(a) + len(b), c)),
+      ipv4(6, tcp(100, a)),
+      ipv4(6, tcp(100, a)),
+      ipv4(6, tcp(100 + len(a), b)),
+    ]
+    self.assertEqual(self.extract(DLT_RAW, frames), [(5, m)])
+
+  def test_tcp_lost_segment(self):
+    msgs = [diameter(i, i % 7) for i in range(1, 301)]
+    (frames, seq) = ([], 0)
+    for m in msgs:
+      if m is not msgs[1]:
+        frames.append(ipv4(6, tcp(seq, m)))
+      seq += len(m)
+    contents = [content for (number, content) in self.extract(DLT_RAW, frames)]
+    self.assertEqual(contents, msgs[:1] + msgs[2:])
+
+  def test_tcp_resync(self):
+    (m1, m2, m3) = (diameter(1), diameter(2, 10), diameter(3))
+    # the end of m2 is lost, its beginning is dropped with the hole
+    frames = [ipv4(6, tcp(0, m1 + m2[:10]))]
+    for i in range(300):
+      frames.append(ipv4(6, tcp(len(m1) + len(m2) + i * len(m3), m3)))
+    contents = [content for (number, content) in self.extract(DLT_RAW, frames)]
+    self.assertEqual(contents, [m1] + [m3] * 300)
+
+  def test_ip_fragments(self):
+    m = diameter(1, 100)
+    segment = tcp(0, m)
+    (first, last) = (segment[:64], segment[64:])
+    frames = [
+      ipv4(6, last, ident=7, frag=64 / 8),
+      ipv4(6, first, ident=7, frag=0x2000),
+    ]
+    self.assertEqual(self.extract(DLT_RAW, frames), [(2, m)])
+
+  def test_ip_fragments_expire(self):
+    (m1, m2) = (diameter(1, 100), diameter(2, 100))
+    (s1, s2) = (tcp(0, m1), tcp(len(m1), m2))
+    frames = [ipv4(6, s1[:64], ident=7, frag=0x2000)]
+    frames += [ipv4(6, tcp(0, ''), ident=i) for i in range(8, 12)]
+    frames += [ipv4(6, s2[64:], ident=7, frag=64 / 8), ipv4(6, s2[:64], ident=7, frag=0x2000)]
+    # the first datagram is evicted before its last fragment, of the same ident, is seen
+    self.assertEqual(self.extract(DLT_RAW, frames, fragments_window=4), [])
+    self.assertEqual(self.extract(DLT_RAW, frames, fragments_window=5), [(6, m1)])
+
+  def test_offloaded_length(self):
+    m = diameter(1)
+    self.assertEqual(self.extract(DLT_RAW, [ipv4(6, tcp(0, m), total=0)]), [(1, m)])
+
+  def test_sctp_reassembly(self):
+    (m1, m2) = (diameter(1, 100), diameter(2))
+    frames = [
+      ipv4(132, sctp([data_chunk(10, m1[:40], end=False)])),
+      ipv4(132, sctp([data_chunk(10, m1[:40], end=False)])),
+      ipv4(132, sctp([data_chunk(11, m1[40:], begin=False), data_chunk(12, m2)])),
+      ipv4(132, sctp([data_chunk(12, m2)])),
+    ]
+    self.assertEqual(self.extract(DLT_RAW, frames), [(3, m1), (3, m2)])
+
+  def test_sctp_ppid(self):
+    m = diameter(1)
+    frames = [
+      ipv4(132, sctp([data_chunk(1, m, ppid=0)], sport=1, dport=2)),
+      ipv4(132, sctp([data_chunk(2, m)], sport=1, dport=2)),
+    ]
+    self.assertEqual(self.extract(DLT_RAW, frames), [(2, m)])
+
+class TcpStreamTest(unittest.TestCase):
+  def test_gap(self):
+    stream = TcpStream(segments=2, size=1000)
+    self.assertEqual(stream.add(0, False, 'abc'), 'abc')
+    # bytes 3 to 5 are never seen
+    self.assertEqual([stream.add(seq, False, data) for (seq, data) in ((6, 'gh'), (8, 'ij'))], ['', ''])
+    self.assertEqual(stream.gaps, 0)
+    self.assertEqual(stream.add(10, False, 'kl'), 'ghijkl')
+    self.assertEqual((stream.gaps, stream.pending, stream.next_seq), (1, {}, 12))
+    self.assertEqual(stream.add(3, False, 'def'), '')
+    self.assertEqual(stream.add(12, False, 'm'), 'm')
+
+  def test_size(self):
+    stream = TcpStream(segments=100, size=10)
+    stream.add(0, False, 'a')
+    self.assertEqual([stream.add(seq, False, 'x' * 4) for seq in (2, 10, 6)], ['', '', 'x' * 12])
+    self.assertEqual(stream.gaps, 1)
+
+class TsnWindowTest(unittest.TestCase):
+  def test_duplicates(self):
+    tsns = TsnWindow()
+    self.assertEqual([tsns.add(t) for t in (5, 7, 6, 7, 5, 8)], [True, True, True, False, False, True])
+    self.assertEqual((tsns.cumulative, tsns.above), (8, set()))
+
+  def test_wrap(self):
+    tsns = TsnWindow()
+    for t in (0xfffffffe, 0xffffffff, 0, 1):
+      self.assertTrue(tsns.add(t))
+    self.assertFalse(tsns.add(0xffffffff))
+    self.assertEqual(tsns.cumulative, 1)
+
+  def test_bounded(self):
+    tsns = TsnWindow(window=16)
+    # TSN 1 is never seen
+    tsns.add(0)
+    for t in range(2, 1000):
+      self.assertTrue(tsns.add(t))
+      self.assertLessEqual(len(tsns.above), 16)
+    self.assertEqual((tsns.cumulative, tsns.above), (999, set()))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from Dia import Directory
+from mutate import Mutation
+from oracle import Oracle, Verdict, judge, DIAMETER_SUCCESS, \
+  DIAMETER_MISSING_AVP, DIAMETER_INVALID_AVP_LENGTH
+
+from socket import inet_aton
+import unittest
+
+def cer(avps=None):
+  m = dm.Msg(code=257, R=True, h2h_id=1, e2e_id=2, avps=[
+    dm.Avp(code=264, M=True, data='client'),
+    dm.Avp(code=296, M=True, data='realm'),
+    dm.Avp(code=257, M=True, data='\x00\x01' + inet_aton('127.0.0.1')),
+    dm.Avp(code=266, M=True, u32=0),
+    dm.Avp(code=269, data='diafuzzer'),
+  ] if avps is None else avps)
+  Directory.tag(m)
+  return m
+
+def cea(result_code):
+  return dm.Msg(code=257, h2h_id=1, e2e_id=2, avps=[dm.Avp(code=268, M=True, u32=result_code)])
+
+class OracleTest(unittest.TestCase):
+  def setUp(self):
+    self.msg = cer()
+    self.oracle = Oracle(self.msg)
+    self.address = self.msg.compute_path(self.msg.avps[2])
+
+  def test_conformant_value(self):
+    v = self.oracle.predict(Mutation('set_value', self.address, '\x00\x01' + inet_aton('10.0.0.1')))
+    self.assertEqual(v, Verdict([], (DIAMETER_SUCCESS,)))
+    self.assertIsNone(judge(v, cea(2001)))
+
+  def test_absent(self):
+    v = self.oracle.predict(Mutation('absent', self.address, None))
+    self.assertEqual(v.result_codes, (DIAMETER_MISSING_AVP,))
+    self.assertIsNone(judge(v, cea(DIAMETER_MISSING_AVP)))
+    self.assertIsNotNone(judge(v, None))
+
+  def test_truncated_address(self):
+    # such an AVP does not even repr
+    v = self.oracle.predict(Mutation('set_value', self.address, '\x00'))
+    self.assertEqual(v.result_codes, (DIAMETER_INVALID_AVP_LENGTH,))
+    self.assertIsNone(judge(v, cea(DIAMETER_INVALID_AVP_LENGTH)))
+    mismatch = judge(v, cea(2001))
+    self.assertIn('Host-IP-Address', mismatch)
+    self.assertIn('ExpectedLengthViolation', mismatch)
+
+  def test_non_conformant_baseline(self):
+    msg = cer(self.msg.avps[:2] + self.msg.avps[3:])
+    v = Oracle(msg).predict(Mutation('absent', msg.compute_path(msg.avps[0]), None))
+    self.assertEqual(v, Verdict(None, None))
+    self.assertIsNone(judge(v, cea(2001)))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from pcap2conform import run_batch
+from Native import DLT_RAW
+from tests.test_native import diameter, ipv4, tcp, pcap
+
+from argparse import Namespace
+from tempfile import mkdtemp
+import shutil
+import json
+import os
+import unittest
+
+class BatchTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = mkdtemp()
+    self.pcaps = []
+    for (name, content) in (('a.pcap', None), ('bad.pcap', 'garbage'), ('b.pcap', None)):
+      path = os.path.join(self.directory, name)
+      if content is None:
+        m = diameter(1)
+        content = pcap(DLT_RAW, [ipv4(6, tcp(i * len(m), m)) for i in range(7)])
+      with open(path, 'wb') as f:
+        f.write(content)
+      self.pcaps.append(path)
+    self.pcaps.append(os.path.join(self.directory, 'missing.pcap'))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_batch(self, **kwargs):
+    args = Namespace(jobs=1, chunk=0, by_flow=False, native=True, pcaps=self.pcaps,
+      output=os.path.join(self.directory, 'violations.json'),
+      report=os.path.join(self.directory, 'report.json'))
+    for (k, v) in kwargs.items():
+      setattr(args, k, v)
+    run_batch(args)
+
+    with open(args.report) as f:
+      report = json.load(f)
+    with open(args.output) as f:
+      records = [json.loads(l) for l in f]
+    return (report, records)
+
+  def test_errors(self):
+    for kwargs in ({}, {'jobs': 2}, {'jobs': 2, 'chunk': 3}, {'by_flow': True}, {'jobs': 2, 'by_flow': True, 'chunk': 2}):
+      (report, records) = self.run_batch(**kwargs)
+      self.assertEqual((report['pcaps'], report['pdus'], report['errors']), (4, 14, 2))
+      failed = [r['pcap'] for r in records if 'error' in r]
+      self.assertEqual(failed, self.pcaps[1:2] + self.pcaps[3:])
+      self.assertEqual(report['violations'], len(records) - 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from pcap2scn import MsgIndex
+
+import unittest
+
+class MsgIndexTest(unittest.TestCase):
+  def test_unbounded(self):
+    index = MsgIndex()
+    for n in range(100):
+      index.add(n, [('k', n), (n, 'loc')])
+    self.assertEqual(index.lookup('k'), (0, 0))
+    self.assertEqual(index.lookup(0), (0, 'loc'))
+    self.assertIsNone(index.lookup('missing'))
+
+  def test_first_location(self):
+    index = MsgIndex(1)
+    index.add('m', [('k', '/a'), ('k', '/b'), ('j', '/c')])
+    self.assertEqual(index.lookup('k'), ('m', '/a'))
+    # one entry per message, which the window evicts at once
+    index.add('n', [('x', '/d')])
+    self.assertIsNone(index.lookup('k'))
+    self.assertIsNone(index.lookup('j'))
+    self.assertEqual(index.entries.keys(), ['x'])
+
+  def test_window(self):
+    index = MsgIndex(3)
+    for m in 'abcdef':
+      index.add(m, [('shared', m), (m, m)])
+      if m in 'ab':
+        index.add(m + '2', [])
+    # messages indexed under no key count in the window too
+    self.assertEqual(index.lookup('shared'), ('d', 'd'))
+    self.assertEqual([index.lookup(m) for m in 'abcdef'], [None] * 3 + [(m, m) for m in 'def'])
+    self.assertEqual(len(index.recent), 3)
+    self.assertEqual(sorted(index.entries), sorted(['shared', 'd', 'e', 'f']))
+    self.assertEqual(len(index.entries['shared']), 3)
+
+if __name__ == '__main__':
+  unittest.main()
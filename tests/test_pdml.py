@@ -0,0 +1,110 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from Pdml import PcapLoader, Pdu
+
+from struct import pack
+from tempfile import mkstemp
+from random import Random
+import os
+import unittest
+
+FRAMES = [(1, 500000, 'abcd', 4), (2, 999999, 'ef', 1514), (3, 0, '', 60)]
+
+def pcap(byteorder, magic, frames, dlt=1):
+  b = pack(byteorder + 'LHHLLLL', magic, 2, 4, 0, 0, 65535, dlt)
+  for (sec, frac, data, l) in frames:
+    b += pack(byteorder + 'LLLL', sec, frac, len(data), l) + data
+  return b
+
+class PcapLoaderTest(unittest.TestCase):
+  def setUp(self):
+    self.names = []
+
+  def tearDown(self):
+    for name in self.names:
+      os.unlink(name)
+
+  def load(self, content):
+    (fd, name) = mkstemp(suffix='.pcap')
+    self.names.append(name)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(content)
+    return PcapLoader(name)
+
+  def test_magics(self):
+    for (byteorder, magic, resolution) in (('<', 0xa1b2c3d4, 0.000001), ('>', 0xa1b2c3d4, 0.000001),
+        ('<', 0xa1b23c4d, 0.000000001), ('>', 0xa1b23c4d, 0.000000001)):
+      pl = self.load(pcap(byteorder, magic, FRAMES, dlt=113))
+      self.assertEqual((pl.maj, pl.min, pl.snaplen, pl.dlt), (2, 4, 65535, 113))
+      self.assertEqual(len(pl.frames), len(FRAMES))
+      for (frame, (sec, frac, data, l)) in zip(pl.frames, FRAMES):
+        self.assertAlmostEqual(frame['ts'], sec + frac*resolution, places=9)
+        self.assertEqual((frame['caplen'], frame['len']), (len(data), l))
+        self.assertIsInstance(frame['bytes'], buffer)
+        self.assertEqual(str(frame['bytes']), data)
+      self.assertEqual(str(pl.frames[-2]['bytes']), 'ef')
+
+  def test_empty(self):
+    self.assertEqual(len(self.load(pcap('<', 0xa1b2c3d4, [])).frames), 0)
+
+  def test_invalid(self):
+    self.assertRaises(SystemExit, self.load, pack('<L', 0x0a0d0d0a) + '\x00' * 20)
+    b = pcap('<', 0xa1b2c3d4, FRAMES)
+    self.assertRaises(AssertionError, self.load, b[:-1])
+    self.assertRaises(AssertionError, self.load, b[:30])
+
+class Field(object):
+  def __init__(self, pos, size):
+    (self.pos, self.size) = (pos, size)
+
+  def __repr__(self):
+    return '<%d+%d>' % (self.pos, self.size)
+
+def owned_bytes(fields, length):
+  '''reference ownership: one owner per byte, the last covering field.'''
+  owners = [None] * length
+  for fld in fields:
+    for i in range(fld.pos, min(fld.pos + fld.size, length)):
+      owners[i] = fld
+  return owners
+
+class OwnedIntervalsTest(unittest.TestCase):
+  def check(self, fields, length):
+    runs = Pdu.owned_intervals(fields, length)
+    owners = []
+    for (s, e, owner) in runs:
+      self.assertEqual(s, len(owners))
+      self.assertLessEqual(s, e)
+      owners.extend([owner] * (e - s + 1))
+    self.assertEqual(owners, owned_bytes(fields, length))
+    # runs are maximal
+    for (a, b) in zip(runs, runs[1:]):
+      self.assertIsNot(a[2], b[2])
+    return runs
+
+  def test_nested(self):
+    (msg, avp, data) = (Field(0, 20), Field(4, 8), Field(8, 4))
+    runs = self.check([msg, avp, data], 20)
+    self.assertEqual(runs, [(0, 3, msg), (4, 7, avp), (8, 11, data), (12, 19, msg)])
+    # an enclosing field listed last owns all its bytes
+    self.assertEqual(self.check([avp, data, msg], 20), [(0, 19, msg)])
+
+  def test_uncovered(self):
+    (a, b) = (Field(2, 3), Field(8, 10))
+    self.assertEqual(self.check([a, b], 12), [(0, 1, None), (2, 4, a), (5, 7, None), (8, 11, b)])
+    self.assertEqual(self.check([Field(3, 0), Field(15, 2)], 12), [(0, 11, None)])
+    self.assertEqual(self.check([], 5), [(0, 4, None)])
+
+  def test_sweep(self):
+    r = Random(34)
+    for n in range(200):
+      length = r.randint(1, 64)
+      fields = [Field(r.randint(0, length + 4), r.randint(0, 24)) for i in range(r.randint(0, 12))]
+      self.check(fields, length)
+
+if __name__ == '__main__':
+  unittest.main()
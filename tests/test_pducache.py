@@ -0,0 +1,119 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import pducache
+import Native
+from pducache import PduCache, CachedLoader
+from Native import DLT_RAW
+from tests.test_native import diameter, ipv4, tcp, pcap
+
+from tempfile import mkdtemp
+import shutil
+import os
+import unittest
+
+class PduCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = mkdtemp()
+    self.cache = PduCache(os.path.join(self.directory, 'cache'))
+    self.pcap = os.path.join(self.directory, 'test.pcap')
+    self.msgs = [diameter(i) for i in range(1, 4)]
+    with open(self.pcap, 'wb') as f:
+      f.write(pcap(DLT_RAW, [ipv4(6, tcp(sum([len(prev) for prev in self.msgs[:i]]), m)) for (i, m) in enumerate(self.msgs)]))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def extract(self):
+    c = CachedLoader(self.pcap, native=True, cache=self.cache)
+    return [(pdu.pdml.frm_number, pdu.content) for pdu in c.pdus]
+
+  def entry(self):
+    return self.cache.path(self.pcap, CachedLoader(self.pcap, native=True, streaming=True).extractor())
+
+  def test_hit(self):
+    expected = [(i + 1, m) for (i, m) in enumerate(self.msgs)]
+    self.assertEqual(self.extract(), expected)
+    self.assertIsNotNone(self.cache.lookup(self.entry()))
+    self.assertEqual(self.extract(), expected)
+
+  def test_version(self):
+    expected = self.extract()
+    path = self.entry()
+    version = Native.VERSION
+    Native.VERSION += 1
+    try:
+      self.assertNotEqual(self.entry(), path)
+      self.assertIsNone(self.cache.lookup(self.entry()))
+      self.assertEqual(self.extract(), expected)
+      self.assertIsNotNone(self.cache.lookup(self.entry()))
+    finally:
+      Native.VERSION = version
+
+  def test_truncated(self):
+    expected = self.extract()
+    path = self.entry()
+    for size in (os.path.getsize(path) - 1, len(pducache.MAGIC) + 3):
+      with open(path, 'r+b') as f:
+        f.truncate(size)
+      self.assertEqual(self.extract(), expected)
+      # the entry was rebuilt
+      self.assertEqual(self.extract(), expected)
+
+  def test_unwritable(self):
+    expected = [(i + 1, m) for (i, m) in enumerate(self.msgs)]
+    # the cache directory cannot be created under a file
+    self.cache = PduCache(os.path.join(self.pcap, 'cache'))
+    self.assertEqual(self.extract(), expected)
+    self.assertEqual(self.extract(), expected)
+
+  def test_write_error(self):
+    def encode_pdu(pdu):
+      raise IOError(28, 'No space left on device')
+    encode = pducache.encode_pdu
+    pducache.encode_pdu = encode_pdu
+    try:
+      self.assertEqual([n for (n, content) in self.extract()], [1, 2, 3])
+    finally:
+      pducache.encode_pdu = encode
+    self.assertIsNone(self.cache.lookup(self.entry()))
+    self.assertEqual([n for n in os.listdir(self.cache.directory) if n.endswith('.tmp')], [])
+
+  def test_concurrent_evict(self):
+    self.extract()
+    names = os.listdir(self.cache.directory)
+    # entries listed, then removed by another process
+    listdir = os.listdir
+    os.listdir = lambda d: names + ['gone.pdus', 'gone.digest']
+    try:
+      self.cache.max_size = 0
+      self.cache.evict()
+    finally:
+      os.listdir = listdir
+    self.assertEqual(os.listdir(self.cache.directory), [])
+    self.cache.evict()
+
+  def test_digest(self):
+    calls = []
+    def file_digest(name):
+      calls.append(name)
+      return digest(name)
+    digest = pducache.file_digest
+    pducache.file_digest = file_digest
+    try:
+      d = self.cache.digest(self.pcap)
+      self.assertEqual(self.cache.digest(self.pcap), d)
+      self.assertEqual(len(calls), 1)
+
+      with open(self.pcap, 'ab') as f:
+        f.write(ipv4(6, tcp(0, diameter(4))))
+      self.assertNotEqual(self.cache.digest(self.pcap), d)
+      self.assertEqual(len(calls), 2)
+    finally:
+      pducache.file_digest = digest
+
+if __name__ == '__main__':
+  unittest.main()
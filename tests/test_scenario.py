@@ -0,0 +1,147 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from mutate import MsgAnchor, MutateScenario, MessageTooBig
+from scenario import Channel, Disconnected, dwr_handler, dwa, frames, HEADER
+
+import socket as sk
+import threading
+import os
+import unittest
+
+def closed(fd):
+  try:
+    os.fstat(fd)
+  except OSError:
+    return True
+  return False
+
+def dwr(h2h_id, e2e_id):
+  return dm.Msg(code=280, R=True, h2h_id=h2h_id, e2e_id=e2e_id, avps=[
+    dm.Avp(code=264, M=True, data='peer'),
+    dm.Avp(code=296, M=True, data='realm')]).encode()
+
+class ChannelTest(unittest.TestCase):
+  def test_transfer(self):
+    (a, b) = Channel.pair()
+    a.put(None, 'data')
+    self.assertEqual(b.get(), (None, 'data'))
+    a.close()
+    b.close()
+
+  def test_close_signals_peer(self):
+    (a, b) = Channel.pair()
+    a.close()
+    self.assertRaises(Disconnected, b.get)
+    self.assertRaises(Disconnected, b.put, None, 'data')
+    self.assertFalse(closed(b.rfd))
+    b.close()
+
+  def test_close_last_end(self):
+    (a, b) = Channel.pair()
+    fds = (a.rfd, a.wfd, b.rfd, b.wfd)
+    a.close()
+    a.close()
+    self.assertFalse(any(closed(fd) for fd in fds))
+    b.close()
+    self.assertTrue(all(closed(fd) for fd in fds))
+
+  def test_timeout(self):
+    (a, b) = Channel.pair()
+    b.settimeout(0.01)
+    self.assertRaises(sk.timeout, b.get)
+    a.close()
+    b.close()
+
+class TooBig(MutateScenario):
+  def __init__(self):
+    MutateScenario.__init__(self, MsgAnchor(0, 280, True), 'too big')
+    self.act = lambda self, msg: self.fail()
+
+  def fail(self):
+    raise MessageTooBig()
+
+class DwrHandlerTest(unittest.TestCase):
+  def setUp(self):
+    (self.f, self.peer) = sk.socketpair(sk.AF_UNIX, sk.SOCK_STREAM)
+
+  def tearDown(self):
+    self.f.close()
+    self.peer.close()
+
+  def test_message_too_big(self):
+    plugs = []
+    threads = []
+    def scenario(c):
+      plugs.append(c)
+      threads.append(threading.current_thread())
+      c.put(None, dwr(1, 1))
+      c.get()
+
+    (exc_info, msgs) = dwr_handler(scenario, self.f, 'host', 'realm', mutator=TooBig())
+    self.assertEqual(exc_info, 'MessageTooBig')
+    self.assertEqual(len(msgs), 1)
+    self.assertFalse(threads[0].is_alive())
+    c = plugs[0]
+    self.assertTrue(all(closed(fd) for fd in (c.rfd, c.wfd, c.peer.rfd, c.peer.wfd)))
+
+class PipelinedTest(unittest.TestCase):
+  '''a peer answering requests 3 and 4 in a single write, along with DWR 5,
+after sending DWR 1 and 2.'''
+  def setUp(self):
+    (self.f, self.peer) = sk.socketpair(sk.AF_UNIX, sk.SOCK_STREAM)
+    self.received = []
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.start()
+
+  def tearDown(self):
+    self.thread.join()
+    self.f.close()
+    self.peer.close()
+
+  def serve(self):
+    self.peer.sendall(dwr(1, 10) + dwr(2, 20))
+    rbuf = ''
+    while len(self.received) < 5:
+      b = self.peer.recv(65536)
+      if len(b) == 0:
+        return
+      (msgs, rbuf) = frames(rbuf + b)
+      for data in msgs:
+        (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(data)
+        self.received.append((bool(flags & 0x80), h2h_id))
+      if sorted(self.received) == [(False, 1), (False, 2), (True, 3), (True, 4)]:
+        self.peer.sendall(dwa('peer', 'realm', 3, 30) + dwr(5, 50) + dwa('peer', 'realm', 4, 40))
+
+  def test_answers(self):
+    def scenario(c):
+      c.put(None, dwr(3, 30))
+      c.put(None, dwr(4, 40))
+      answers = [HEADER.unpack_from(c.get()[1])[2:] for i in range(2)]
+      assert(answers == [(3, 30), (4, 40)])
+
+    (exc_info, msgs) = dwr_handler(scenario, self.f, 'host', 'realm')
+    self.assertIsNone(exc_info)
+    self.assertEqual([(m.R, m.h2h_id, is_sent) for (m, is_sent) in msgs],
+      [(True, 3, True), (True, 4, True), (False, 3, False), (False, 4, False)])
+    self.thread.join()
+    self.assertEqual(sorted(self.received), [(False, 1), (False, 2), (False, 5), (True, 3), (True, 4)])
+
+  def test_scenario_ends_first(self):
+    # the answer to 4 is still buffered when the scenario ends
+    def scenario(c):
+      c.put(None, dwr(3, 30))
+      c.put(None, dwr(4, 40))
+      c.get()
+
+    (exc_info, msgs) = dwr_handler(scenario, self.f, 'host', 'realm')
+    self.assertIsNone(exc_info)
+    self.assertEqual([(m.R, m.h2h_id) for (m, is_sent) in msgs][:3], [(True, 3), (True, 4), (False, 3)])
+    self.peer.shutdown(sk.SHUT_RDWR)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,131 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from engine import Send, Recv, Close
+from scn2tpl import Compiler, CompiledScenario, CompileError, substitute
+from scenario import set_ids, HEADER
+
+import unittest
+
+SCENARIO = '''def run(f, args={}):
+  tsxs = [()]*1
+
+  m = Msg(R=True, code=318, app_id=16777251, avps=[
+    Avp(code=263, M=True, vendor=0, data='mme.example;1;1'),
+    Avp(code=264, M=True, vendor=0, data=local_hostname),
+    Avp(code=296, M=True, vendor=0, data=local_realm),
+    Avp(code=1, M=True, vendor=0, data='20801000000001'),
+    Avp(code=443, M=True, vendor=0, avps=[
+      Avp(code=450, M=True, vendor=0, u32=1),
+      Avp(code=444, M=True, vendor=0, data='208010000000001'),
+    ]),
+  ])
+  m.send(f)
+  tsxs[0] = (m.e2e_id, m.h2h_id)
+
+  m = Msg.recv(f)
+  assert(m.code == 318)
+  assert(not m.R)
+  assert(tsxs[0] == (m.e2e_id, m.h2h_id))
+  origin_host = m.eval_path('/code=264').data
+
+  m = Msg(R=True, code=321, app_id=16777251, avps=[
+    Avp(code=263, M=True, vendor=0, data='mme.example;1;1'),
+    Avp(code=293, M=True, vendor=0, data=origin_host),
+  ])
+  m.send(f)
+
+  f.close()
+'''
+
+def air(local_hostname, local_realm):
+  return dm.Msg(R=True, code=318, app_id=16777251, avps=[
+    dm.Avp(code=263, M=True, vendor=0, data='mme.example;1;1'),
+    dm.Avp(code=264, M=True, vendor=0, data=local_hostname),
+    dm.Avp(code=296, M=True, vendor=0, data=local_realm),
+    dm.Avp(code=1, M=True, vendor=0, data='20801000000001'),
+    dm.Avp(code=443, M=True, vendor=0, avps=[
+      dm.Avp(code=450, M=True, vendor=0, u32=1),
+      dm.Avp(code=444, M=True, vendor=0, data='208010000000001'),
+    ]),
+  ])
+
+def pur(origin_host):
+  return dm.Msg(R=True, code=321, app_id=16777251, avps=[
+    dm.Avp(code=263, M=True, vendor=0, data='mme.example;1;1'),
+    dm.Avp(code=293, M=True, vendor=0, data=origin_host),
+  ])
+
+def aia(origin_host):
+  return dm.Msg(R=False, code=318, app_id=16777251, h2h_id=1, e2e_id=1, avps=[
+    dm.Avp(code=264, M=True, vendor=0, data=origin_host),
+    dm.Avp(code=268, M=True, vendor=0, u32=2001),
+  ]).encode()
+
+def expected(m, data, args):
+  '''encoding of m, with identifiers of data, and overridden by args.'''
+  (flags, code, m.h2h_id, m.e2e_id) = HEADER.unpack_from(data)
+  substitute(m, args)
+  return m.encode()
+
+class TemplateTest(unittest.TestCase):
+  def setUp(self):
+    c = Compiler('test.scn')
+    steps = c.compile(SCENARIO)
+    self.scenario = CompiledScenario(steps, c.tsxs, 'hss.example', 'example')
+
+  def run_scenario(self, args, origin_host):
+    '''messages sent by the template, the answer coming from origin_host.'''
+    sent = []
+    c = self.scenario.coroutine(args)
+    action = c.next()
+    while not isinstance(action, Close):
+      if isinstance(action, Send):
+        sent.append(action.msg)
+        action = c.send(None)
+      else:
+        self.assertIsInstance(action, Recv)
+        (flags, code, h2h_id, e2e_id) = HEADER.unpack_from(sent[0])
+        action = c.send((None, set_ids(aia(origin_host), h2h_id, e2e_id)))
+    return sent
+
+  def check(self, args, origin_host):
+    sent = self.run_scenario(args, origin_host)
+    self.assertEqual(len(sent), 2)
+    self.assertEqual(sent[0], expected(air('hss.example', 'example'), sent[0], args))
+    self.assertEqual(sent[1], expected(pur(origin_host), sent[1], args))
+    for data in sent:
+      self.assertEqual(dm.Msg.decode(data).encode(), data)
+    return [dm.Msg.decode(data) for data in sent]
+
+  def test_defaults(self):
+    self.check({}, 'hss1.example')
+
+  def test_overrides(self):
+    for session_id in ('x', 'mme.example;1;12345', 'a' * 301):
+      for imsi in ('20801999999999', '208019999999999'):
+        (m, n) = self.check({'session_id': session_id, 'imsi': imsi}, 'h' * len(session_id))
+        self.assertEqual(m.avps[0].data, session_id)
+        self.assertEqual(m.avps[3].data, imsi)
+        self.assertEqual(m.avps[4].avps[1].data, imsi)
+        self.assertEqual(n.avps[1].data, 'h' * len(session_id))
+
+  def test_ids(self):
+    # requests get fresh identifiers, answers must match them
+    (a, b) = (self.run_scenario({}, 'hss'), self.run_scenario({}, 'hss'))
+    self.assertNotEqual(HEADER.unpack_from(a[0])[2:], HEADER.unpack_from(b[0])[2:])
+
+    c = self.scenario.coroutine({})
+    c.next()
+    c.send(None)
+    self.assertRaises(AssertionError, c.send, (None, aia('hss')))
+
+  def test_unsupported(self):
+    self.assertRaises(CompileError, Compiler('test.scn').compile, SCENARIO.replace('f.close()', 'print(m)'))
+
+if __name__ == '__main__':
+  unittest.main()
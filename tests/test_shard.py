@@ -0,0 +1,116 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+from Pdml import Pdu
+from shard import canonical_flow, flow_key, demux, map_flows
+
+from multiprocessing.pool import ThreadPool
+import time
+import unittest
+
+def pdu(n, client_port, reply=False):
+  '''PDU numbered n of the flow of client_port, in given direction.'''
+  if reply:
+    return Pdu.from_content(n, '10.0.0.2', '10.0.0.1', 132, 3868, client_port, u'', 'x')
+  return Pdu.from_content(n, '10.0.0.1', '10.0.0.2', 132, client_port, 3868, u'', 'x')
+
+def capture(count, flows):
+  '''count PDUs spread over flows, alternating directions.'''
+  return [pdu(n, 40000 + n % flows, reply=(n / flows) % 2) for n in range(count)]
+
+class FakeResult(object):
+  '''never ready until waited for, so that map_flows bounds are reached.'''
+  def __init__(self, pool, func, task):
+    (self.pool, self.func, self.task) = (pool, func, task)
+
+  def ready(self):
+    return False
+
+  def get(self):
+    self.pool.inflight -= 1
+    r = self.func(self.task)
+    self.pool.completed += len(r)
+    return r
+
+class FakePool(object):
+  def __init__(self):
+    self.inflight = 0
+    self.max_inflight = 0
+    self.completed = 0
+
+  def apply_async(self, func, args):
+    self.inflight += 1
+    self.max_inflight = max(self.max_inflight, self.inflight)
+    return FakeResult(self, func, args[0])
+
+def numbers(task):
+  return [(seq, p.pdml.frm_number) for (seq, p) in task[1]]
+
+class DemuxTest(unittest.TestCase):
+  def test_both_directions(self):
+    (a, b) = (pdu(0, 40000), pdu(1, 40000, reply=True))
+    self.assertEqual(flow_key(a), flow_key(b))
+    self.assertEqual(canonical_flow((132, '10.0.0.1', 40000, '10.0.0.2', 3868)), flow_key(a))
+    self.assertNotEqual(flow_key(a), flow_key(pdu(2, 40001)))
+
+    tasks = list(demux([a, b, pdu(2, 40001)]))
+    self.assertEqual([numbers(t) for t in tasks], [[(0, 0), (1, 1)], [(2, 2)]])
+
+  def test_batch(self):
+    tasks = list(demux(capture(10, 1), batch=4))
+    self.assertEqual([len(t[1]) for t in tasks], [4, 4, 2])
+    self.assertEqual(len(set([t[0] for t in tasks])), 1)
+
+  def test_window(self):
+    window = 8
+    read = [0]
+    def pdus():
+      for p in capture(200, 3):
+        read[0] += 1
+        yield p
+
+    emitted = 0
+    seqs = []
+    for (key, task) in demux(pdus(), window=window):
+      emitted += len(task)
+      self.assertLessEqual(read[0] - emitted, window)
+      seqs.extend([seq for (seq, p) in task])
+    self.assertEqual(sorted(seqs), range(200))
+
+class MapFlowsTest(unittest.TestCase):
+  def test_sequential(self):
+    pdus = capture(50, 4)
+    self.assertEqual(list(map_flows(pdus, numbers, batch=3)), range(50))
+
+  def test_out_of_order(self):
+    # tasks of the first flow take longer than those of the others
+    def slow(task):
+      if task[0] == flow_key(pdu(0, 40000)):
+        time.sleep(0.05)
+      return numbers(task)
+
+    pool = ThreadPool(4)
+    try:
+      r = list(map_flows(capture(60, 3), slow, pool, batch=5))
+    finally:
+      pool.close()
+      pool.join()
+    self.assertEqual(r, range(60))
+
+  def test_bounds(self):
+    (pending, window) = (4, 16)
+    pool = FakePool()
+    yielded = 0
+    for r in map_flows(capture(500, 7), numbers, pool, batch=2, pending=pending, window=window):
+      self.assertEqual(r, yielded)
+      yielded += 1
+      # results waiting for earlier ones, plus the task just completed
+      self.assertLessEqual(pool.completed - yielded, window + 2)
+    self.assertEqual(yielded, 500)
+    self.assertLessEqual(pool.max_inflight, pending)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,167 @@
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import Diameter as dm
+from transaction import Transactions, U32_MAX
+from engine import Engine, Peer
+from scenario import Disconnected, dwa, frames, set_ids
+
+import socket as sk
+import threading
+import time
+import unittest
+
+def dwr():
+  return dm.Msg(code=280, R=True, avps=[
+    dm.Avp(code=264, M=True, data='client'),
+    dm.Avp(code=296, M=True, data='realm')])
+
+def answer(m, h2h_id=None, e2e_id=None):
+  data = dwa('server', 'realm', m.h2h_id, m.e2e_id)
+  if h2h_id is not None or e2e_id is not None:
+    data = set_ids(data, m.h2h_id if h2h_id is None else h2h_id, m.e2e_id if e2e_id is None else e2e_id)
+  return data
+
+class TransactionsTest(unittest.TestCase):
+  def setUp(self):
+    self.tsxs = Transactions()
+
+  def test_counters(self):
+    (a, b) = (self.tsxs.request(dwr()), self.tsxs.request(dwr()))
+    self.assertEqual(b.request.h2h_id, (a.request.h2h_id + 1) & U32_MAX)
+    self.assertEqual(b.request.e2e_id, (a.request.e2e_id + 1) & U32_MAX)
+
+  def test_match(self):
+    (a, b) = (self.tsxs.request(dwr()), self.tsxs.request(dwr()))
+    self.assertIs(self.tsxs.match(answer(b.request)), b)
+    self.assertIs(self.tsxs.match(answer(a.request)), a)
+    # requests are not answers
+    self.assertIsNone(self.tsxs.match(b.request.encode()))
+
+  def test_match_e2e(self):
+    (a, b) = (self.tsxs.request(dwr()), self.tsxs.request(dwr()))
+    # hop-by-hop identifier unknown, or of another request
+    self.assertIs(self.tsxs.match(answer(a.request, h2h_id=a.request.h2h_id + 100)), a)
+    self.assertIs(self.tsxs.match(answer(a.request, h2h_id=b.request.h2h_id)), a)
+    self.assertIsNone(self.tsxs.match(answer(a.request, e2e_id=a.request.e2e_id + 100)))
+
+  def test_answer(self):
+    t = self.tsxs.request(dwr())
+    done = []
+    t.add_done_callback(done.append)
+    m = dm.Msg.decode(answer(t.request))
+    self.tsxs.answer(t, m)
+    self.assertEqual(done, [t])
+    self.assertIs(t.result(), m)
+    self.assertIsNotNone(t.latency())
+    self.assertIsNone(self.tsxs.match(answer(t.request)))
+    self.assertEqual((self.tsxs.outstanding, self.tsxs.by_e2e), ({}, {}))
+
+  def test_expire(self):
+    (a, b, c) = (self.tsxs.request(dwr(), 1.0), self.tsxs.request(dwr(), 10.0), self.tsxs.request(dwr()))
+    self.tsxs.expire(a.started + 5.0)
+    self.assertTrue(a.done())
+    self.assertRaises(sk.timeout, a.result)
+    self.assertFalse(b.done() or c.done())
+    self.assertIsNone(self.tsxs.match(answer(a.request)))
+    self.assertIs(self.tsxs.match(answer(b.request)), b)
+
+  def test_fail_all(self):
+    ts = [self.tsxs.request(dwr()) for i in range(3)]
+    # a callback ending another transaction
+    ts[0].add_done_callback(lambda t: self.tsxs.fail(ts[2], ValueError()))
+    self.tsxs.fail_all(Disconnected())
+    self.assertRaises(Disconnected, ts[0].result)
+    self.assertRaises(Disconnected, ts[1].result)
+    self.assertTrue(ts[2].done())
+    self.assertEqual((self.tsxs.outstanding, self.tsxs.by_e2e), ({}, {}))
+
+class EngineTest(unittest.TestCase):
+  def setUp(self):
+    (self.f, self.peer) = sk.socketpair(sk.AF_UNIX, sk.SOCK_STREAM)
+    self.engine = Engine('host', 'realm')
+    self.results = []
+
+  def tearDown(self):
+    self.peer.close()
+
+  def serve(self, count, reply):
+    '''reads count requests, then gives them to reply, whose result is sent.'''
+    rbuf = ''
+    requests = []
+    while len(requests) < count:
+      b = self.peer.recv(65536)
+      if len(b) == 0:
+        return
+      (msgs, rbuf) = frames(rbuf + b)
+      requests.extend([dm.Msg.decode(data) for data in msgs])
+    data = reply(requests)
+    if data:
+      self.peer.sendall(data)
+
+  def run_engine(self, scenario, count, reply):
+    t = threading.Thread(target=self.serve, args=(count, reply))
+    t.start()
+    sessions = []
+    self.engine.add(self.f, scenario(Peer(timeout=1.0)), done=sessions.append)
+    self.engine.run()
+    t.join()
+    return sessions[0]
+
+  def test_pipelined(self):
+    def scenario(peer):
+      ts = []
+      for i in range(3):
+        t = yield peer.request(dwr())
+        ts.append(t)
+      for t in ts:
+        m = yield peer.wait(t)
+        self.results.append(m.h2h_id == t.request.h2h_id)
+      yield peer.close()
+
+    # answers in reverse order, a DWR of the peer in between
+    def reply(requests):
+      data = ''.join([answer(m) for m in reversed(requests[1:])])
+      return data + set_ids(dwr().encode(), 1, 1) + answer(requests[0])
+
+    s = self.run_engine(scenario, 3, reply)
+    self.assertIsNone(s.exc_info)
+    self.assertEqual(self.results, [True] * 3)
+    # the DWR is answered on behalf of the scenario, and not recorded
+    self.assertEqual([(m.R, is_sent) for (m, is_sent) in s.msgs], [(True, True)] * 3 + [(False, False)] * 3)
+
+  def test_timeout(self):
+    def scenario(peer):
+      t = yield peer.request(dwr(), timeout=0.05)
+      try:
+        yield peer.wait(t)
+      except sk.timeout:
+        self.results.append('timeout')
+      yield peer.close()
+
+    started = time.time()
+    s = self.run_engine(scenario, 1, lambda requests: '')
+    self.assertIsNone(s.exc_info)
+    self.assertEqual(self.results, ['timeout'])
+    self.assertLess(time.time() - started, 1.0)
+
+  def test_disconnected(self):
+    def scenario(peer):
+      t = yield peer.request(dwr())
+      try:
+        yield peer.wait(t)
+      except Disconnected:
+        self.results.append('disconnected')
+
+    def reply(requests):
+      self.peer.shutdown(sk.SHUT_RDWR)
+      return ''
+
+    self.run_engine(scenario, 1, reply)
+    self.assertEqual(self.results, ['disconnected'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Project     : diafuzzer
+# Copyright (C) 2017 Orange
+# All rights reserved.
+# This software is distributed under the terms and conditions of the 'BSD 3-Clause'
+# license which can be found in the file 'LICENSE' in this package distribution.
+
+import time
+import socket as sk
+from random import randint
+from struct import unpack
+
+U32_MAX = pow(2, 32)-1
+
+class Transaction(object):
+  '''future of the answer to a request. Once done, result returns the
+answer, or raises the exception which ended the transaction.'''
+  def __init__(self, request, timeout=None):
+    self.request = request
+    self.started = time.time()
+    self.deadline = None
+    if timeout is not None:
+      self.deadline = self.started + timeout
+    self.finished = None
+    self.answer = None
+    self.exception = None
+    self.callbacks = []
+
+  def done(self):
+    return self.finished is not None
+
+  def result(self):
+    assert(self.done())
+    if self.exception is not None:
+      raise self.exception
+    return self.answer
+
+  def latency(self):
+    '''seconds elapsed between request and answer, or None.'''
+    if self.answer is None:
+      return None
+    return self.finished - self.started
+
+  def add_done_callback(self, cb):
+    if self.done():
+      cb(self)
+    else:
+      self.callbacks.append(cb)
+
+  def complete(self, answer=None, exception=None):
+    if self.done():
+      return
+    self.finished = time.time()
+    (self.answer, self.exception) = (answer, exception)
+    (callbacks, self.callbacks) = (self.callbacks, [])
+    for cb in callbacks:
+      cb(self)
+
+class Transactions(object):
+  '''requests in flight over an association, keyed by hop-by-hop identifier,
+and by end-to-end identifier for answers whose hop-by-hop identifier was
+not restored by an intermediate agent.
+Identifiers are allocated from counters, the end-to-end one being seeded
+as RFC 6733 recommends, so that they do not collide within an association.'''
+  def __init__(self):
+    self.h2h_id = randint(0, U32_MAX)
+    self.e2e_id = ((int(time.time()) & 0xfff) << 20) | randint(0, 0xfffff)
+    self.outstanding = {}
+    self.by_e2e = {}
+
+  def request(self, m, timeout=None):
+    '''allocates identifiers of request m, and tracks its transaction.'''
+    assert(m.R)
+    m.h2h_id = self.h2h_id
+    m.e2e_id = self.e2e_id
+    self.h2h_id = (self.h2h_id + 1) & U32_MAX
+    self.e2e_id = (self.e2e_id + 1) & U32_MAX
+
+    t = Transaction(m, timeout)
+    self.outstanding[m.h2h_id] = t
+    self.by_e2e[m.e2e_id] = t
+    return t
+
+  def match(self, data):
+    '''outstanding transaction answered by encoded message data, or None.
+Only the message header is looked at.'''
+    (flags, h2h_id, e2e_id) = unpack('!4xB7xLL', data[:20])
+    if flags & 0x80:
+      return None
+    t = self.outstanding.get(h2h_id)
+    if t is None or t.request.e2e_id != e2e_id:
+      t = self.by_e2e.get(e2e_id)
+    return t
+
+  def answer(self, t, m):
+    self.forget(t)
+    t.complete(answer=m)
+
+  def expire(self, now=None):
+    '''ends transactions whose deadline has passed.'''
+    if now is None:
+      now = time.time()
+    for t in [t for t in self.outstanding.values() if t.deadline is not None and t.deadline <= now]:
+      self.fail(t, sk.timeout('timed out'))
+
+  def fail(self, t, exception):
+    self.forget(t)
+    t.complete(exception=exception)
+
+  def forget(self, t):
+    # callbacks of a transaction may end others
+    if self.outstanding.get(t.request.h2h_id) is t:
+      del self.outstanding[t.request.h2h_id]
+    if self.by_e2e.get(t.request.e2e_id) is t:
+      del self.by_e2e[t.request.e2e_id]
+
+  def fail_all(self, exception):
+    for t in self.outstanding.values():
+      self.fail(t, exception)
@@ -16,6 +16,9 @@ import socket as sk
 
 import Diameter as dm
 from scenario import load_scenario, dwr_handler
+from load import run_load, parse_range
+from server import serve, PeerStats
+from itertools import repeat
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -32,8 +35,22 @@ if __name__ == '__main__':
   parser.add_argument('--local-realm',
     help='Local Diameter realm, used in DWA as Origin-Realm, and may be used as local_realm',
     default='invalid')
-  parser.add_argument('mode', help='Role: client, clientloop or server. When using client or clientloop, an additional positional argument describing the target IP and port, colon separated, must be used. When using server, local address and port must be given using options',
-    choices=('client', 'clientloop', 'server'))
+  parser.add_argument('--socketpair',
+    help='Exchange messages with the scenario over a framed socketpair, instead of an in-process channel',
+    action='store_true')
+  parser.add_argument('--associations',
+    help='Load and server modes: maximum number of simultaneous associations, 100 and 1 by default',
+    type=int)
+  parser.add_argument('--rate',
+    help='Load mode: scenarios started per second', default=10.0, type=float)
+  parser.add_argument('--ramp-up',
+    help='Load mode: seconds taken to reach the rate', default=0.0, type=float)
+  parser.add_argument('--duration',
+    help='Load mode: seconds during which scenarios are started', default=60.0, type=float)
+  parser.add_argument('--imsi-range',
+    help='Load mode: FIRST-LAST range of IMSI substituted in scenario instances')
+  parser.add_argument('mode', help='Role: client, clientloop, load or server. When using client, clientloop or load, an additional positional argument describing the target IP and port, colon separated, must be used. When using server, local address and port must be given using options',
+    choices=('client', 'clientloop', 'load', 'server'))
   parser.add_argument('scenario', help='Python scenario to run')
   parser.add_argument('remote', nargs=argparse.REMAINDER, help='target_ip port')
 
@@ -53,10 +70,10 @@ if __name__ == '__main__':
 
   # parse additional argument in client or clientloop modes
   target = None
-  if args.mode in ('client', 'clientloop'):
+  if args.mode in ('client', 'clientloop', 'load'):
     if len(args.remote) != 2 or len(args.remote[0]) == 0:
       parser.print_help()
-      print >>sys.stderr, 'using client or clientloop modes require to specify target ip port'
+      print >>sys.stderr, 'using client, clientloop or load modes require to specify target ip port'
       sys.exit(1)
 
     target = args.remote[0]
@@ -77,13 +94,33 @@ if __name__ == '__main__':
 
       f.connect((target, port))
 
-      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm)
+      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm,
+        channel=not args.socketpair)
       if exc_info is not None:
         print('raised: %s' % (exc_info))
       f.close()
 
       if args.mode == 'client':
         break
+  elif args.mode == 'load':
+    if not hasattr(scenario, 'coroutine'):
+      print >>sys.stderr, 'load mode requires a template, or a coroutine scenario'
+      sys.exit(1)
+
+    imsis = None
+    if args.imsi_range:
+      imsis = parse_range(args.imsi_range)
+
+    def new_socket():
+      f = sk.socket(family, sk.SOCK_STREAM, sk.IPPROTO_SCTP)
+      if args.local_addresses:
+        addrs = [(a, 0) for a in args.local_addresses]
+        ret = sctp.bindx(f, addrs, family)
+        assert(ret == 0)
+      return f
+
+    run_load(scenario, new_socket, (target, port), args.local_hostname, args.local_realm,
+      args.associations or 100, args.rate, args.duration, args.ramp_up, imsis)
   elif args.mode == 'server':
     srv = sk.socket(family, sk.SOCK_STREAM, sk.IPPROTO_SCTP)
     if args.local_addresses:
@@ -94,9 +131,16 @@ if __name__ == '__main__':
       srv.bind((ADDR_ANY, args.local_port))
     srv.listen(64)
 
-    while True:
-      (f,_) = srv.accept()
-      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm)
+    def handle(f, task):
+      (exc_info, msgs) = dwr_handler(scenario, f, args.local_hostname, args.local_realm,
+        channel=not args.socketpair)
       if exc_info is not None:
         print('raised: %s' % (exc_info))
-      f.close()
+      return (exc_info, msgs)
+
+    # runs forever, per peer statistics are reported on interruption
+    stats = PeerStats()
+    try:
+      serve(srv, repeat(None), handle, args.associations or 1, stats)
+    except KeyboardInterrupt:
+      stats.report()